@@ -0,0 +1,127 @@
+import errno
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+from config import ADMISSION_WORKERS, ADMISSION_MAX_PENDING, ADMISSION_RETENTION_SECONDS
+from retry import RetryTimer
+
+
+class AdmissionQueueFullError(Exception):
+    """Raised when too many download requests are still waiting to be admitted."""
+
+
+class Admission:
+    """
+    A download request that was accepted but whose .odm file may not exist yet.
+    It shows up in the status view under its own id, and once the download is
+    created its `download_id` tells where the download continues.
+    """
+
+    def __init__(self, url: str, options: dict):
+        self.id = f"admission-{uuid.uuid4().hex}"
+        self.url = url
+        self.options = options
+        self.state = "admitting"  # Then "admitted", or "error"
+        self.error: Optional[str] = None
+        self.download = None  # The created Download
+        self.download_id: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def get_raw_status(self) -> dict:
+        header = self.download.header if self.download is not None else None
+        return {
+            "url": self.url,
+            "state": self.state,
+            "host": urlparse(self.url).hostname or "",
+            "error": self.error,
+            "download_id": self.download_id,
+            "download_filename": header.download_filename if header else self.options.get("download_filename"),
+            "total_bytes": header.file_size if header else self.options.get("file_size"),
+            "supports_resume": header.supports_resume if header else None,
+            "admission_seconds": round(self.finished_at - self.created_at, 3) if self.finished_at else None,
+        }
+
+
+class AdmissionPool:
+    """
+    Creates new downloads off the request path. Probing the URL (size, filename,
+    resume support) and creating the .odm file run on at most `max_workers`
+    threads, so a slow origin delays only its own download. At most
+    `max_pending` requests may wait for a worker; more are refused.
+
+    `create(url, **options)` creates and starts the download and returns it.
+    `on_change(admission)` is called whenever an admission changes state, and
+    once more when a finished admission is dropped after `retention` seconds.
+    """
+
+    def __init__(self, create: Callable, on_change: Callable = None, max_workers: int = ADMISSION_WORKERS,
+                 max_pending: int = ADMISSION_MAX_PENDING, retention: float = ADMISSION_RETENTION_SECONDS):
+        self.create = create
+        self.on_change = on_change
+        self.max_pending = max_pending
+        self.retention = retention
+        self.admissions: dict[str, Admission] = {}
+        self._pending = 0
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="admission")
+        self._expiry = RetryTimer(self._expire, name="odm-admission-expiry")
+
+    def submit(self, url: str, **options) -> Admission:
+        """Accepts a download request and returns its admission right away."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise AdmissionQueueFullError(f"{self._pending} downloads are already waiting to be created")
+            self._pending += 1
+            admission = Admission(url, options)
+            self.admissions[admission.id] = admission
+        self._notify(admission)
+        self._executor.submit(self._admit, admission)
+        return admission
+
+    def get(self, admission_id: str) -> Optional[Admission]:
+        return self.admissions.get(admission_id)
+
+    @property
+    def pending_count(self) -> int:
+        return self._pending
+
+    def _admit(self, admission: Admission):
+        try:
+            download = self.create(admission.url, **admission.options)
+            admission.download = download
+            admission.download_id = download.odm_file_path
+            admission.state = "admitted"
+        except OSError as e:
+            admission.error = ("Not enough disk space for the download." if e.errno == errno.ENOSPC
+                               else f"File system error - {e}")
+            admission.state = "error"
+        except Exception as e:
+            admission.error = f"Could not create the download - {e}"
+            admission.state = "error"
+        finally:
+            admission.finished_at = time.time()
+            with self._lock:
+                self._pending -= 1
+            if admission.error:
+                print(f"[WARN] Download of '{admission.url}' was not created: {admission.error}")
+            self._notify(admission)
+            self._expiry.schedule(admission.id, self.retention)
+
+    def _expire(self, admission_id: str):
+        """Forgets a finished admission, the download it created is listed on its own"""
+        with self._lock:
+            admission = self.admissions.pop(admission_id, None)
+        if admission is not None:
+            self._notify(admission)
+
+    def _notify(self, admission: Admission):
+        if self.on_change:
+            self.on_change(admission)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
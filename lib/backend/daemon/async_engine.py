@@ -0,0 +1,415 @@
+import asyncio
+import errno
+import functools
+import time
+from threading import Event, Thread, get_ident
+from typing import Optional
+
+import aiohttp
+from config import WRITE_BUFFER_SIZE, HTTP_POOL_MAXSIZE, HTTP_POOL_IDLE_TIMEOUT, READ_SIZE_MAX
+from checksum import ChecksumMismatchError, parse_digest_headers
+from download_index import DownloadIndex
+from download_manager import (DownloadManager, Download, RemoteFileChangedError, check_range_response,
+                              http_error_message)
+from mirrors import Mirror
+from odm_file import PayloadWriter, Segment
+from read_sizer import ReadSizer, ReceiveBuffer
+from retry import CONNECTION, TIMEOUT
+
+
+class AsyncDownloadManager(DownloadManager):
+    """
+    DownloadManager that runs every transfer as a coroutine on one event loop,
+    instead of starting an OS thread per download.
+
+    The loop is normally the daemon's own (see attach_loop). If none is attached
+    when the first download starts, a private loop is started in a background thread.
+    Disk writes are handed to the loop's default executor so they never block it.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, max_simultaneous_downloads: int = None,
+                 index: DownloadIndex = None):
+        super().__init__(max_simultaneous_downloads, index)
+        self.loop = loop
+        self._loop_thread_id = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def attach_loop(self, loop: asyncio.AbstractEventLoop):
+        """Runs transfers on `loop`. Must be called from the thread running that loop."""
+        self.loop = loop
+        self._loop_thread_id = get_ident()
+
+    def _create_download(self, odm_file_path: str) -> "AsyncDownload":
+        return AsyncDownload(odm_file_path, manager=self, on_finish=self._on_download_finished,
+                             on_checkpoint=self._update_index, rate_limiter=self.rate_limiter,
+                             mirror_stats=self.mirror_stats)
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self.loop is None:
+            loop = asyncio.new_event_loop()
+            started = Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                self.attach_loop(loop)
+                started.set()
+                loop.run_forever()
+
+            Thread(target=run_loop, daemon=True, name="odm-download-loop").start()
+            started.wait()
+        return self.loop
+
+    def call_soon(self, callback, *args):
+        """Runs `callback` on the download loop, from any thread."""
+        loop = self._ensure_loop()
+        if get_ident() == self._loop_thread_id:
+            loop.call_soon(callback, *args)
+        else:
+            loop.call_soon_threadsafe(callback, *args)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """HTTP session shared by all transfers. Only usable on the download loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, limit_per_host=HTTP_POOL_MAXSIZE,
+                                               keepalive_timeout=HTTP_POOL_IDLE_TIMEOUT),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+            )
+        return self._session
+
+    async def close(self):
+        """
+        Stops every transfer (see DownloadManager.close) and closes the shared HTTP session.
+        Must be awaited on the download loop.
+        """
+        states = self._stop_scheduling()
+        await asyncio.gather(*(download.pause_async() for download in states))
+        await self.loop.run_in_executor(None, self._finish_close, states)
+        if self._session is not None:
+            await self._session.close()
+
+
+class AsyncDownload(Download):
+    """A Download driven by a coroutine on the manager's event loop."""
+
+    def __init__(self, odm_file_path: str, manager: AsyncDownloadManager, **kwargs):
+        super().__init__(odm_file_path, **kwargs)
+        self.manager = manager
+        self.task: Optional[asyncio.Task] = None
+        self._stopped = Event()
+        self._stopped.set()
+
+    def resume(self):
+        """Resume a download"""
+        if self.is_downloading or not self._stopped.is_set():
+            return
+        self._stopped.clear()
+        self.manager.call_soon(self._start_task)
+
+    def _start_task(self):
+        self.task = self.manager.loop.create_task(self.download_coroutine(resume=True))
+
+    def pause(self):
+        """
+        Pause a download. Blocks until the transfer has stopped, except on the download
+        loop, which must not block: there it only asks the transfer to stop (see pause_async).
+        """
+        if not self.is_downloading:
+            # Do nothing if download is already in stopped state
+            return
+
+        # Set stop flag to True. The coroutine will automatically set it back to False.
+        self._stop_flag = True
+        if get_ident() == self.manager._loop_thread_id:
+            return
+        self._stopped.wait()
+
+        print(f"Download paused: '{self.odm_file_path}'")
+
+    async def pause_async(self):
+        """Pause a download, waiting on the download loop until the transfer has stopped."""
+        if not self.is_downloading:
+            return
+
+        self._stop_flag = True
+        if self.task is not None:
+            await asyncio.wait({self.task})
+
+        print(f"Download paused: '{self.odm_file_path}'")
+
+    async def _run_blocking(self, function, *args):
+        """Runs a blocking (disk) call in the loop's executor."""
+        return await self.manager.loop.run_in_executor(None, functools.partial(function, *args))
+
+    async def download_coroutine(self, resume=True):
+        """
+        Coroutine that performs the actual file downloading
+        :param resume: If False, file download will start from beginning
+        """
+        print(f"Starting download: {self._odm_object.header.download_filename}, Size: {self._odm_object.header.file_size}Bytes")
+
+        error_msg = None
+        self._start_attempt()
+        try:
+            try:
+                completed = await self._transfer_async(resume)
+            except RemoteFileChangedError as e:
+                # Never mix two versions of the file: start over, once
+                print(f"[WARN] {e}. Restarting '{self._odm_object.header.download_filename}' from the beginning")
+                await self._run_blocking(self._restart_payload, e)
+                completed = await self._transfer_async(resume=True)
+
+            if not completed:
+                # Download was stopped intentionally
+                return
+
+            # Download completed successfully, once its checksums are right
+            await self._run_blocking(self._odm_object.close_writer)
+            print(f"Write statistics: {self._odm_object.get_writer_stats()}")
+            print(f"Checksums: {await self._run_blocking(self._odm_object.finish_checksum)}")
+            self._odm_object.header.completed = True
+            await self._run_blocking(self._odm_object.write_header)
+            await self._run_blocking(self._odm_object.extract_payload, False)
+            if self.on_complete:
+                self.on_complete()
+            print("Download complete")
+
+        except ChecksumMismatchError as e:
+            error_msg = f"Downloaded file is corrupt. {e}"
+
+        except RemoteFileChangedError as e:
+            error_msg = f"The file keeps changing on the server. {e}"
+
+        except aiohttp.ClientResponseError as e:
+            error_msg = http_error_message(e.status, e)
+            self._record_http_error(e.status, e.headers)
+
+        except asyncio.TimeoutError as e:
+            error_msg = "Request timed out. The server is taking too long to respond."
+            self.retry_class = TIMEOUT
+
+        except aiohttp.ClientConnectionError as e:
+            error_msg = "Connection failed. Check your internet connection or the server may be down."
+            self.retry_class = CONNECTION
+
+        except aiohttp.ClientPayloadError as e:
+            error_msg = "Connection lost while receiving the file."
+            self.retry_class = CONNECTION
+
+        except aiohttp.ClientError as e:
+            error_msg = f"Network error - {e}"
+
+        except PermissionError as e:
+            error_msg = "Permission denied writing to file. Check file permissions."
+
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                error_msg = "Not enough disk space to continue the download."
+            else:
+                error_msg = f"File system error - {e}"
+
+        except Exception as e:
+            error_msg = f"Unexpected error - {e}"
+
+        finally:
+            self.is_downloading = False
+            try:
+                await self._run_blocking(self._odm_object.close_writer)
+            except OSError as e:
+                error_msg = error_msg or f"File system error - {e}"
+            if error_msg:
+                self.error_message = error_msg
+                print(f"Error downloading '{self._odm_object.odm_filepath}': {error_msg}")
+                if self.on_error:
+                    self.on_error(error_msg)
+            self._stopped.set()
+            if self.on_finish:
+                self.on_finish(self)
+
+    async def _transfer_async(self, resume=True) -> bool:
+        if self._use_segments():
+            return await self._download_segments_async()
+        return await self._download_stream_async(resume)
+
+    async def _download_stream_async(self, resume=True) -> bool:
+        """
+        Downloads the payload over a single connection.
+        :return: True if the stream was fully received, False if the download was stopped
+        """
+        header = self._odm_object.header
+        writer = await self._run_blocking(self._odm_object.open_writer)
+
+        start_offset = header.downloaded_bytes
+        if start_offset and not resume:
+            # Asked to start over
+            await self._run_blocking(self._odm_object.restart_payload, header.file_size, header.etag,
+                                     header.last_modified)
+            start_offset = 0
+        headers = self._get_range_headers(start_offset) if start_offset else {}
+
+        async with self.manager.session.get(header.url, headers=headers) as response:
+            response.raise_for_status()
+            skip = 0
+            if start_offset:
+                try:
+                    check_range_response(header, response.status, response.headers, start_offset)
+                except RemoteFileChangedError as e:
+                    if response.status != 200:
+                        raise
+                    # The body is the whole file, use it rather than asking again
+                    skip = await self._run_blocking(self._accept_whole_file, response.headers, e, start_offset)
+            else:
+                self._record_validators(response.headers)
+            # Takes the writer lock, which an executor thread may hold while the disk queue is full
+            await self._run_blocking(self._odm_object.add_expected_checksums,
+                                     parse_digest_headers(response.headers, full_response=response.status == 200))
+            self.is_downloading = True
+            while skip > 0 and not self._stop_flag:
+                data = await response.content.read(min(skip, READ_SIZE_MAX))
+                if not data:
+                    break
+                skip -= len(data)
+            if not await self._receive(response, writer, ReceiveBuffer()):
+                return await self._stop()
+        return True
+
+    async def _download_segments_async(self) -> bool:
+        """
+        Downloads the payload as several byte ranges over concurrent connections.
+        :return: True if every segment is complete, False if the download was stopped
+        """
+        header = self._odm_object.header
+        segments, mirrors = await self._run_blocking(self._plan_segments)
+        writer = await self._run_blocking(self._odm_object.open_writer)
+
+        abort = asyncio.Event()
+        errors = []
+        self.is_downloading = True
+        try:
+            await asyncio.gather(*[
+                self._download_segment_async(segment, mirror, writer, abort, errors)
+                for segment, mirror in zip(segments, mirrors)
+            ])
+        finally:
+            await self._run_blocking(self._mirror_set.save)
+
+        if errors:
+            raise errors[0]
+
+        if self._stop_flag:
+            return await self._stop()
+
+        return all(segment.is_complete for segment in header.segments)
+
+    async def _download_segment_async(self, segment: Segment, mirror: Mirror, writer: PayloadWriter,
+                                      abort: asyncio.Event, errors: list):
+        """
+        Fetches the remainder of one segment from `mirror`, moving to another mirror if it fails.
+        Once the segment is complete, it takes over part of a slower one (see _steal_segment).
+        Errors no mirror is left for are collected in `errors` and stop the other segments.
+        """
+        buffer = ReceiveBuffer()
+        try:
+            while segment is not None:
+                try:
+                    await self._fetch_segment_async(segment, mirror, writer, abort, buffer)
+                except (aiohttp.ClientError, asyncio.TimeoutError, RemoteFileChangedError) as e:
+                    if self._stop_flag or abort.is_set():
+                        return
+                    mirror = self._replace_mirror(mirror, segment, e)
+                    if mirror is None:
+                        raise
+                    continue
+                if self._stop_flag or abort.is_set():
+                    return
+                segment = await self._run_blocking(self._steal_segment, writer)
+
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+
+    async def _fetch_segment_async(self, segment: Segment, mirror: Mirror, writer: PayloadWriter,
+                                   abort: asyncio.Event, buffer: ReceiveBuffer):
+        start = self._odm_object.get_resume_byte(segment) - self._odm_object.header.header_size
+        is_mirror = mirror.url != self._odm_object.header.url
+        headers = self._get_range_headers(start, segment.end, is_mirror)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=self._mirror_set.read_timeout)
+        started = time.monotonic()
+        self._mirror_set.begin(mirror)
+        self._active_fetches[segment] = (started, start)
+        try:
+            async with self.manager.session.get(mirror.url, headers=headers, timeout=timeout) as response:
+                response.raise_for_status()
+                check_range_response(self._odm_object.header, response.status, response.headers, start, is_mirror)
+                await self._run_blocking(self._odm_object.add_expected_checksums,
+                                         parse_digest_headers(response.headers, full_response=False))
+                if not await self._receive(response, writer, buffer, segment, abort):
+                    return
+        finally:
+            del self._active_fetches[segment]
+            self._mirror_set.end(mirror, segment.start + segment.downloaded - start, time.monotonic() - started)
+
+        if not segment.is_complete:
+            raise aiohttp.ServerDisconnectedError(
+                f"Connection closed with {segment.remaining} bytes left in segment {segment.start}-{segment.end - 1}")
+
+    async def _receive(self, response: aiohttp.ClientResponse, writer: PayloadWriter, buffer: ReceiveBuffer,
+                       segment: Segment = None, abort: asyncio.Event = None) -> bool:
+        """
+        Copies the response body into the payload, handing it to the writer in
+        batches of WRITE_BUFFER_SIZE bytes so that few calls leave the loop.
+        Reads are collected in `buffer`, which the writer copies from, and their
+        size adapts to the throughput of this response (see ReadSizer).
+        :return: False if the transfer was interrupted by a stop request or an abort
+        """
+        sizer = ReadSizer(initial=self.chunk_size)
+        pending = 0  # Bytes collected in the buffer
+        interrupted = False
+        self._read_sizers.append(sizer)
+        try:
+            while True:
+                if self._stop_flag or (abort is not None and abort.is_set()):
+                    interrupted = True
+                    break
+                size = sizer.size
+                if segment is not None:
+                    # Never write past the end of the segment, which moves back if another connection takes part of it
+                    size = min(size, segment.remaining - pending)
+                    if size <= 0:
+                        break
+                started = time.monotonic()
+                chunk = await response.content.read(size)
+                if not chunk:
+                    break
+                sizer.record(len(chunk), time.monotonic() - started)
+                view = buffer.reserve(pending + len(chunk), keep=pending)
+                view[pending:pending + len(chunk)] = chunk
+                pending += len(chunk)
+                self._record_progress(len(chunk))
+                if self.rate_limiter is not None:
+                    delay = self.rate_limiter.reserve(self, len(chunk))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if pending >= WRITE_BUFFER_SIZE:
+                    await self._write(writer, segment, view[:pending])
+                    pending = 0
+
+            if pending:
+                await self._write(writer, segment, buffer.reserve(pending)[:pending])
+        finally:
+            self._read_sizers.remove(sizer)
+        return not interrupted
+
+    async def _write(self, writer: PayloadWriter, segment: Optional[Segment], data: memoryview):
+        if segment is None:
+            await self._run_blocking(writer.write, data)
+        else:
+            await self._run_blocking(writer.write_segment, segment, data)
+
+    async def _stop(self) -> bool:
+        print(f"Stopping download of '{self._odm_object.header.download_filename}'")
+        self._stop_flag = False
+        self.is_downloading = False
+        await self._run_blocking(self._odm_object.close_writer)
+        return False
@@ -0,0 +1,332 @@
+"""
+Local HTTP stand-in for download servers, used by the benchmarks (see benchmark.py).
+
+Serves synthetic files at /files/<name>, whose content is derived from the name
+so that any byte range can be served (and checked) without keeping the files in
+memory. Server behaviours can be switched on to reproduce real-world conditions:
+Range support (with If-Range), per-connection bandwidth caps, response latency,
+connections dropped mid-stream, injected 429/5xx responses and Content-Disposition
+filenames. Replacing a file (see BenchServer.replace_file) changes its validators.
+Random decisions use a seeded generator, so a run is reproducible.
+
+    python bench_server.py --file big.bin=268435456 --bandwidth 10485760 --error-rate 0.05
+"""
+import argparse
+import email.utils
+import hashlib
+import random
+import re
+import sys
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Optional
+from urllib.parse import unquote, urlparse
+
+PATTERN_SIZE = 1024 * 1024
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class SyntheticFile:
+    """A file whose content is a pattern seeded by its name and version, repeated up to its size."""
+
+    def __init__(self, name: str, size: int, version: int = 0, etag_prefix: str = ""):
+        self.name = name
+        self.size = size
+        self.version = version
+        self.etag = f'"{etag_prefix}{name}-{size}-{version}"'
+        # Versions are a minute apart, so that Last-Modified tells them apart too
+        self.last_modified = email.utils.formatdate(1_700_000_000 + version * 60, usegmt=True)
+        seed = int.from_bytes(hashlib.sha256(f"{name}:{version}".encode()).digest()[:8], "big")
+        pattern = random.Random(seed).randbytes(PATTERN_SIZE)
+        # Twice the pattern, so any window of up to PATTERN_SIZE bytes is one slice
+        self._doubled = memoryview(pattern + pattern)
+
+    def read(self, offset: int, length: int) -> memoryview:
+        """Returns up to PATTERN_SIZE bytes of the content at `offset`."""
+        length = min(length, PATTERN_SIZE, self.size - offset)
+        start = offset % PATTERN_SIZE
+        return self._doubled[start:start + length]
+
+    def iter_range(self, start: int, end: int, chunk_size: int = WRITE_CHUNK_SIZE):
+        """Yields the content of [start, end) in chunks of at most `chunk_size` bytes."""
+        while start < end:
+            chunk = self.read(start, min(chunk_size, end - start))
+            yield chunk
+            start += len(chunk)
+
+    def crc32(self) -> str:
+        """CRC32 of the whole content, as reported by the download checksums."""
+        crc = 0
+        for chunk in self.iter_range(0, self.size, PATTERN_SIZE):
+            crc = zlib.crc32(chunk, crc)
+        return f"{crc:08x}"
+
+
+class BenchServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server for the synthetic files, with configurable behaviour:
+    :param supports_range: Honour Range requests. Otherwise every GET returns the whole file (200).
+    :param bandwidth: Cap in bytes per second for each connection. None for no cap.
+    :param latency: Seconds waited before answering each request
+    :param disconnect_after: Close the connection after sending this many body bytes...
+    :param disconnect_rate: ...in this fraction of the GET responses
+    :param error_rate: Fraction of the GET requests answered with one of `error_statuses` instead
+    :param error_statuses: Status codes used for injected errors, 429 and 503 carry a Retry-After header
+    :param retry_after: Value of the Retry-After header of injected errors, in seconds
+    :param content_disposition: Send the file name in a Content-Disposition header
+    :param seed: Seed of the generator deciding which requests get errors and disconnects
+    :param etag_prefix: Prefix of the ETags of files added afterwards. Servers that build ETags from
+        inode numbers send different ones for mirrors of a file, give each server its own prefix to do the same
+    """
+
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, address=("127.0.0.1", 0), files: dict[str, int] = None, supports_range: bool = True,
+                 bandwidth: Optional[int] = None, latency: float = 0.0, disconnect_after: Optional[int] = None,
+                 disconnect_rate: float = 0.0, error_rate: float = 0.0, error_statuses=(429, 503),
+                 retry_after: int = 1, content_disposition: bool = False, seed: int = 0, etag_prefix: str = ""):
+        super().__init__(address, BenchRequestHandler)
+        self.etag_prefix = etag_prefix
+        self.files: dict[str, SyntheticFile] = {}
+        for name, size in (files or {}).items():
+            self.add_file(name, size)
+        self.supports_range = supports_range
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.disconnect_after = disconnect_after
+        self.disconnect_rate = disconnect_rate
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.retry_after = retry_after
+        self.content_disposition = content_disposition
+        self._random = random.Random(seed)
+        self._lock = Lock()
+
+        # Counters
+        self.requests = 0
+        self.injected_errors = 0
+        self.disconnects = 0
+        self.bytes_sent = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_file(self, name: str, size: int) -> SyntheticFile:
+        self.files[name] = SyntheticFile(name, size, etag_prefix=self.etag_prefix)
+        return self.files[name]
+
+    def replace_file(self, name: str, size: int = None) -> SyntheticFile:
+        """Replaces a file with a new version of different content (and validators)"""
+        previous = self.files[name]
+        self.files[name] = SyntheticFile(name, previous.size if size is None else size, previous.version + 1,
+                                         self.etag_prefix)
+        return self.files[name]
+
+    def url_for(self, name: str) -> str:
+        return f"{self.base_url}/files/{name}"
+
+    def draw(self, rate: float) -> bool:
+        """Whether a request falls in the fraction `rate`. Drawn in arrival order, so runs repeat."""
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def get_stats(self) -> dict:
+        return {"requests": self.requests, "injected_errors": self.injected_errors, "disconnects": self.disconnects,
+                "bytes_sent": self.bytes_sent}
+
+    def start(self) -> Thread:
+        """Serves from a daemon thread"""
+        thread = Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections early (paused downloads, aborted segments) are expected
+        pass
+
+
+class BenchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: BenchServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _get_file(self) -> Optional[SyntheticFile]:
+        path = unquote(urlparse(self.path).path)
+        if not path.startswith("/files/"):
+            return None
+        return self.server.files.get(path[len("/files/"):])
+
+    def _send_file_headers(self, file: SyntheticFile, status: int, start: int, end: int):
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes" if self.server.supports_range else "none")
+        self.send_header("ETag", file.etag)
+        self.send_header("Last-Modified", file.last_modified)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{file.size}")
+        if self.server.content_disposition:
+            self.send_header("Content-Disposition", f'attachment; filename="{file.name}"')
+        self.end_headers()
+
+    def _parse_range(self, file: SyntheticFile) -> Optional[tuple[int, int]]:
+        """Returns the [start, end) range requested, None for the whole file."""
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", "").strip())
+        if not self.server.supports_range or match is None or not any(match.groups()):
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range not in (file.etag, file.last_modified):
+            # The client's copy is of another version, it gets the whole current one
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the last N bytes
+            return max(0, file.size - int(last)), file.size
+        end = min(int(last) + 1, file.size) if last else file.size
+        return int(first), end
+
+    def _send_error(self, status: int):
+        self.send_response(status)
+        if status in (429, 503):
+            self.send_header("Retry-After", str(self.server.retry_after))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.count("requests")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        file = self._get_file()
+        if file is None:
+            self._send_error(404)
+            return
+        self._send_file_headers(file, 200, 0, file.size)
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        if server.latency:
+            time.sleep(server.latency)
+        file = self._get_file()
+        if file is None:
+            self._send_error(404)
+            return
+        if server.draw(server.error_rate):
+            server.count("injected_errors")
+            self._send_error(server.error_statuses[server.requests % len(server.error_statuses)])
+            return
+
+        requested = self._parse_range(file)
+        if requested is None:
+            start, end, status = 0, file.size, 200
+        elif requested[0] >= file.size or requested[0] >= requested[1]:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{file.size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        else:
+            (start, end), status = requested, 206
+        self._send_file_headers(file, status, start, end)
+
+        limit = None
+        if server.disconnect_after is not None and server.draw(server.disconnect_rate):
+            limit = start + server.disconnect_after
+        self._send_body(file, start, end, limit)
+
+    def _send_body(self, file: SyntheticFile, start: int, end: int, limit: Optional[int]):
+        bandwidth = self.server.bandwidth
+        # Chunks of about 10 ms worth of bytes keep the pacing smooth under a cap
+        chunk_size = WRITE_CHUNK_SIZE if not bandwidth else max(1024, min(WRITE_CHUNK_SIZE, bandwidth // 100))
+        started = time.monotonic()
+        sent = 0
+        for chunk in file.iter_range(start, end, chunk_size):
+            if limit is not None and start + sent + len(chunk) > limit:
+                self.wfile.write(chunk[:max(0, limit - start - sent)])
+                self.server.count("disconnects")
+                self.close_connection = True
+                return
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self.server.count("bytes_sent", len(chunk))
+            if bandwidth:
+                ahead = sent / bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def parse_file_spec(spec: str) -> tuple[str, int]:
+    """Parses "<name>=<size in bytes>"."""
+    name, separator, size = spec.partition("=")
+    if not separator or not name or not size.isdigit():
+        raise argparse.ArgumentTypeError(f"Expected <name>=<size in bytes>, got '{spec}'")
+    return name, int(size)
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """Adds the server behaviour options, shared with benchmark.py"""
+    parser.add_argument("--no-range", action="store_true", help="Ignore Range requests and always send whole files")
+    parser.add_argument("--bandwidth", type=int, default=None, help="Per-connection cap in bytes per second")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+    parser.add_argument("--disconnect-after", type=int, default=None,
+                        help="Drop connections after sending this many body bytes (see --disconnect-rate)")
+    parser.add_argument("--disconnect-rate", type=float, default=1.0,
+                        help="Fraction of responses dropped with --disconnect-after (default: 1.0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of GET requests answered with errors")
+    parser.add_argument("--error-status", type=int, action="append", default=None,
+                        help="Status code of injected errors, can be repeated (default: 429 and 503)")
+    parser.add_argument("--content-disposition", action="store_true",
+                        help="Send file names in Content-Disposition headers")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the error and disconnect decisions")
+
+
+def get_server_options(args: argparse.Namespace) -> dict:
+    """Keyword arguments of BenchServer from the options added by add_server_arguments"""
+    return {
+        "supports_range": not args.no_range,
+        "bandwidth": args.bandwidth,
+        "latency": args.latency,
+        "disconnect_after": args.disconnect_after,
+        "disconnect_rate": args.disconnect_rate,
+        "error_rate": args.error_rate,
+        "error_statuses": args.error_status or (429, 503),
+        "content_disposition": args.content_disposition,
+        "seed": args.seed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve synthetic files for download benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on (default: any free port)")
+    parser.add_argument("--file", type=parse_file_spec, action="append", default=[], metavar="NAME=SIZE",
+                        help="File to serve at /files/NAME, can be repeated")
+    add_server_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = BenchServer((args.host, args.port), files=dict(args.file), **get_server_options(args))
+    # The first line tells a parent process where to connect
+    print(server.base_url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.get_stats(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
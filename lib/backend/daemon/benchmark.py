@@ -0,0 +1,396 @@
+"""
+Reproducible download benchmarks, run offline against a local stand-in server.
+
+Starts bench_server.py in a child process, so that its CPU time, I/O and memory
+don't count, then downloads its files with a DownloadManager of the selected
+engine. Each workload is repeated and reported with the median of:
+
+- throughput in MB/s (wall clock, from adding the downloads until the last one completes)
+- CPU seconds per GB downloaded (all threads of this process)
+- read and write system calls per MB (from /proc/self/io, Linux only)
+- .odm header writes per MB
+- peak RSS in MB (reset before each run where /proc/self/clear_refs allows it)
+
+plus the percentiles of the completion times of every file, measured from the
+moment it was added. Every downloaded file is checked against the CRC32 of the
+served content. Results can be saved as a baseline and later runs compared with
+it; the exit status is 1 when a metric regressed by more than the tolerance or
+a download failed.
+
+    python benchmark.py --save-baseline
+    python benchmark.py --engine asyncio --bandwidth 20971520 --error-rate 0.02
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import queue
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Optional
+
+from bench_server import SyntheticFile, add_server_arguments, get_server_options
+
+MB = 1024 * 1024
+DEFAULT_BASELINE_FILE = Path(__file__).resolve().with_name("benchmark_baseline.json")
+
+# Metric -> True if higher values are better
+METRICS = {
+    "throughput_mb_s": True,
+    "cpu_seconds_per_gb": False,
+    "syscalls_per_mb": False,
+    "header_writes_per_mb": False,
+    "peak_rss_mb": False,
+    "completion_p50_s": False,
+    "completion_p90_s": False,
+    "completion_p99_s": False,
+}
+
+
+def get_workloads(args: argparse.Namespace) -> dict[str, dict[str, int]]:
+    """Files of each workload, name -> size"""
+    return {
+        "single-large": {"large.bin": args.large_size},
+        "many-small": {f"small-{i:04d}.bin": args.small_size for i in range(args.small_count)},
+    }
+
+
+class _NullOutput(io.TextIOBase):
+    """Swallows the downloads' progress output without any system call."""
+
+    def write(self, s):
+        return len(s)
+
+    def isatty(self):
+        return False
+
+
+def _read_proc_io() -> Optional[int]:
+    """Read and write system calls made by this process so far, None if unknown"""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+    except OSError:
+        return None
+    return int(counters["syscr"]) + int(counters["syscw"])
+
+
+def _reset_peak_rss() -> bool:
+    """Resets the peak RSS of this process (Linux), returns False if not possible"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _read_peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(values: list[float], fraction: float) -> Optional[float]:
+    """Percentile with linear interpolation between the closest ranks"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _create_manager(engine: str, concurrency: int, index, on_finished):
+    """Creates a download manager of `engine` that also calls `on_finished(download)` after every transfer."""
+    if engine == "asyncio":
+        from async_engine import AsyncDownloadManager as base
+    else:
+        from download_manager import DownloadManager as base
+
+    class ObservedManager(base):
+        def _on_download_finished(self, download):
+            super()._on_download_finished(download)
+            on_finished(download)
+
+    manager = ObservedManager(max_simultaneous_downloads=concurrency, index=index)
+    # The app's speed limit would cap the results
+    manager.set_speed_limit(None)
+    return manager
+
+
+def run_once(base_url: str, files: dict[str, int], expected_crc32: dict[str, str], engine: str, concurrency: int,
+             max_resumes: int, timeout: float) -> dict:
+    """
+    Downloads `files` once into a temporary directory and measures it.
+    Downloads that fail are resumed up to `max_resumes` times each, like a user would.
+    """
+    from download_index import DownloadIndex
+
+    work_dir = Path(tempfile.mkdtemp(prefix="odm-bench-"))
+    finished = queue.Queue()
+    index = DownloadIndex(work_dir / "index.db")
+    manager = _create_manager(engine, concurrency, index, finished.put)
+
+    added_at: dict[str, float] = {}
+    completion_times = []
+    resumes = 0
+    failed = []
+    resume_counts: dict[str, int] = {}
+    pending = set(files)
+
+    _reset_peak_rss()
+    started_syscalls = _read_proc_io()
+    started_cpu = time.process_time()
+    started = time.perf_counter()
+    try:
+        for name in files:
+            added_at[name] = time.perf_counter()
+            # No filename, so it's detected from Content-Disposition or the URL like for real downloads
+            manager.download_file(f"{base_url}/files/{name}", download_dir=str(work_dir))
+
+        deadline = started + timeout
+        while pending:
+            try:
+                download = finished.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                failed.extend(f"{name}: timed out" for name in pending)
+                break
+            name = download.header.download_filename
+            if name not in pending:
+                continue
+            if download.header.completed:
+                completion_times.append(time.perf_counter() - added_at[name])
+                pending.discard(name)
+            elif download.error_message:
+                if resume_counts.get(name, 0) < max_resumes:
+                    resume_counts[name] = resume_counts.get(name, 0) + 1
+                    resumes += 1
+                    manager.resume_download(download.odm_file_path)
+                else:
+                    failed.append(f"{name}: {download.error_message}")
+                    pending.discard(name)
+        elapsed = time.perf_counter() - started
+        cpu_seconds = time.process_time() - started_cpu
+        syscalls = _read_proc_io()
+        peak_rss = _read_peak_rss()
+
+        header_writes = 0
+        downloaded_bytes = 0
+        for download in manager.active_downloads.values():
+            header_writes += download._odm_object.get_writer_stats().get("header_writes", 0)
+            if download.header.completed:
+                downloaded_bytes += download.header.downloaded_bytes
+                crc32 = download.header.checksum.results.get("crc32")
+                if crc32 != expected_crc32[download.header.download_filename]:
+                    failed.append(f"{download.header.download_filename}: CRC32 {crc32} doesn't match the served "
+                                  f"content ({expected_crc32[download.header.download_filename]})")
+    finally:
+        for download in list(manager.active_downloads.values()):
+            if download.is_downloading:
+                manager.pause_download(download.odm_file_path)
+        if engine == "asyncio" and manager.loop is not None:
+            import asyncio
+            asyncio.run_coroutine_threadsafe(manager.close(), manager.loop).result()
+        index.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    megabytes = downloaded_bytes / MB
+    return {
+        "elapsed_s": elapsed,
+        "bytes": downloaded_bytes,
+        "throughput_mb_s": megabytes / elapsed if elapsed else None,
+        "cpu_seconds_per_gb": cpu_seconds / (megabytes / 1024) if megabytes else None,
+        "syscalls_per_mb": (syscalls - started_syscalls) / megabytes
+        if megabytes and syscalls is not None and started_syscalls is not None else None,
+        "header_writes_per_mb": header_writes / megabytes if megabytes else None,
+        "peak_rss_mb": peak_rss / MB if peak_rss is not None else None,
+        "completion_times_s": completion_times,
+        "resumes": resumes,
+        "failed": failed,
+    }
+
+
+def summarize(runs: list[dict]) -> dict:
+    """Median of every metric over the runs, completion percentiles over all files of all runs"""
+    completion_times = [seconds for run in runs for seconds in run["completion_times_s"]]
+    summary = {}
+    for metric in METRICS:
+        if metric.startswith("completion_"):
+            continue
+        values = [run[metric] for run in runs if run[metric] is not None]
+        summary[metric] = statistics.median(values) if values else None
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        summary[f"completion_{name}_s"] = percentile(completion_times, fraction)
+    summary["runs"] = len(runs)
+    summary["resumes"] = sum(run["resumes"] for run in runs)
+    summary["failed"] = [failure for run in runs for failure in run["failed"]]
+    return summary
+
+
+def start_server(args: argparse.Namespace, files: dict[str, int]) -> tuple[subprocess.Popen, str]:
+    """Runs bench_server.py with the behaviour options of `args` in a child process"""
+    command = [sys.executable, str(Path(__file__).resolve().with_name("bench_server.py"))]
+    for name, size in files.items():
+        command += ["--file", f"{name}={size}"]
+    for key, value in get_server_options(args).items():
+        if key == "supports_range":
+            command += [] if value else ["--no-range"]
+        elif key == "error_statuses":
+            for status in value:
+                command += ["--error-status", str(status)]
+        elif key == "content_disposition":
+            command += ["--content-disposition"] if value else []
+        elif value is not None:
+            command += [f"--{key.replace('_', '-')}", str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    base_url = process.stdout.readline().strip()
+    if not base_url:
+        process.kill()
+        raise RuntimeError("The benchmark server failed to start")
+    return process, base_url
+
+
+def get_settings(args: argparse.Namespace) -> dict:
+    """Everything that changes what is measured, stored with a baseline"""
+    return {
+        "engine": args.engine,
+        "concurrency": args.concurrency,
+        "large_size": args.large_size,
+        "small_size": args.small_size,
+        "small_count": args.small_count,
+        "max_resumes": args.max_resumes,
+        "server": get_server_options(args),
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Prints every metric next to its baseline value and returns the regressions beyond `tolerance`"""
+    regressions = []
+    print(f"\nCompared with the baseline of {baseline.get('recorded_at', 'unknown date')} "
+          f"(tolerance {tolerance:.0%}):")
+    for workload, summary in results.items():
+        reference = baseline["results"].get(workload)
+        if reference is None:
+            print(f"  {workload}: not in the baseline")
+            continue
+        print(f"  {workload}")
+        for metric, higher_is_better in METRICS.items():
+            current, previous = summary.get(metric), reference.get(metric)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions.append(f"{workload} {metric}: {previous:.4g} -> {current:.4g} ({change:+.1%})")
+            print(f"    {metric:<22} {previous:>12.4g} -> {current:>12.4g}  {change:+7.1%}{flag}")
+    return regressions
+
+
+def print_summary(workload: str, summary: dict):
+    print(f"\n{workload} ({summary['runs']} runs, {summary['resumes']} resumes, {len(summary['failed'])} failures)")
+    for metric in METRICS:
+        value = summary[metric]
+        print(f"  {metric:<22} {'n/a' if value is None else f'{value:.4g}':>12}")
+    for failure in summary["failed"][:10]:
+        print(f"  [FAILED] {failure}")
+
+
+def main(argv=None) -> int:
+    from config import MAX_SIMULTANEOUS_DOWNLOADS, DOWNLOAD_ENGINE
+
+    parser = argparse.ArgumentParser(description="Benchmark downloads against a local stand-in server")
+    parser.add_argument("--workload", action="append", choices=["single-large", "many-small"],
+                        help="Workload to run, can be repeated (default: all)")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default=DOWNLOAD_ENGINE)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each workload (default: 3)")
+    parser.add_argument("--concurrency", type=int, default=MAX_SIMULTANEOUS_DOWNLOADS,
+                        help=f"Simultaneous downloads (default: {MAX_SIMULTANEOUS_DOWNLOADS})")
+    parser.add_argument("--large-size", type=int, default=256 * MB, help="Size of the single large file")
+    parser.add_argument("--small-size", type=int, default=256 * 1024, help="Size of each small file")
+    parser.add_argument("--small-count", type=int, default=200, help="Number of small files")
+    parser.add_argument("--max-resumes", type=int, default=3, help="Resumes of a failed download before giving up")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds allowed for each run")
+    add_server_arguments(parser)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_FILE, help="Baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative change of a metric reported as a regression (default: 0.10)")
+    parser.add_argument("--json", type=Path, default=None, help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the downloads")
+    args = parser.parse_args(argv)
+
+    workloads = get_workloads(args)
+    selected = args.workload or list(workloads)
+    all_files = {name: size for workload in selected for name, size in workloads[workload].items()}
+    expected_crc32 = {name: SyntheticFile(name, size).crc32() for name, size in all_files.items()}
+
+    server, base_url = start_server(args, all_files)
+    results = {}
+    try:
+        for workload in selected:
+            runs = []
+            for i in range(args.repeat):
+                output = None if args.verbose else _NullOutput()
+                with redirect_stdout(output or sys.stdout), redirect_stderr(output or sys.stderr):
+                    runs.append(run_once(base_url, workloads[workload], expected_crc32, args.engine,
+                                         args.concurrency, args.max_resumes, args.timeout))
+                print(f"[INFO] {workload} run {i + 1}/{args.repeat}: {runs[-1]['elapsed_s']:.2f}s")
+            results[workload] = summarize(runs)
+            print_summary(workload, results[workload])
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "settings": get_settings(args),
+        "results": results,
+    }
+    if args.json is not None:
+        args.json.write_text(json.dumps(report, indent=2))
+
+    regressions = []
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"\n[INFO] Saved the baseline to {args.baseline}")
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("settings") != report["settings"]:
+            print("\n[WARN] The baseline was recorded with different settings, the comparison may be meaningless")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            for regression in regressions:
+                print(f"  {regression}")
+
+    failures = sum(len(summary["failed"]) for summary in results.values())
+    return 1 if regressions or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+import base64
+import binascii
+import hashlib
+import os
+import zlib
+from typing import Optional
+
+from config import CHECKSUM_ALGORITHMS
+
+# Digest algorithm names used by HTTP headers, mapped to the names used here
+HTTP_ALGORITHM_NAMES = {
+    "md5": "md5",
+    "sha": "sha1",
+    "sha-1": "sha1",
+    "sha-256": "sha256",
+    "sha-512": "sha512",
+}
+SUPPORTED_ALGORITHMS = {"crc32"} | hashlib.algorithms_guaranteed
+
+
+class ChecksumMismatchError(Exception):
+    """Raised when a finished payload doesn't match an expected digest."""
+
+
+# Reflected CRC32 polynomial, the one zlib.crc32 uses
+_CRC32_POLY = 0xEDB88320
+
+
+def _multmodp(a: int, b: int) -> int:
+    """Multiplies a(x) by b(x) modulo the CRC32 polynomial. `a` must not be zero."""
+    m = 1 << 31
+    product = 0
+    while True:
+        if a & m:
+            product ^= b
+            if not a & (m - 1):
+                return product
+        m >>= 1
+        b = (b >> 1) ^ _CRC32_POLY if b & 1 else b >> 1
+
+
+def _get_x2n_table() -> list[int]:
+    table = [1 << 30]  # x^1
+    for _ in range(31):
+        table.append(_multmodp(table[-1], table[-1]))
+    return table
+
+
+_X2N_TABLE = _get_x2n_table()  # x^(2^n) modulo the polynomial
+
+
+def crc32_combine(crc1: int, crc2: int, length2: int) -> int:
+    """
+    Returns the CRC32 of A + B from the CRC32 of A, the CRC32 of B and the length of B,
+    without the bytes (zlib's crc32_combine, which the zlib module doesn't expose).
+    """
+    # crc1 times x^(8 * length2), computed from the powers x^(2^n) of the bits of length2
+    power = 1 << 31  # x^0
+    n = 3
+    while length2:
+        if length2 & 1:
+            power = _multmodp(_X2N_TABLE[n & 31], power)
+        length2 >>= 1
+        n += 1
+    return _multmodp(power, crc1) ^ crc2
+
+
+class Checksum:
+    """
+    Checksums of a payload, computed incrementally as it is written.
+
+    CRC32 is kept for each run of contiguous bytes written, keyed by its start:
+    every segment of a segmented download extends its own run, and adjacent runs
+    are merged with crc32_combine, so no byte is ever read back. The runs are
+    stored in the header, so CRC32 progress survives a restart.
+
+    The other algorithms (hashlib) can only take the payload in order and their
+    state can't be serialized: only CRC32 is resumable. Each of them hashes the
+    bytes that extend its own contiguous prefix as they are written; finish() reads
+    the rest from the file in a single pass once the payload is complete (the
+    segments after the first one, what a hasher added late missed, or the whole
+    payload after a restart).
+    """
+
+    def __init__(self, algorithms=CHECKSUM_ALGORITHMS, expected: dict = None, runs=None, results: dict = None):
+        self.expected: dict[str, str] = dict(expected or {})  # Algorithm -> lowercase hex digest
+        self.algorithms: list[str] = list(dict.fromkeys([*algorithms, *self.expected]))
+        # CRC32 of the payload ranges written so far: start -> [end, CRC32]
+        self.runs: dict[int, list[int]] = {start: [end, crc] for start, end, crc in runs or ()}
+        self.results: dict[str, str] = dict(results or {})  # Final digests, once the payload is complete
+        # hashlib hashers, with the number of payload bytes each one took, in this process
+        self._hashers: dict = {name: hashlib.new(name) for name in self.algorithms if name != "crc32"}
+        self._offsets: dict[str, int] = dict.fromkeys(self._hashers, 0)
+
+    @property
+    def offset(self) -> int:
+        """Number of payload bytes taken by every hashlib hasher"""
+        return min(self._offsets.values(), default=0)
+
+    def add_expected(self, algorithm: str, hexdigest: str):
+        """Expects the payload to have `hexdigest`, computing `algorithm` too if it isn't yet."""
+        self.expected[algorithm] = hexdigest.lower()
+        if algorithm not in self.algorithms:
+            self.algorithms.append(algorithm)
+            if algorithm != "crc32":
+                # Starts from the beginning, finish() reads what it missed; the other hashers keep going
+                self._hashers[algorithm] = hashlib.new(algorithm)
+                self._offsets[algorithm] = 0
+
+    def update(self, offset: int, data):
+        """Hashes `data`, written at payload `offset`."""
+        if not len(data):
+            return
+        end = offset + len(data)
+        if "crc32" in self.algorithms:
+            self._update_crc32(offset, data)
+        for name, hashed in self._offsets.items():
+            if offset <= hashed < end:
+                self._hashers[name].update(memoryview(data)[hashed - offset:])
+                self._offsets[name] = end
+
+    def _update_crc32(self, offset: int, data):
+        end = offset + len(data)
+        for start, run in self.runs.items():
+            if start <= offset <= run[0]:
+                # Extends the run, bytes it holds already are the same ones
+                if run[0] < end:
+                    run[1] = zlib.crc32(memoryview(data)[run[0] - offset:], run[1])
+                    run[0] = end
+                break
+        else:
+            run = self.runs[offset] = [end, zlib.crc32(data)]
+
+        following = self.runs.pop(run[0], None)
+        if following is not None:
+            # The run reached the start of the next one (a segment finished)
+            run[1] = crc32_combine(run[1], following[1], following[0] - run[0])
+            run[0] = following[0]
+
+    def get_runs(self) -> list[tuple[int, int, int]]:
+        """Returns the (start, end, CRC32) runs, in payload order."""
+        return [(start, end, crc) for start, (end, crc) in sorted(self.runs.items())]
+
+    @staticmethod
+    def _read(f, header_size: int, start: int, end: int, chunk_size: int):
+        """Yields the payload bytes [start, end) of the open file `f`, in chunks"""
+        fd = f.fileno()
+        while start < end:
+            data = os.pread(fd, min(chunk_size, end - start), header_size + start)
+            if not data:
+                raise EOFError(f"Payload ends before byte {end}")
+            yield data
+            start += len(data)
+
+    def finish(self, f, header_size: int, size: int, chunk_size: int = 1024 * 1024) -> dict[str, str]:
+        """
+        Returns the final hex digests of the `size` bytes payload and keeps them in `results`.
+        The bytes that weren't hashed as they were written are read from the open file `f`.
+        """
+        results = {}
+        if self._hashers:
+            position = self.offset
+            for data in self._read(f, header_size, position, size, chunk_size):
+                end = position + len(data)
+                for name, hashed in self._offsets.items():
+                    if hashed < end:
+                        self._hashers[name].update(memoryview(data)[max(hashed - position, 0):])
+                        self._offsets[name] = end
+                position = end
+            results.update((name, hasher.hexdigest()) for name, hasher in self._hashers.items())
+
+        if "crc32" in self.algorithms:
+            crc = 0
+            position = 0
+            while position < size:
+                run = self.runs.get(position)
+                if run is not None:
+                    crc = crc32_combine(crc, run[1], run[0] - position)
+                    position = run[0]
+                    continue
+                # A gap, left by a file written before its runs were stored or by crc32 added late
+                gap_end = min((start for start in self.runs if start > position), default=size)
+                for data in self._read(f, header_size, position, min(gap_end, size), chunk_size):
+                    crc = zlib.crc32(data, crc)
+                position = gap_end
+            results["crc32"] = f"{crc:08x}"
+
+        self.results = {name: results[name] for name in self.algorithms}
+        return self.results
+
+    @property
+    def verified(self) -> Optional[bool]:
+        """Whether the results match every expected digest, or None if that isn't known."""
+        if not self.expected or not self.results:
+            return None
+        return all(self.results.get(name) == digest for name, digest in self.expected.items())
+
+    def verify(self):
+        """Raises ChecksumMismatchError if a result differs from its expected digest."""
+        for name, digest in self.expected.items():
+            if self.results.get(name) != digest:
+                raise ChecksumMismatchError(
+                    f"Checksum mismatch: expected {name} {digest}, got {self.results.get(name)}")
+
+    def to_dict(self, include_progress=True) -> dict:
+        data = {"algorithms": self.algorithms, "expected": self.expected, "results": self.results}
+        if include_progress:
+            data["runs"] = [list(run) for run in self.get_runs()]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Checksum":
+        runs = data.get("runs")
+        if runs is None and data.get("offset"):
+            # Stored before runs existed: the CRC32 of the contiguous prefix
+            runs = [(0, data["offset"], data.get("crc32", 0))]
+        return cls(data.get("algorithms", CHECKSUM_ALGORITHMS), data.get("expected"), runs, data.get("results"))
+
+
+def parse_checksum(spec: str) -> tuple[str, str]:
+    """Parses a user supplied checksum such as "sha256:9f86d0..." into (algorithm, hex digest)."""
+    algorithm, separator, digest = spec.replace("=", ":", 1).partition(":")
+    algorithm = HTTP_ALGORITHM_NAMES.get(algorithm.strip().lower(), algorithm.strip().lower())
+    if not separator or algorithm not in SUPPORTED_ALGORITHMS:
+        raise ValueError(f"Unsupported checksum '{spec}', expected <algorithm>:<hex digest>")
+    digest = digest.strip().lower()
+    try:
+        bytes.fromhex(digest)
+    except ValueError:
+        raise ValueError(f"Checksum digest is not hexadecimal: '{digest}'")
+    return algorithm, digest
+
+
+def _base64_to_hex(value: str) -> Optional[str]:
+    try:
+        return base64.b64decode(value.strip().strip(":"), validate=True).hex()
+    except (binascii.Error, ValueError):
+        return None
+
+
+def parse_digest_headers(headers, full_response: bool = True) -> dict[str, str]:
+    """
+    Extracts the expected digests of the whole payload from response headers:
+    Digest (RFC 3230), Repr-Digest (RFC 9530), x-goog-hash and Content-MD5.
+    Content-MD5 describes the response body, so it's only used if `full_response`.
+    :return: Algorithm -> lowercase hex digest
+    """
+    digests = {}
+    candidates = []
+    for name in ("Digest", "Repr-Digest", "x-goog-hash"):
+        value = headers.get(name)
+        if value:
+            # "sha-256=<base64>, md5=<base64>", Repr-Digest wraps the values in colons
+            candidates.extend(item.strip().split("=", 1) for item in value.split(",") if "=" in item)
+    if full_response and headers.get("Content-MD5"):
+        candidates.append(("md5", headers["Content-MD5"]))
+
+    for algorithm, value in candidates:
+        # Unknown names include crc32c, which x-goog-hash sends and zlib can't compute
+        algorithm = HTTP_ALGORITHM_NAMES.get(algorithm.strip().lower())
+        if algorithm is None:
+            continue
+        digest = _base64_to_hex(value)
+        if digest:
+            digests[algorithm] = digest
+    return digests
@@ -1,91 +1,255 @@
-# python
-import sys
+"""
+Compares two files, or the payload of an .odm file with a reference file, and
+reports the byte ranges where they differ.
+
+Both inputs are memory-mapped and compared in large blocks with memcmp. Only
+blocks that differ are searched for the exact mismatching ranges, with NumPy
+when it is installed and otherwise by XOR-ing the blocks as big integers and
+scanning the result for non-zero runs, both of which run in C.
+
+    python compare_files.py reference.bin downloaded.bin
+    python compare_files.py --odm download.bin.odm reference.bin
+"""
+import argparse
+import mmap
 import os
+import re
+import sys
+from typing import Iterator, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BLOCK_SIZE = 1024 * 1024
+_NON_ZERO_RUN = re.compile(rb"[^\x00]+")
 
-CHUNK = 8192
 
 def hex_bytes(b):
     return ' '.join(f'{x:02x}' for x in b)
 
-def context_hex(path, offset, context):
-    with open(path, 'rb') as f:
-        start = max(0, offset - context)
-        f.seek(start)
-        data = f.read(context * 2 + 1)
-    return start, data
-
-def compare_files(path_a, path_b, max_diffs=20, context=16):
-    size_a = os.path.getsize(path_a)
-    size_b = os.path.getsize(path_b)
-    print(f"{path_a}: {size_a} bytes")
-    print(f"{path_b}: {size_b} bytes")
-
-    diffs = []
-    total_diffs = 0
-    offset = 0
-
-    with open(path_a, 'rb') as fa, open(path_b, 'rb') as fb:
-        while True:
-            a = fa.read(CHUNK)
-            b = fb.read(CHUNK)
-            if not a and not b:
-                break
-
-            minlen = min(len(a), len(b))
-            if a[:minlen] != b[:minlen]:
-                # find differing bytes within this chunk
-                for i in range(minlen):
-                    if a[i] != b[i]:
-                        total_diffs += 1
-                        if len(diffs) < max_diffs:
-                            diffs.append(offset + i)
-                # continue scanning remaining bytes in this chunk range
-                # (we already counted differences above)
-            # if chunk lengths differ, account for trailing bytes as differences
-            if len(a) != len(b):
-                extra = abs(len(a) - len(b))
-                total_diffs += extra
-                if len(diffs) < max_diffs:
-                    # record offsets for some of the extra bytes (up to remaining slots)
-                    start_extra = offset + minlen
-                    slots_left = max_diffs - len(diffs)
-                    for j in range(min(slots_left, extra)):
-                        diffs.append(start_extra + j)
-
-            offset += max(len(a), len(b))
-
-    print(f"Total differing bytes (approx): {total_diffs}")
-    if not diffs:
-        if size_a != size_b:
-            print("Files differ only by length (no byte mismatches in overlapping region).")
-        else:
-            print("Files appear identical in the compared regions.")
+
+class ComparisonResult:
+    """Differences between two byte regions. Ranges are [start, end) offsets into the compared regions."""
+
+    def __init__(self, size_a: int, size_b: int, ranges: list[tuple[int, int]], total_ranges: int,
+                 differing_bytes: int):
+        self.size_a = size_a
+        self.size_b = size_b
+        self.ranges = ranges  # Only the first ones, up to the requested maximum
+        self.total_ranges = total_ranges
+        self.differing_bytes = differing_bytes  # In the overlapping part, plus the length difference
+
+    @property
+    def identical(self) -> bool:
+        return self.differing_bytes == 0
+
+    def to_dict(self) -> dict:
+        return {
+            "size_a": self.size_a,
+            "size_b": self.size_b,
+            "identical": self.identical,
+            "differing_bytes": self.differing_bytes,
+            "total_ranges": self.total_ranges,
+            "ranges": self.ranges,
+        }
+
+
+class _MappedFile:
+    """Read-only memory map of a file, which also works for empty files."""
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if size and hasattr(self.data, "madvise"):
+            self.data.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+
+
+def _find_runs(a: bytes, b: bytes) -> Iterator[tuple[int, int]]:
+    """Yields the [start, end) runs of positions where the equally long `a` and `b` differ."""
+    if numpy is not None:
+        differs = numpy.frombuffer(a, dtype=numpy.uint8) != numpy.frombuffer(b, dtype=numpy.uint8)
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([False], differs, [False])).astype(numpy.int8)))
+        yield from zip(edges[0::2].tolist(), edges[1::2].tolist())
+        return
+
+    xor = (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+    for match in _NON_ZERO_RUN.finditer(xor):
+        yield match.start(), match.end()
+
+
+def iter_mismatches(data_a, data_b, offset_a: int = 0, offset_b: int = 0, length: Optional[int] = None,
+                    block_size: int = BLOCK_SIZE) -> Iterator[tuple[int, int]]:
+    """
+    Yields the [start, end) ranges (relative to the offsets) where `length` bytes of
+    `data_a` from `offset_a` differ from `data_b` from `offset_b`. Adjacent runs are merged.
+    """
+    if length is None:
+        length = min(len(data_a) - offset_a, len(data_b) - offset_b)
+
+    pending = None
+    for start in range(0, length, block_size):
+        end = min(start + block_size, length)
+        block_a = data_a[offset_a + start:offset_a + end]
+        block_b = data_b[offset_b + start:offset_b + end]
+        if block_a == block_b:
+            continue
+        for run_start, run_end in _find_runs(block_a, block_b):
+            run_start += start
+            run_end += start
+            if pending is not None and pending[1] == run_start:
+                pending = (pending[0], run_end)
+                continue
+            if pending is not None:
+                yield pending
+            pending = (run_start, run_end)
+    if pending is not None:
+        yield pending
+
+
+def compare_regions(data_a, data_b, offset_a: int = 0, offset_b: int = 0, size_a: Optional[int] = None,
+                    size_b: Optional[int] = None, max_ranges: int = 20,
+                    block_size: int = BLOCK_SIZE) -> ComparisonResult:
+    """Compares `size_a` bytes of `data_a` from `offset_a` with `size_b` bytes of `data_b` from `offset_b`."""
+    size_a = len(data_a) - offset_a if size_a is None else size_a
+    size_b = len(data_b) - offset_b if size_b is None else size_b
+    overlap = min(size_a, size_b)
+
+    ranges = []
+    total_ranges = differing_bytes = 0
+    for start, end in iter_mismatches(data_a, data_b, offset_a, offset_b, overlap, block_size):
+        total_ranges += 1
+        differing_bytes += end - start
+        if len(ranges) < max_ranges:
+            ranges.append((start, end))
+
+    if size_a != size_b:
+        # The bytes only one side has count as a difference too
+        differing_bytes += abs(size_a - size_b)
+        total_ranges += 1
+        if len(ranges) < max_ranges:
+            ranges.append((overlap, max(size_a, size_b)))
+
+    return ComparisonResult(size_a, size_b, ranges, total_ranges, differing_bytes)
+
+
+def _read_odm_regions(odm_path: str) -> tuple[int, list[tuple[int, int]], bool]:
+    """Returns the header size of an .odm file, the payload ranges that were downloaded and whether it is complete."""
+    from odm_file import Header
+
+    with open(odm_path, "rb") as f:
+        header = Header.read_dict(f)
+    header_size = header.get("header_size") or Header.DEFAULT_SIZES[1]
+    if header.get("segments") is not None:
+        regions = [(seg["start"], seg["start"] + seg["downloaded"]) for seg in header["segments"] if seg["downloaded"]]
+    else:
+        regions = [(0, header["downloaded_bytes"])]
+    file_size = header.get("file_size")
+    complete = bool(header.get("completed")) or (
+        file_size is not None and sum(end - start for start, end in regions) >= file_size)
+    return header_size, regions, complete
+
+
+def compare_files(path_a, path_b, max_diffs=20, context=16, block_size=BLOCK_SIZE, verbose=True) -> ComparisonResult:
+    """Compares two files and prints the first `max_diffs` differing ranges with `context` bytes around them."""
+    with _MappedFile(path_a) as a, _MappedFile(path_b) as b:
+        result = compare_regions(a.data, b.data, max_ranges=max_diffs, block_size=block_size)
+        if verbose:
+            print(f"{path_a}: {result.size_a} bytes")
+            print(f"{path_b}: {result.size_b} bytes")
+            _print_result(result, (path_a, a.data, 0), (path_b, b.data, 0), context)
+    return result
+
+
+def compare_odm_payload(odm_path, reference_path, max_diffs=20, context=16, block_size=BLOCK_SIZE,
+                        verbose=True) -> ComparisonResult:
+    """
+    Compares the downloaded parts of the payload of an .odm file with the same
+    ranges of a reference file, skipping the header. A download that is complete
+    must also match the length of the reference.
+    """
+    header_size, regions, complete = _read_odm_regions(odm_path)
+    with _MappedFile(odm_path) as odm, _MappedFile(reference_path) as reference:
+        payload_size = len(odm.data) - header_size
+        ranges = []
+        total_ranges = differing_bytes = 0
+        for start, end in regions:
+            # Preallocated files are longer than the downloaded payload, never compare past the data.
+            # Downloaded bytes the reference doesn't have are counted here, as a length difference
+            end = min(end, payload_size)
+            region = compare_regions(odm.data, reference.data, header_size + start, start, end - start,
+                                     max(0, min(end, len(reference.data)) - start), max_diffs - len(ranges),
+                                     block_size)
+            ranges.extend((start + range_start, start + range_end) for range_start, range_end in region.ranges)
+            total_ranges += region.total_ranges
+            differing_bytes += region.differing_bytes
+
+        downloaded = sum(end - start for start, end in regions)
+        if complete and len(reference.data) > downloaded:
+            # The reference goes on past the end of the complete download
+            missing = (downloaded, len(reference.data))
+            differing_bytes += missing[1] - missing[0]
+            total_ranges += 1
+            if len(ranges) < max_diffs:
+                ranges.append(missing)
+        result = ComparisonResult(downloaded, len(reference.data), ranges, total_ranges, differing_bytes)
+
+        if verbose:
+            print(f"{odm_path}: {downloaded} payload bytes downloaded in {len(regions)} range(s), "
+                  f"header {header_size} bytes")
+            print(f"{reference_path}: {len(reference.data)} bytes")
+            _print_result(result, (f"{odm_path} payload", odm.data, header_size), (reference_path, reference.data, 0),
+                          context)
+    return result
+
+
+def _print_result(result: ComparisonResult, side_a: tuple, side_b: tuple, context: int):
+    """Prints the differing ranges with a hex dump of `context` bytes around the start of each."""
+    if result.identical:
+        print("Files are identical in the compared regions.")
         return
 
-    print(f"Showing up to {len(diffs)} differences (context = {context} bytes):")
-    for d in diffs:
-        a_start, a_chunk = context_hex(path_a, d, context)
-        b_start, b_chunk = context_hex(path_b, d, context)
-        idx_in_chunk = d - a_start
-        # hex lines
-        a_hex = hex_bytes(a_chunk)
-        b_hex = hex_bytes(b_chunk)
-        # pointer line with caret under differing byte
-        # compute caret position in characters: each byte = 2 hex + 1 space => 3 chars, minus final space
-        caret_pos = idx_in_chunk * 3
-        pointer_line = ' ' * caret_pos + '^'
-
-        print(f"\nOffset: {d} (0x{d:x})")
-        print(f"{path_a} @ {a_start}:")
-        print(a_hex)
-        print(pointer_line)
-        print(f"{path_b} @ {b_start}:")
-        print(b_hex)
-        print(pointer_line)
+    print(f"{result.differing_bytes} differing bytes in {result.total_ranges} range(s)")
+    print(f"Showing {len(result.ranges)} range(s) (context = {context} bytes):")
+    for start, end in result.ranges:
+        print(f"\nRange: {start}-{end - 1} (0x{start:x}-0x{end - 1:x}), {end - start} bytes")
+        for name, data, base in (side_a, side_b):
+            # The range start is marked with a caret, each byte takes 3 characters
+            context_start = max(0, start - context)
+            chunk = data[base + context_start:base + min(start + context + 1, len(data) - base)]
+            print(f"{name} @ {context_start}:")
+            print(hex_bytes(chunk))
+            print(' ' * ((start - context_start) * 3) + '^')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare two files, or an .odm payload with a reference file")
+    parser.add_argument("file_a", help="First file, or the .odm file with --odm")
+    parser.add_argument("file_b", help="Second file, or the reference file with --odm")
+    parser.add_argument("--odm", action="store_true",
+                        help="Compare the payload of FILE_A (an .odm file) with FILE_B. Implied by a .odm extension")
+    parser.add_argument("--max-ranges", type=int, default=20, help="Differing ranges to show (default: 20)")
+    parser.add_argument("--context", type=int, default=16, help="Bytes of context around each range (default: 16)")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE,
+                        help=f"Bytes compared at once (default: {BLOCK_SIZE})")
+    args = parser.parse_args(argv)
+
+    if args.odm or args.file_a.endswith(".odm"):
+        result = compare_odm_payload(args.file_a, args.file_b, args.max_ranges, args.context, args.block_size)
+    else:
+        result = compare_files(args.file_a, args.file_b, args.max_ranges, args.context, args.block_size)
+    return 0 if result.identical else 1
+
 
 if __name__ == '__main__':
-    file1 = "/home/bulaya/Downloads/Videos/Big_Buck_Bunny_360_10s_5MB.mp4"
-    file2 = "/home/bulaya/Downloads/ODM Downloads/Big_Buck_Bunny_360_10s_5MB.mp4"
-    # maxd = int(sys.argv[3]) if len(sys.argv) > 3 else 20
-    # ctx = int(sys.argv[4]) if len(sys.argv) > 4 else 16
-    compare_files(file1, file2, )
+    sys.exit(main())
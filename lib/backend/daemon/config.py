@@ -1,11 +1,81 @@
+import json
 from pathlib import Path
 
 DEFAULT_DOWNLOAD_DIR = Path.home() / "Downloads" / "ODM Downloads"
-CONFIG_FILE = Path(__file__).resolve().parent.parent / "config.json"
+CONFIG_FILE = Path(__file__).resolve().parents[3] / "app_data" / "settings.json"  # Settings written by the Flutter app
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 VERSION = "0.1.0"
 
 
+def load_app_config() -> dict:
+    """Reads the app settings from CONFIG_FILE, returning an empty dict if they can't be read."""
+    try:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Could not read app config '{CONFIG_FILE}': {e}")
+        return {}
+
+
+# Scheduling: downloads beyond these limits wait in a priority queue.
+# The global cap defaults to the app's "maxSimultaneousDownloads" setting
+MAX_SIMULTANEOUS_DOWNLOADS = 4
+MAX_CONNECTIONS_PER_HOST = 8
+
+# Download engine: "threads" runs each download on its own OS thread, "asyncio"
+# runs all transfers as coroutines on the daemon's event loop (requires aiohttp)
+DOWNLOAD_ENGINE = "threads"
+
+# Bandwidth limiting: how many seconds' worth of bytes a download may take at
+# once. The global limit itself comes from the app's "downloadSpeedLimit" (B/s)
+RATE_LIMIT_BURST_SECONDS = 0.1
+
+# Shared HTTP connection pool: connections kept per host, and how long an
+# unused host session is kept before it is closed
+HTTP_POOL_MAXSIZE = 16
+HTTP_POOL_IDLE_TIMEOUT = 120.0
+
+# Speed measurement: window of the instantaneous speed (split into buckets)
+# and time constant of the smoothed speed used for ETAs
+SPEED_WINDOW_SECONDS = 1.0
+SPEED_WINDOW_BUCKETS = 10
+SPEED_SMOOTHING_SECONDS = 5.0
+
+# Event stream (/ws): how often changes are published, and how long a send to
+# a client may take before the client is dropped
+EVENT_PUBLISH_INTERVAL = 0.5
+WS_SEND_TIMEOUT = 10.0
+
+# Header format written for new .odm files. Version 1 is the NUL-padded JSON
+# header (128 KiB), version 2 the compact binary header. Both can be read here,
+# but the Flutter app (PartialDownloadHeader) only reads 128 KiB version 1
+# headers, so version 2 stays opt-in until it does.
+HEADER_VERSION = 1
+HEADER_SIZE_V2 = 16 * 1024
+
+# Payload writer: bytes buffered in memory before hitting the disk, and how
+# often the header is checkpointed (whichever threshold is reached first)
+WRITE_BUFFER_SIZE = 1024 * 1024
+CHECKPOINT_INTERVAL_BYTES = 8 * 1024 * 1024
+CHECKPOINT_INTERVAL_SECONDS = 2.0
+
+# Disk writer pool shared by all downloads: number of writer threads, payload
+# bytes a download may have queued before its reads wait for the disk, and the
+# largest vectored write adjacent buffers are merged into
+DISK_WRITER_THREADS = 2
+DISK_QUEUE_MAX_BYTES = 16 * 1024 * 1024
+DISK_WRITE_MAX_BYTES = 8 * 1024 * 1024
+
+# Reserve disk space for the whole payload when a download is created and its
+# size is known (used when the caller doesn't say whether to preallocate)
+PREALLOCATE_DOWNLOADS = True
+
+# Segmented downloads: number of parallel connections per download, and the
+# smallest range worth giving its own connection
+SEGMENT_COUNT = 4
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+
 # def create_default_structure() -> None:
 #     os.makedirs(DEFAULT_DOWNLOAD_DIR, exist_ok=True)
 #     if not os.path.exists(CONFIG_FILE):
@@ -16,3 +86,73 @@ VERSION = "0.1.0"
 #
 # def get_default_download_dir() -> str:
 #     return DEFAULT_DOWNLOAD_DIR
+
+# Persistent index of every download (SQLite in WAL mode), kept next to the
+# app settings. It is rebuilt from the .odm files if it is missing or stale
+INDEX_DB_FILE = CONFIG_FILE.parent / "downloads.db"
+
+# Daemon startup: the port should be bound within STARTUP_TIME_BUDGET_SECONDS,
+# everything heavy happens afterwards in the background. Downloads that were
+# running when the daemon stopped are resumed one every RESTORE_STAGGER_SECONDS
+STARTUP_TIME_BUDGET_SECONDS = 1.0
+RESTORE_STAGGER_SECONDS = 0.5
+
+# Checksums computed while downloading. Algorithms of expected digests (given
+# by the user or sent by the server) are added per download. Only the CRC32
+# state can be kept in the header; for hashlib algorithms a restarted daemon
+# reads the already downloaded payload once more to rebuild their state
+CHECKSUM_ALGORITHMS = ("crc32",)
+
+# Receive loop: bytes asked for per read, within these bounds. The size adapts
+# to the measured throughput so that one read takes about READ_TARGET_SECONDS,
+# re-evaluated every READ_ADJUST_INTERVAL seconds, and is halved right away
+# when a single read stalls for longer than READ_STALL_SECONDS
+READ_SIZE_MIN = 16 * 1024
+READ_SIZE_MAX = 4 * 1024 * 1024
+READ_SIZE_INITIAL = 64 * 1024
+READ_TARGET_SECONDS = 0.02
+READ_ADJUST_INTERVAL = 0.25
+READ_STALL_SECONDS = 0.5
+
+# Metrics served at /metrics (Prometheus text format). When disabled the hot
+# paths call no-op functions instead of updating counters and histograms
+METRICS_ENABLED = True
+
+# Download admission: new downloads are probed (HEAD request, bounded by
+# HEAD_TIMEOUT_SECONDS) and their .odm files created on ADMISSION_WORKERS
+# background threads. Requests beyond ADMISSION_MAX_PENDING waiting are refused
+ADMISSION_WORKERS = 4
+ADMISSION_MAX_PENDING = 256
+# Seconds a finished admission stays listed (GET /download/{id} and the status
+# view) so that clients see how it ended, before only the download remains
+ADMISSION_RETENTION_SECONDS = 30.0
+HEAD_TIMEOUT_SECONDS = 10.0
+
+# Automatic retries of failed transfers. Each class of error has its own rule:
+# (attempts, first delay, longest delay) in seconds. Attempts count consecutive
+# failures that received nothing, the delay doubles with each of them and is
+# jittered. A longer Retry-After sent by the server is honoured, up to
+# RETRY_AFTER_MAX_SECONDS. Other errors (404, disk full...) aren't retried
+RETRY_RULES = {
+    "connection": (20, 2.0, 300.0),
+    "timeout": (20, 2.0, 300.0),
+    "rate_limited": (10, 10.0, 900.0),
+    "server_error": (10, 5.0, 600.0),
+}
+RETRY_AFTER_MAX_SECONDS = 3600.0
+
+# Per-host circuit breaker: after CIRCUIT_FAILURE_THRESHOLD consecutive failed
+# transfers from a host, its retries wait CIRCUIT_RESET_SECONDS, then a single
+# one probes whether the host is back before the others follow
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 60.0
+
+# Mirrors: a download may list other URLs serving the same file, which must
+# match its size and validators when it is created (at most MAX_MIRRORS).
+# Segments are split across them in proportion to the throughput per
+# connection measured for each mirror, remembered in the download index
+# (smoothed by MIRROR_STATS_SMOOTHING). A mirror that fails or sends nothing
+# for MIRROR_STALL_SECONDS has its segments moved to the fastest other one
+MAX_MIRRORS = 16
+MIRROR_STALL_SECONDS = 10.0
+MIRROR_STATS_SMOOTHING = 0.3
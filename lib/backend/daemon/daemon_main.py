@@ -1,16 +1,87 @@
-import subprocess
 import argparse
 import asyncio
+import json
+import sys
+import time
+import zlib
+from contextlib import asynccontextmanager
+from pathlib import Path
+from threading import Event
 
-from fastapi import FastAPI, BackgroundTasks, WebSocket, WebSocketDisconnect
+_started = time.perf_counter()
+startup_timings: dict[str, float] = {}  # Seconds spent in each startup phase
+
+
+def _record_timing(phase: str, since: float):
+    startup_timings[phase] = round(time.perf_counter() - since, 4)
+
+
+# The daemon modules import each other by plain name, also when this module is imported as a package
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fastapi import FastAPI, BackgroundTasks, WebSocket, WebSocketDisconnect, Request, Response, HTTPException, Query
 from pydantic import BaseModel
-from lib.backend.daemon.download_manager import DownloadManager
+from config import DOWNLOAD_ENGINE, STARTUP_TIME_BUDGET_SECONDS, METRICS_ENABLED
+from admission import AdmissionQueueFullError
+import metrics
+
+_record_timing("imports", _started)
+
+# Created in the background once the port is bound, see start_background_services
+manager = None
+status_view = None  # Cached status of every download, shared by /status and the event stream
+event_hub = None  # Pushes download status changes to WebSocket clients
+_services_ready = Event()
+_startup_task = None
+
+
+def create_services(index_db_file=None):
+    """
+    Creates the download manager and the status services. This loads the heavy modules, so it's slow.
+    :param index_db_file: Download index to use instead of INDEX_DB_FILE
+    """
+    global manager, status_view, event_hub
+    started = time.perf_counter()
+    if DOWNLOAD_ENGINE == "asyncio":
+        from async_engine import AsyncDownloadManager as ManagerClass
+    else:
+        from download_manager import DownloadManager as ManagerClass
+    from download_index import DownloadIndex
+    download_manager = ManagerClass(index=DownloadIndex(index_db_file) if index_db_file is not None else None)
+    from disk_writer import get_shared_writer_pool
+    from events import EventHub
+    from status_view import StatusView
+
+    status_view = StatusView(download_manager)
+    event_hub = EventHub(status_view)
+    metrics.DOWNLOADS.labels("active").set_function(lambda: download_manager.scheduler.active_count)
+    metrics.DOWNLOADS.labels("queued").set_function(lambda: download_manager.scheduler.queued_count)
+    metrics.DOWNLOADS.labels("retrying").set_function(lambda: download_manager.retrying_count)
+    metrics.OPEN_CIRCUITS.set_function(lambda: download_manager.circuit_breaker.open_count)
+    metrics.ADMISSIONS_PENDING.set_function(lambda: download_manager.admissions.pending_count)
+    metrics.DISK_QUEUE_BYTES.set_function(lambda: get_shared_writer_pool().queued_bytes)
+    metrics.DISK_QUEUES_BUSY.set_function(lambda: get_shared_writer_pool().queue_count)
+    manager = download_manager
+    _record_timing("create_services", started)
+
+
+def get_manager():
+    """Returns the download manager, waiting for the background startup to create it"""
+    _services_ready.wait()
+    if manager is None:
+        raise HTTPException(status_code=503, detail="The download manager failed to start")
+    return manager
+
 
-app = FastAPI(title="Open Download Manager Daemon")
-manager = DownloadManager()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts the services in the background once serving, stops the transfers on shutdown"""
+    start_background_services()
+    yield
+    await stop_background_services()
 
-# Store active WebSocket connections
-active_connections: list[WebSocket] = []
+
+app = FastAPI(title="Open Download Manager Daemon", lifespan=lifespan)
 
 
 class DownloadRequest(BaseModel):
@@ -18,6 +89,54 @@ class DownloadRequest(BaseModel):
     destination: str
 
 
+def start_background_services():
+    """
+    Lets the server bind its port right away: the download manager is created, and the
+    unfinished downloads recorded in the download index are restored, in the background
+    """
+    global _startup_task
+    _record_timing("serving", _started)
+    if startup_timings["serving"] > STARTUP_TIME_BUDGET_SECONDS:
+        print(f"[WARN] Daemon took {startup_timings['serving']:.2f}s to start serving, "
+              f"over the {STARTUP_TIME_BUDGET_SECONDS}s budget. Run with --startup-report to see why.")
+    _startup_task = asyncio.get_running_loop().create_task(_start_services())
+
+
+async def _start_services():
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, create_services)
+        # Lets an event-loop based download engine run on the daemon's loop
+        if hasattr(manager, "attach_loop"):
+            manager.attach_loop(loop)
+        event_hub.start()
+    except Exception as e:
+        print(f"[ERROR] Failed to start the download manager: {e!r}")
+        return
+    finally:
+        _services_ready.set()
+    _record_timing("ready", _started)
+
+    started = time.perf_counter()
+    await loop.run_in_executor(None, manager.restore_downloads)
+    _record_timing("restore_downloads", started)
+
+
+async def stop_background_services():
+    """Stops the transfers so that every .odm file is checkpointed, see DownloadManager.close"""
+    if not _services_ready.is_set() or manager is None:
+        # Still being created, there's nothing running yet
+        return
+    event_hub.stop()
+    try:
+        if hasattr(manager, "attach_loop"):
+            await manager.close()
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, manager.close)
+    except Exception as e:
+        print(f"[ERROR] Failed to stop the download manager: {e!r}")
+
+
 @app.get("/")
 def root():
     return {"message": "ODM Daemon is running"}
@@ -25,55 +144,165 @@ def root():
 
 @app.get("/health")
 def health_check():
-    """Health check endpoint for server status verification"""
-    return {"status": "ok", "service": "open_download_manager"}
+    """Health check endpoint for server status verification. Answers before the download manager is ready."""
+    return {"status": "ok", "service": "open_download_manager", "ready": _services_ready.is_set(),
+            "startup_timings": startup_timings}
 
 
-@app.post("/download")
+@app.post("/download", status_code=202)
 def start_download(url: str, download_filename: str = None, website: str = None, download_dir: str = None,
-                   file_size: int = None, preallocated: bool = None, odm_filepath: str = None):
-    manager.download_file(url, download_filename=download_filename, website=website, download_dir=download_dir,
-                          file_size=file_size, preallocated=preallocated, odm_filepath=odm_filepath)
-    return {"status": "started", }
+                   file_size: int = None, preallocated: bool = None, odm_filepath: str = None, checksum: str = None,
+                   mirror: list[str] = Query(None)):
+    """
+    Accepts a download and answers right away, before the URL is probed and the .odm file created.
+    The returned id appears in /status and the event stream with state "admitting", then "admitted"
+    along with the download_id of the created download, or "error".
+    `checksum` ("sha256:<hex digest>", md5, crc32...) is verified when the download completes.
+    Each `mirror` (repeat the parameter for several) is another URL of the same file to download from.
+    """
+    try:
+        admission = get_manager().admit_download(url, download_filename=download_filename, website=website,
+                                                 download_dir=download_dir, file_size=file_size,
+                                                 preallocated=preallocated, odm_filepath=odm_filepath,
+                                                 checksum=checksum, mirrors=mirror)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except AdmissionQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    return {"status": "accepted", "id": admission.id}
+
+
+@app.get("/download/{admission_id}")
+def get_admission(admission_id: str):
+    """
+    State of a download accepted by POST /download. Once it is created or has failed it stays
+    available for ADMISSION_RETENTION_SECONDS, then only the download itself is listed.
+    """
+    admission = get_manager().admissions.get(admission_id)
+    if admission is None:
+        raise HTTPException(status_code=404, detail="Unknown download id")
+    return {"id": admission.id, **admission.get_raw_status()}
 
 
 @app.get("/status")
-def get_status():
-    return manager.get_status()
+def get_status(request: Request, response: Response, state: str = None, host: str = None, since: int = None,
+               offset: int = 0, limit: int = None):
+    """
+    Status of the downloads, served from a cache that is only updated for downloads that changed.
+    Filter with state (downloading, queued, retrying, paused, error or completed) and host, page with offset and limit.
+    With since=<version>, only downloads changed after that version are returned, holding only the changed fields.
+    The ETag is the status version and the query, so a client sending If-None-Match gets 304 while
+    nothing changed for the same query.
+    """
+    get_manager()
+    query = (state, host, since, offset, limit)
+    etag = _get_status_etag(status_view.refresh(), query)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    result = status_view.query(state=state, host=host, since=since, offset=offset, limit=limit)
+    response.headers["ETag"] = _get_status_etag(result["version"], query)
+    return result
+
+
+def _get_status_etag(version: int, query: tuple) -> str:
+    """ETag of a /status answer: the view version and a digest of the normalized query parameters"""
+    normalized = json.dumps(query, separators=(",", ":"))
+    return f'W/"{version}-{zlib.crc32(normalized.encode()):08x}"'
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Daemon metrics in the Prometheus text format. Not served when METRICS_ENABLED is off."""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(content=metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/downloads")
+def list_downloads(state: str = None, host: str = None):
+    """Every download in the persistent index, including finished ones that aren't loaded"""
+    return get_manager().list_downloads(state=state, host=host)
+
+
+@app.get("/http_pool")
+def get_http_pool_stats():
+    """Session and connection reuse counters of the shared HTTP pool"""
+    return get_manager().session_pool.get_stats()
+
+
+@app.post("/speed_limit")
+def set_speed_limit(limit: int = None, odm_filepath: str = None):
+    """
+    Changes a download speed limit (bytes per second) without restarting transfers.
+    Applies to all downloads together, or to one download if odm_filepath is given. Omit limit to remove it.
+    """
+    download_manager = get_manager()
+    if odm_filepath is not None and download_manager.get_download(odm_filepath) is None:
+        raise HTTPException(status_code=404, detail="Unknown download")
+    download_manager.set_speed_limit(limit, odm_file_path=odm_filepath)
+    return {"status": "ok", "limit": limit, "odm_filepath": odm_filepath}
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time communication with clients"""
+    """
+    Event stream for clients. On connect the client receives a snapshot of all downloads
+    ({"type": "snapshot", "version": n, "downloads": {id: status}}), then throttled updates
+    holding only the fields that changed ({"type": "update", "version": n, "downloads": {id: fields}}),
+    or null for a download that was removed. Versions are the same as the ones of /status.
+    """
     await websocket.accept()
-    active_connections.append(websocket)
-    print(f"WebSocket client connected. Total connections: {len(active_connections)}")
-    
-    try:
-        while True:
-            # Receive messages from client
-            data = await websocket.receive_text()
-            print(f"Received from client: {data}")
-            
-            # Echo back to client (you can customize this)
-            await websocket.send_text(f"Server received: {data}")
-            
-    except WebSocketDisconnect:
-        active_connections.remove(websocket)
-        print(f"WebSocket client disconnected. Total connections: {len(active_connections)}")
-    except Exception as e:
-        print(f"WebSocket error: {e}")
-        if websocket in active_connections:
-            active_connections.remove(websocket)
+    if not _services_ready.is_set():
+        await asyncio.get_running_loop().run_in_executor(None, _services_ready.wait)
+    if event_hub is None:
+        await websocket.close(code=1011)
+        return
+    await event_hub.serve(websocket)
 
 
 async def broadcast_message(message: str):
     """Send a message to all connected WebSocket clients"""
-    for connection in active_connections:
-        try:
-            await connection.send_text(message)
-        except Exception as e:
-            print(f"Error broadcasting to client: {e}")
+    if event_hub is not None:
+        await event_hub.broadcast(message)
+
+
+def print_startup_report(top: int = 20):
+    """
+    Imports the daemon and creates its services in a fresh interpreter run with
+    `-X importtime`, then prints the startup phases and the slowest imports.
+    """
+    import subprocess
+
+    # A throwaway index, so that the report neither reads nor updates the daemon's one
+    code = ("import json, tempfile, daemon_main\n"
+            "with tempfile.TemporaryDirectory() as app_data:\n"
+            "    daemon_main.create_services(index_db_file=app_data + '/downloads.db')\n"
+            "    daemon_main.manager.index.close()\n"
+            "print(json.dumps(daemon_main.startup_timings))")
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=Path(__file__).resolve().parent,
+                            capture_output=True, text=True)
+    total = time.perf_counter() - started
+    if result.returncode != 0:
+        print(result.stderr)
+        return
+
+    # Lines look like "import time: <self [us]> | <cumulative [us]> | <imported package>"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative_us), int(self_us), name.rstrip()))
+
+    print(f"Startup phases in seconds (whole interpreter: {total:.3f}, "
+          f"budget until serving: {STARTUP_TIME_BUDGET_SECONDS}):")
+    for phase, seconds in json.loads(result.stdout.strip().splitlines()[-1]).items():
+        print(f"  {phase:<20} {seconds:8.3f}")
+    print(f"\nSlowest imports (cumulative ms, self ms):")
+    for cumulative_us, self_us, name in sorted(imports, reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:8.1f} {self_us / 1000:8.1f}  {name}")
 
 
 if __name__ == "__main__":
@@ -91,15 +320,20 @@ if __name__ == "__main__":
         default=8080,
         help="Port to bind the server to (default: 8080)"
     )
-    
+    parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        help="Print how long each startup phase and import takes, then exit"
+    )
+
     args = parser.parse_args()
-    
-    # Start the uvicorn server with the provided host and port
+
+    if args.startup_report:
+        print_startup_report()
+        sys.exit(0)
+
+    # Serve from this interpreter, which has already imported the app
+    import uvicorn
+
     print(f"Starting server on {args.host}:{args.port}")
-    subprocess.run([
-        "uvicorn",
-        "lib.backend.daemon.daemon_main:app",
-        "--host", args.host,
-        "--port", str(args.port),
-        # "--reload"
-    ])
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,238 @@
+import os
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+from typing import Optional
+
+from config import DISK_WRITER_THREADS, DISK_QUEUE_MAX_BYTES, DISK_WRITE_MAX_BYTES
+from metrics import DISK_BACKPRESSURE_SECONDS, DISK_WRITE_SECONDS
+
+# Most buffers a single vectored write may take
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, OSError, ValueError):
+    IOV_MAX = 1024
+
+
+def pwritev(f, buffers: list, offset: int) -> None:
+    """Writes the `buffers` one after the other at `offset` of the open file `f`, with os.pwritev where available."""
+    if not hasattr(os, "pwritev"):
+        f.seek(offset)
+        for buffer in buffers:
+            f.write(buffer)
+        return
+    buffers = list(buffers)
+    while buffers:
+        written = os.pwritev(f.fileno(), buffers, offset)
+        offset += written
+        # Drop what was written, a short write may end in the middle of a buffer
+        while written:
+            if written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            else:
+                buffers[0] = memoryview(buffers[0])[written:]
+                written = 0
+
+
+class WriteQueue:
+    """
+    Payload buffers of one open file waiting for the threads of a DiskWriterPool.
+
+    The queue holds at most `max_bytes` (counting the batch being written): a
+    reader putting more waits until the pool has caught up, which holds back
+    the reads of that download only. A failed write is kept and raised to the
+    readers by every later put() and drain(), until discard().
+    """
+
+    def __init__(self, pool: "DiskWriterPool", f, max_bytes: int = DISK_QUEUE_MAX_BYTES):
+        self.pool = pool
+        self.file = f
+        self.max_bytes = max_bytes
+        self.queued_bytes = 0
+        self._items: list[tuple[int, bytes]] = []  # (file offset, buffer), in the order they were put
+        self._scheduled = False  # Waiting in the pool or being written by one of its threads
+        self._error: Optional[OSError] = None
+
+        # Statistics, updated by the pool threads
+        self.writes = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self.backpressure_seconds = 0.0
+
+    def put(self, offset: int, data) -> None:
+        """Queues `data` to be written at file `offset`. The queue takes ownership of the buffer."""
+        condition = self.pool.condition
+        with condition:
+            self._raise_error()
+            if self.queued_bytes and self.queued_bytes + len(data) > self.max_bytes:
+                started = time.perf_counter()
+                while self._error is None and self.queued_bytes and self.queued_bytes + len(data) > self.max_bytes:
+                    condition.wait()
+                waited = time.perf_counter() - started
+                self.backpressure_seconds += waited
+                DISK_BACKPRESSURE_SECONDS.observe(waited)
+                self._raise_error()
+            self._items.append((offset, data))
+            self.queued_bytes += len(data)
+            if not self._scheduled:
+                self._scheduled = True
+                self.pool.submit(self)
+
+    def drain(self) -> None:
+        """Waits until everything queued is on disk, raising the error of a failed write."""
+        with self.pool.condition:
+            while self._error is None and self.queued_bytes:
+                self.pool.condition.wait()
+            self._raise_error()
+
+    def discard(self) -> None:
+        """Drops the buffers not written yet and forgets a failed write. Waits for the batch being written."""
+        with self.pool.condition:
+            self.queued_bytes -= sum(len(data) for _, data in self._items)
+            self._items.clear()
+            while self.queued_bytes:
+                self.pool.condition.wait()
+            self._error = None
+
+    @property
+    def failed(self) -> bool:
+        """Whether a write failed since the queue was opened or discarded"""
+        return self._error is not None
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _take(self, max_bytes: int) -> list[tuple[int, bytes]]:
+        """Removes the oldest items, about `max_bytes` of them. Called with the pool condition held."""
+        size = 0
+        count = 0
+        for _, data in self._items:
+            if count and size + len(data) > max_bytes:
+                break
+            size += len(data)
+            count += 1
+        batch = self._items[:count]
+        del self._items[:count]
+        return batch
+
+
+class DiskWriterPool:
+    """
+    Threads writing the payload of all downloads, so that a slow disk delays
+    the network reads only once a download's WriteQueue is full.
+
+    A queue is written by one thread at a time, in batches of at most
+    `write_max_bytes`. The items of a batch are sorted by offset and the
+    adjacent ones (consecutive buffers of a stream) go to the disk in a
+    single vectored write. Queues take turns, so one download writing a lot
+    doesn't hold up the others.
+    """
+
+    def __init__(self, threads: int = DISK_WRITER_THREADS, write_max_bytes: int = DISK_WRITE_MAX_BYTES):
+        self.thread_count = max(1, threads)
+        self.write_max_bytes = write_max_bytes
+        self.condition = Condition()
+        self._ready: deque[WriteQueue] = deque()
+        self._threads: list[Thread] = []
+        self._queues: set[WriteQueue] = set()  # Open queues, for the totals
+
+    def open_queue(self, f, max_bytes: int = DISK_QUEUE_MAX_BYTES) -> WriteQueue:
+        """Returns a new queue for the open file `f`, see close_queue()"""
+        queue = WriteQueue(self, f, max_bytes)
+        with self.condition:
+            self._queues.add(queue)
+        return queue
+
+    def close_queue(self, queue: WriteQueue) -> None:
+        """Drops what `queue` still holds and waits for its last write, after which its file may be closed"""
+        queue.discard()
+        with self.condition:
+            self._queues.discard(queue)
+
+    def submit(self, queue: WriteQueue) -> None:
+        """Hands `queue`, which has items, to the threads. Called with the condition held."""
+        self._ready.append(queue)
+        if len(self._threads) < min(self.thread_count, len(self._ready)):
+            thread = Thread(target=self._run, daemon=True, name=f"odm-disk-writer-{len(self._threads) + 1}")
+            self._threads.append(thread)
+            thread.start()
+        self.condition.notify_all()
+
+    @property
+    def queued_bytes(self) -> int:
+        """Payload bytes waiting for the disk, in all queues"""
+        with self.condition:
+            return sum(queue.queued_bytes for queue in self._queues)
+
+    @property
+    def queue_count(self) -> int:
+        """Number of queues with bytes waiting for the disk"""
+        with self.condition:
+            return sum(1 for queue in self._queues if queue.queued_bytes)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self._ready:
+                    self.condition.wait()
+                queue = self._ready.popleft()
+                batch = queue._take(self.write_max_bytes)
+
+            error = None
+            written = 0
+            seconds = 0.0
+            writes = 0
+            try:
+                for offset, buffers in self._coalesce(batch):
+                    started = time.perf_counter()
+                    pwritev(queue.file, buffers, offset)
+                    elapsed = time.perf_counter() - started
+                    DISK_WRITE_SECONDS.observe(elapsed)
+                    seconds += elapsed
+                    writes += 1
+                    written += sum(len(buffer) for buffer in buffers)
+            except (OSError, ValueError) as e:
+                # ValueError is raised by a file closed under the queue, which close_queue() prevents
+                error = e
+
+            with self.condition:
+                queue.queued_bytes -= sum(len(data) for _, data in batch)
+                queue.writes += writes
+                queue.bytes_written += written
+                queue.write_seconds += seconds
+                if error is not None:
+                    queue._error = error
+                    queue.queued_bytes -= sum(len(data) for _, data in queue._items)
+                    queue._items.clear()
+                if queue._items:
+                    self._ready.append(queue)
+                else:
+                    queue._scheduled = False
+                self.condition.notify_all()
+
+    @staticmethod
+    def _coalesce(batch: list[tuple[int, bytes]]) -> list[tuple[int, list]]:
+        """Groups the items of `batch` into runs of adjacent buffers: [(file offset, buffers)]"""
+        runs = []
+        end = None
+        for offset, data in sorted(batch, key=lambda item: item[0]):
+            if offset == end and len(runs[-1][1]) < IOV_MAX:
+                runs[-1][1].append(data)
+            else:
+                runs.append((offset, [data]))
+            end = offset + len(data)
+        return runs
+
+
+_shared_pool: Optional[DiskWriterPool] = None
+_shared_pool_lock = Lock()
+
+
+def get_shared_writer_pool() -> DiskWriterPool:
+    """Returns the disk writer pool shared by the whole daemon."""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = DiskWriterPool()
+        return _shared_pool
@@ -0,0 +1,234 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, Optional
+from urllib.parse import urlparse
+
+from config import INDEX_DB_FILE
+from odm_file import ODMFile
+
+
+class DownloadIndex:
+    """
+    Persistent index of every known download, stored in SQLite (WAL mode).
+
+    One row per .odm file holds the key header fields, the download state and
+    the file's modification time when the row was written. Rows are updated in
+    their own transaction right after each header checkpoint, so listing and
+    restoring downloads are indexed queries instead of loading every .odm file.
+    A row whose file changed since it was written is reloaded from the file; the
+    whole index is rebuilt only when the database is missing or its schema is
+    outdated.
+
+    The index also keeps the throughput measured for each mirror origin (see
+    MirrorStats), which only guides how new segments are split.
+    """
+
+    SCHEMA_VERSION = 2
+    COLUMNS = ("path", "url", "host", "download_filename", "download_dir", "website", "file_size",
+               "downloaded_bytes", "completed", "supports_resume", "state", "error", "created_at",
+               "last_attempt", "odm_mtime_ns")
+
+    def __init__(self, db_path=INDEX_DB_FILE):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        existed = self.db_path.exists()
+
+        self._lock = Lock()
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode a commit is still atomic with NORMAL, only the last transactions may be lost on power failure
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+
+        schema_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        # Set when the rows can't be trusted and rebuild() should be called
+        self.needs_rebuild = not existed or schema_version != self.SCHEMA_VERSION
+        if schema_version != self.SCHEMA_VERSION:
+            self._create_schema()
+
+    def _create_schema(self):
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute("DROP TABLE IF EXISTS downloads")
+            self._connection.execute("""
+                CREATE TABLE downloads (
+                    path TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    host TEXT NOT NULL,
+                    download_filename TEXT,
+                    download_dir TEXT,
+                    website TEXT,
+                    file_size INTEGER,
+                    downloaded_bytes INTEGER NOT NULL,
+                    completed INTEGER NOT NULL,
+                    supports_resume INTEGER,
+                    state TEXT NOT NULL,
+                    error TEXT,
+                    created_at TEXT,
+                    last_attempt TEXT,
+                    odm_mtime_ns INTEGER
+                )
+            """)
+            self._connection.execute("CREATE INDEX downloads_state ON downloads (state)")
+            self._connection.execute("CREATE INDEX downloads_host ON downloads (host)")
+            self._connection.execute("DROP TABLE IF EXISTS mirrors")
+            self._connection.execute("""
+                CREATE TABLE mirrors (
+                    origin TEXT PRIMARY KEY,
+                    throughput REAL,
+                    failures INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    @staticmethod
+    def _get_row(odm_file: ODMFile, state: str, error: Optional[str]) -> tuple:
+        header = odm_file.header
+        try:
+            mtime = os.stat(odm_file.odm_filepath).st_mtime_ns
+        except OSError:
+            mtime = None
+        return (
+            str(Path(odm_file.odm_filepath)), header.url, urlparse(header.url).hostname or "",
+            header.download_filename, header.download_dir, header.website, header.file_size,
+            header.downloaded_bytes, int(bool(header.completed)),
+            None if header.supports_resume is None else int(header.supports_resume),
+            state, error, header.created_at, header.last_attempt, mtime,
+        )
+
+    def _upsert(self, rows: Iterable[tuple]):
+        placeholders = ", ".join("?" * len(self.COLUMNS))
+        updates = ", ".join(f"{column} = excluded.{column}" for column in self.COLUMNS[1:])
+        self._connection.executemany(
+            f"INSERT INTO downloads ({', '.join(self.COLUMNS)}) VALUES ({placeholders}) "
+            f"ON CONFLICT (path) DO UPDATE SET {updates}",
+            rows
+        )
+
+    def record(self, odm_file: ODMFile, state: str, error: Optional[str] = None):
+        """Inserts or updates the row of `odm_file` from its current header, in one transaction."""
+        row = self._get_row(odm_file, state, error)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._upsert([row])
+
+    def remove(self, odm_filepath):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM downloads WHERE path = ?", (str(Path(odm_filepath)),))
+
+    def get(self, odm_filepath) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM downloads WHERE path = ?",
+                                           (str(Path(odm_filepath)),)).fetchone()
+        return dict(row) if row is not None else None
+
+    def list(self, state: str = None, host: str = None) -> list[dict]:
+        """Returns the indexed downloads, optionally only those in `state` and/or from `host`, oldest first."""
+        conditions, parameters = [], []
+        if state is not None:
+            conditions.append("state = ?")
+            parameters.append(state)
+        if host is not None:
+            conditions.append("host = ?")
+            parameters.append(host)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._connection.execute(f"SELECT * FROM downloads {where} ORDER BY rowid", parameters).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_mirror_stats(self, origin: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM mirrors WHERE origin = ?", (origin,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record_mirror_stats(self, rows: Iterable[tuple]):
+        """Inserts or updates (origin, throughput, failures) rows of mirror stats, in one transaction."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                "INSERT INTO mirrors (origin, throughput, failures, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (origin) DO UPDATE SET throughput = excluded.throughput, "
+                "failures = excluded.failures, updated_at = excluded.updated_at",
+                [(*row, now) for row in rows]
+            )
+
+    def validate(self) -> int:
+        """
+        Checks every row against its .odm file. Rows of deleted files are dropped and rows
+        whose header fields differ from the file header are reloaded from it. A file only
+        modified by payload writes after its last checkpoint (a transfer that was killed) has
+        the header of its row, so only its recorded mtime is refreshed.
+        :return: Number of rows dropped or reloaded
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM downloads").fetchall()
+
+        removed, reloaded, touched = [], [], []
+        for row in rows:
+            try:
+                mtime = os.stat(row["path"]).st_mtime_ns
+            except FileNotFoundError:
+                removed.append((row["path"],))
+                continue
+            if mtime == row["odm_mtime_ns"]:
+                continue
+            try:
+                odm_file = ODMFile.load(row["path"])
+            except Exception as e:
+                print(f"[WARN] Dropping unreadable ODM file '{row['path']}' from the index: {e}")
+                removed.append((row["path"],))
+                continue
+            state = "completed" if odm_file.header.completed else row["state"]
+            new_row = self._get_row(odm_file, state, row["error"])
+            if new_row[:-1] == tuple(row[column] for column in self.COLUMNS[:-1]):
+                touched.append((new_row[-1], row["path"]))
+            else:
+                reloaded.append(new_row)
+
+        if removed or reloaded or touched:
+            with self._lock, self._connection:
+                self._connection.execute("BEGIN")
+                self._connection.executemany("DELETE FROM downloads WHERE path = ?", removed)
+                self._upsert(reloaded)
+                self._connection.executemany("UPDATE downloads SET odm_mtime_ns = ? WHERE path = ?", touched)
+        return len(removed) + len(reloaded)
+
+    def rebuild(self, directories: Iterable) -> int:
+        """
+        Replaces the whole index with the .odm files found in `directories`.
+        :return: Number of downloads indexed
+        """
+        rows = []
+        seen = set()
+        for directory in directories:
+            directory = Path(directory).expanduser()
+            if not directory.is_dir():
+                continue
+            for odm_filepath in directory.rglob("*.odm"):
+                odm_filepath = odm_filepath.resolve()
+                if odm_filepath in seen:
+                    continue
+                seen.add(odm_filepath)
+                try:
+                    odm_file = ODMFile.load(str(odm_filepath))
+                except Exception as e:
+                    print(f"[WARN] Skipping unreadable ODM file '{odm_filepath}': {e}")
+                    continue
+                rows.append(self._get_row(odm_file, "completed" if odm_file.header.completed else "paused", None))
+
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute("DELETE FROM downloads")
+            self._upsert(rows)
+        self.needs_rebuild = False
+        print(f"[INFO] Rebuilt download index with {len(rows)} downloads")
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,9 +1,27 @@
+import errno
+import re
+import sqlite3
+import time
 from pathlib import Path
-from threading import Thread
+from threading import Thread, Event
 from typing import Optional
 
 import requests
-from odm_file import ODMFile
+from urllib3.exceptions import ProtocolError, ReadTimeoutError, DecodeError
+from config import (SEGMENT_COUNT, MIN_SEGMENT_SIZE, MAX_SIMULTANEOUS_DOWNLOADS, DEFAULT_DOWNLOAD_DIR,
+                    RESTORE_STAGGER_SECONDS, DATETIME_FORMAT, MAX_MIRRORS, load_app_config)
+from admission import Admission, AdmissionPool
+from checksum import ChecksumMismatchError, parse_checksum, parse_digest_headers
+from download_index import DownloadIndex
+from http_pool import SessionPool, get_shared_pool
+from metrics import BYTES_RECEIVED, HTTP_ERRORS, RETRIES
+from mirrors import Mirror, MirrorSet, MirrorStats
+from odm_file import ODMFile, PayloadWriter, Segment
+from rate_limiter import RateLimiter
+from read_sizer import ReadSizer, ReceiveBuffer
+from retry import (CONNECTION, TIMEOUT, CircuitBreaker, RetryPolicy, RetryTimer, classify_http_status,
+                   parse_retry_after)
+from scheduler import DownloadScheduler, PRIORITY_NORMAL
 
 
 # from lib.scripts.cli.core.odm_file import ODMFile
@@ -11,21 +29,260 @@ from odm_file import ODMFile
 
 class DownloadManager:
 
-    def __init__(self):
+    def __init__(self, max_simultaneous_downloads: int = None, index: DownloadIndex = None):
         self.active_downloads: dict["Path", "Download"] = {}
+        app_config = load_app_config()
+        self.download_dirs = [Path(DEFAULT_DOWNLOAD_DIR)]
+        if app_config.get("downloadDir"):
+            self.download_dirs.append(Path(app_config["downloadDir"]).expanduser())
+        if max_simultaneous_downloads is None:
+            max_simultaneous_downloads = app_config.get("maxSimultaneousDownloads") or MAX_SIMULTANEOUS_DOWNLOADS
+        self.scheduler = DownloadScheduler(max_active=max_simultaneous_downloads)
+        self.rate_limiter = RateLimiter(global_rate=app_config.get("downloadSpeedLimit"))
+        self.session_pool = get_shared_pool()
+        self._listeners = []
+        self.admissions = AdmissionPool(self.download_file, on_change=self._notify_changed)
+        self.retry_policy = RetryPolicy()
+        self.circuit_breaker = CircuitBreaker()
+        self._retry_timer = RetryTimer(self._retry_download)
+        self._closed = False
 
-    def add_download(self, odm_file_path, start=True):
+        self.index = index if index is not None else DownloadIndex()
+        if self.index.needs_rebuild:
+            self.index.rebuild(self.download_dirs)
+        else:
+            self.index.validate()
+        self.mirror_stats = MirrorStats(self.index)
+
+    def close(self):
+        """
+        Stops every transfer for the daemon's shutdown, so that each .odm file is checkpointed
+        and closed. The index keeps the state every download had (downloading, queued,
+        retrying...), so restore_downloads resumes them on the next start. Nothing starts afterwards.
+        """
+        states = self._stop_scheduling()
+        for download in states:
+            download.pause()
+        self._finish_close(states)
+
+    def _stop_scheduling(self) -> dict["Download", str]:
+        """Lets no download start any more and returns the state of each one"""
+        self._closed = True
+        self.scheduler.max_active = 0
+        return {download: self.get_download_state(download) for download in list(self.active_downloads.values())}
+
+    def _finish_close(self, states: dict["Download", str]):
+        for download, state in states.items():
+            try:
+                self.index.record(download._odm_object, state, download.error_message)
+            except sqlite3.Error as e:
+                print(f"[WARN] Could not update the download index for '{download.odm_file_path}': {e}")
+        self.index.close()
+
+    def add_download(self, odm_file_path, start=True, priority: int = None) -> "Download":
+        """
+        Adds a download to the manager. If `start` is set it is queued, and the
+        scheduler starts it as soon as the concurrency limits allow.
+        """
         resolved_path = Path(odm_file_path).resolve()
         if resolved_path not in self.active_downloads.keys():
-            download_object = Download(str(resolved_path),
-                                       # on_progress=lambda prog: print(self.get_status())
-                                       )
+            download_object = self._create_download(str(resolved_path))
+            download_object.on_progress = lambda downloaded, download=download_object: self._notify_changed(download)
             self.active_downloads[resolved_path] = download_object
+            self._notify_changed(download_object)
         else:
             download_object = self.active_downloads[resolved_path]
 
         if start:
-            download_object.resume()
+            self.scheduler.enqueue(download_object, priority)
+        elif priority is not None:
+            self.scheduler.set_priority(download_object, priority)
+        self._update_index(download_object)
+        return download_object
+
+    def restore_downloads(self, stagger_interval: float = RESTORE_STAGGER_SECONDS):
+        """
+        Adds the unfinished downloads recorded in the index, without reading any other .odm file.
+        Downloads that were running, queued or waiting to be retried when the daemon stopped are queued again, one every
+        `stagger_interval` seconds so that they don't all open connections and files at once.
+        Blocks until every download is restored, so it's meant to run in the background.
+        """
+        to_resume = []
+        for entry in self.index.list():
+            if entry["completed"] or Path(entry["path"]) in self.active_downloads:
+                continue
+            if entry["state"] in ("downloading", "queued", "retrying"):
+                # Added when resumed, so the index keeps their state until then
+                to_resume.append(entry["path"])
+                continue
+            self._restore_download(entry["path"], start=False)
+
+        for i, odm_file_path in enumerate(to_resume):
+            if i and stagger_interval > 0:
+                time.sleep(stagger_interval)
+            if self._closed:
+                return
+            self._restore_download(odm_file_path, start=True)
+
+    def _restore_download(self, odm_file_path: str, start: bool):
+        try:
+            self.add_download(odm_file_path, start=start)
+        except Exception as e:
+            print(f"[WARN] Could not restore download '{odm_file_path}': {e}")
+
+    def _create_download(self, odm_file_path: str) -> "Download":
+        return Download(odm_file_path,
+                        # on_progress=lambda prog: print(self.get_status())
+                        on_finish=self._on_download_finished,
+                        on_checkpoint=self._update_index,
+                        rate_limiter=self.rate_limiter,
+                        session_pool=self.session_pool,
+                        mirror_stats=self.mirror_stats,
+                        )
+
+    def _on_download_finished(self, download: "Download"):
+        if self._closed:
+            # Stopped by close, which records the state the download had
+            return
+        self.scheduler.on_download_stopped(download)
+        self._schedule_retry(download)
+        if download.header.completed or (download.error_message is not None and download.next_retry_at is None):
+            # Done with for good, a speed limit of its own doesn't outlive it
+            self.rate_limiter.remove(download)
+        self._notify_changed(download)
+        self._update_index(download)
+
+    def _schedule_retry(self, download: "Download"):
+        """
+        Queues a download whose transfer failed again after a backoff delay, if the
+        retry policy allows it. A transfer that received something resets the count of
+        consecutive failures and closes the circuit of its host, one that didn't counts
+        against both. The retry resumes from the last checkpoint like any other resume.
+        """
+        host = self.scheduler.get_host(download)
+        if download.made_progress or download.header.completed:
+            self.circuit_breaker.record_success(host)
+            download.retry_attempt = 0
+        if download.retry_class is None or download.error_message is None:
+            return
+        if not download.made_progress:
+            self.circuit_breaker.record_failure(host)
+
+        download.retry_attempt += 1
+        delay = self.retry_policy.get_delay(download.retry_class, download.retry_attempt, download.retry_after)
+        if delay is None:
+            print(f"[WARN] Giving up on '{download.header.download_filename}' after "
+                  f"{download.retry_attempt - 1} retries: {download.error_message}")
+            return
+        delay = max(delay, self.circuit_breaker.get_wait(host))
+        download.next_retry_at = time.time() + delay
+        print(f"[INFO] Retrying '{download.header.download_filename}' in {delay:.1f}s "
+              f"(attempt {download.retry_attempt}): {download.error_message}")
+        self._retry_timer.schedule(download, delay)
+
+    def _retry_download(self, download: "Download"):
+        """Queues a download whose retry is due, unless the circuit of its host holds it back"""
+        if download.next_retry_at is None or self._closed:
+            # Paused or resumed in the meantime
+            return
+        wait = self.circuit_breaker.acquire(self.scheduler.get_host(download))
+        if wait > 0:
+            download.next_retry_at = time.time() + wait
+            self._retry_timer.schedule(download, wait)
+            self._notify_changed(download)
+            return
+        download.next_retry_at = None
+        download.retry_count += 1
+        self.scheduler.enqueue(download)
+
+    def _cancel_retry(self, download: "Download"):
+        if self._retry_timer.cancel(download) or download.next_retry_at is not None:
+            download.next_retry_at = None
+            self._notify_changed(download)
+
+    @property
+    def retrying_count(self) -> int:
+        """Number of downloads waiting for an automatic retry"""
+        return len(self._retry_timer)
+
+    def _update_index(self, download: "Download"):
+        """Records the current header and state of `download` in the index"""
+        try:
+            self.index.record(download._odm_object, self.get_download_state(download), download.error_message)
+        except sqlite3.Error as e:
+            # The .odm file stays the source of truth, a lagging row is fixed when the index is validated
+            print(f"[WARN] Could not update the download index for '{download.odm_file_path}': {e}")
+
+    def list_downloads(self, state: str = None, host: str = None) -> list[dict]:
+        """Every download known to the index, including ones not loaded, optionally filtered"""
+        return self.index.list(state=state, host=host)
+
+    def add_listener(self, callback):
+        """
+        Registers `callback(download)`, called whenever a download makes progress or changes state.
+        While a new download is being created it is called with its Admission instead.
+        It runs on the download's thread, so it must be cheap and thread-safe.
+        """
+        self._listeners.append(callback)
+
+    def _notify_changed(self, download: "Download"):
+        for listener in self._listeners:
+            listener(download)
+
+    def resume_download(self, odm_file_path, priority: int = None):
+        """Queues a paused download again. A download waiting to be retried is queued right away."""
+        download_object = self.active_downloads.get(Path(odm_file_path).resolve())
+        if download_object is not None:
+            self._cancel_retry(download_object)
+            download_object.retry_attempt = 0
+        self.add_download(odm_file_path, start=True, priority=priority)
+
+    def pause_download(self, odm_file_path):
+        """Pauses a running download, or takes it out of the queue if it hasn't started yet"""
+        download_object = self.active_downloads[Path(odm_file_path).resolve()]
+        self.scheduler.remove(download_object)
+        self._cancel_retry(download_object)
+        download_object.pause()
+        self._update_index(download_object)
+
+    def remove_download(self, odm_file_path):
+        """
+        Stops a download and forgets it: it leaves the queue, the index and the status view.
+        Its .odm file and any extracted payload stay on disk.
+        """
+        download_object = self.active_downloads.get(Path(odm_file_path).resolve())
+        if download_object is None:
+            raise KeyError(f"Unknown download '{odm_file_path}'")
+        self.scheduler.remove(download_object)
+        self._cancel_retry(download_object)
+        download_object.pause()
+        del self.active_downloads[Path(odm_file_path).resolve()]
+        self.rate_limiter.remove(download_object)
+        try:
+            self.index.remove(download_object.odm_file_path)
+        except sqlite3.Error as e:
+            print(f"[WARN] Could not remove '{download_object.odm_file_path}' from the download index: {e}")
+        self._notify_changed(download_object)
+
+    def get_download(self, odm_file_path) -> Optional["Download"]:
+        """The download of `odm_file_path`, None if the manager doesn't have it"""
+        return self.active_downloads.get(Path(odm_file_path).resolve())
+
+    def set_priority(self, odm_file_path, priority: int):
+        self.scheduler.set_priority(self.active_downloads[Path(odm_file_path).resolve()], priority)
+
+    def set_speed_limit(self, limit: Optional[int], odm_file_path=None):
+        """
+        Changes a speed limit in bytes per second while downloads keep running.
+        Applies to all downloads together, or only to `odm_file_path` if given. None removes the limit.
+        """
+        if odm_file_path is None:
+            self.rate_limiter.set_global_rate(limit)
+            return
+        download_object = self.get_download(odm_file_path)
+        if download_object is None:
+            raise KeyError(f"Unknown download '{odm_file_path}'")
+        self.rate_limiter.set_rate(download_object, limit)
 
     def download_file(
             self,
@@ -34,10 +291,19 @@ class DownloadManager:
             website: str = None,
             download_dir: str = None,
             file_size: int = None,
-            preallocated: bool = False,
+            preallocated: bool = None,
             odm_filepath: str = None,
-    ):
-        """Creates a download file and adds it to the active downloads"""
+            priority: int = PRIORITY_NORMAL,
+            checksum: str = None,
+            mirrors: list[str] = None,
+    ) -> "Download":
+        """
+        Creates a download file and adds it to the active downloads.
+        `checksum` ("<algorithm>:<hex digest>") is verified when the download completes.
+        `mirrors` are other URLs of the same file, fetched from in parallel with `url`.
+        Blocks while the URL is probed, see admit_download for a non-blocking version.
+        """
+        expected_checksums = dict([parse_checksum(checksum)]) if checksum else None
         odm_file = ODMFile.create_new(
             url=url,
             download_filename=download_filename,
@@ -46,12 +312,126 @@ class DownloadManager:
             file_size=file_size,
             preallocated=preallocated,
             odm_filepath=odm_filepath,
+            expected_checksums=expected_checksums,
+            mirrors=mirrors,
         )
-        self.add_download(odm_file.odm_filepath, start=True)
+        return self.add_download(odm_file.odm_filepath, start=True, priority=priority)
+
+    def admit_download(self, url: str, checksum: str = None, **options) -> Admission:
+        """
+        Accepts a download without waiting for it to be created: download_file runs on
+        the admission pool, and the returned admission reports its progress in the
+        status view. Takes the arguments of download_file. Raises ValueError for an invalid
+        `checksum` or too many mirrors, and AdmissionQueueFullError if too many downloads are waiting.
+        """
+        if checksum:
+            parse_checksum(checksum)
+        if len(options.get("mirrors") or ()) > MAX_MIRRORS:
+            raise ValueError(f"At most {MAX_MIRRORS} mirrors can be given")
+        return self.admissions.submit(url, checksum=checksum, **options)
+
+    @staticmethod
+    def get_download_id(download: "Download") -> str:
+        """Identifier of a download (or of its admission, until it is created) in status and event payloads"""
+        if isinstance(download, Admission):
+            return download.id
+        return str(Path(download.odm_file_path))
+
+    def is_listed(self, download: "Download") -> bool:
+        """Whether `download` (or an Admission) is still one the manager has, False once it was removed"""
+        if isinstance(download, Admission):
+            return self.admissions.get(download.id) is download
+        return self.active_downloads.get(Path(download.odm_file_path).resolve()) is download
+
+    def get_download_status(self, download: "Download", queue_positions: dict = None) -> dict:
+        return {**download.get_status(), **self.scheduler.get_entry_status(download, queue_positions)}
+
+    def get_raw_download_status(self, download: "Download", queue_positions: dict = None) -> dict:
+        """Unformatted status of `download`, including its scheduling state and an overall `state`"""
+        if isinstance(download, Admission):
+            return download.get_raw_status()
+        status = {**download.get_raw_status(), **self.scheduler.get_entry_status(download, queue_positions)}
+        status["state"] = self.get_download_state(download, status["queue_state"])
+        status["host"] = self.scheduler.get_host(download)
+        return status
+
+    def get_download_state(self, download: "Download", queue_state: str = None) -> str:
+        """Overall state of a download: completed, downloading, queued, retrying, error or paused"""
+        if download.header.completed:
+            return "completed"
+        if queue_state == "active" or (queue_state is None and self.scheduler.is_active(download)):
+            return "downloading"
+        if queue_state == "queued" or (queue_state is None and self.scheduler.is_queued(download)):
+            return "queued"
+        if download.next_retry_at is not None:
+            return "retrying"
+        if download.error_message:
+            return "error"
+        return "paused"
 
     def get_status(self):
-        return {odm_path: download.get_status() for odm_path, download in
-                self.active_downloads.items()}
+        queue_positions = self.scheduler.get_queue_positions()
+        return {odm_path: self.get_download_status(download, queue_positions)
+                for odm_path, download in self.active_downloads.items()}
+
+
+def http_error_message(status_code: int, error: Exception) -> str:
+    """Returns a user-facing description of an HTTP error status."""
+    if status_code == 403:
+        return f"Access forbidden (403). The URL may have expired or requires authentication."
+    elif status_code == 404:
+        return f"File not found (404). The URL may be invalid or the file has been moved."
+    elif status_code == 416:
+        return f"Range not satisfiable (416). The file may have changed or resume position is invalid."
+    elif status_code == 429:
+        return f"Too many requests (429). Server is rate limiting, try again later."
+    elif status_code >= 500:
+        return f"Server error ({status_code}). The server is experiencing issues."
+    else:
+        return f"HTTP {status_code} - {error}"
+
+
+class RemoteFileChangedError(Exception):
+    """
+    Raised when a response doesn't continue the payload: the remote file changed since
+    the download started, or the server ignored the range request. Holds what the
+    response tells about the current version, so the download can start over with it.
+    """
+
+    def __init__(self, message: str, file_size: int = None, etag: str = None, last_modified: str = None,
+                 ranges_ignored: bool = False):
+        super().__init__(message)
+        self.file_size = file_size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.ranges_ignored = ranges_ignored
+
+
+_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+
+def check_range_response(header, status: int, headers, start: int, mirror: bool = False):
+    """
+    Raises RemoteFileChangedError unless a response to a range request starting at payload
+    byte `start` is that range of the version of the file described by `header`.
+    Set `mirror` for responses of a mirror, see Header.has_same_validators.
+    """
+    if status == 206:
+        match = _CONTENT_RANGE.match(headers.get("Content-Range", ""))
+        total = int(match.group(3)) if match and match.group(3) != "*" else None
+        if (match and int(match.group(1)) == start and header.has_same_validators(headers, mirror)
+                and (total is None or header.file_size is None or total == header.file_size)):
+            return
+        raise RemoteFileChangedError(
+            f"The server sent another version of the file (Content-Range: {headers.get('Content-Range')})",
+            total, headers.get("ETag"), headers.get("Last-Modified"))
+
+    # A whole file, because it changed (If-Range didn't match) or because the server doesn't do ranges
+    content_length = headers.get("Content-Length")
+    file_size = int(content_length) if content_length and not headers.get("Content-Encoding") else None
+    raise RemoteFileChangedError(f"The server sent the whole file instead of the bytes from {start}",
+                                 file_size, headers.get("ETag"), headers.get("Last-Modified"),
+                                 ranges_ignored=header.has_same_validators(headers, mirror))
 
 
 class Download:
@@ -60,19 +440,43 @@ class Download:
         "download_dir"
     }
 
-    def __init__(self, odm_file_path: str, chunk_size: int = 8192, on_error=None, on_progress=None, on_complete=None, ):
-        self._download_speed = 0
+    def __init__(self, odm_file_path: str, chunk_size: int = None, on_error=None, on_progress=None, on_complete=None,
+                 segment_count: int = SEGMENT_COUNT, on_finish=None, rate_limiter: RateLimiter = None,
+                 session_pool: SessionPool = None, on_checkpoint=None, mirror_stats: MirrorStats = None):
+        self.segment_count = segment_count
+        self.rate_limiter = rate_limiter
+        self.session_pool = session_pool or get_shared_pool()
+        self.mirror_stats = mirror_stats or MirrorStats()
+        self._mirror_set: Optional[MirrorSet] = None  # URLs of the current segmented transfer
+        self._active_fetches: dict[Segment, tuple[float, int]] = {}  # Segment -> (start time, start offset)
         self.is_downloading = False
         self.thread = None
         self.odm_file_path = odm_file_path
         self._odm_object = ODMFile.load(self.odm_file_path)
-        self.chunk_size = chunk_size
+        self.chunk_size = chunk_size  # Initial read size, it then adapts to the throughput (see ReadSizer)
+        self._read_sizers: list[ReadSizer] = []  # One per open response
         self._stop_flag = False  # Will be set to true when intentionally stopping a download
 
         # Callables
         self.on_progress = on_progress
         self.on_error = on_error
         self.on_complete = on_complete
+        self.on_finish = on_finish  # Called with this download whenever a transfer ends, for any reason
+        self.on_checkpoint = on_checkpoint  # Called with this download after each header checkpoint
+        self._odm_object.on_checkpoint = lambda odm_file: self.on_checkpoint and self.on_checkpoint(self)
+        self.error_message: Optional[str] = None  # Why the last transfer failed, if it did
+        self.error_status: Optional[int] = None  # HTTP status of that failure, if it was an HTTP error
+        self.retry_class: Optional[str] = None  # Retry rule that applies to that failure, None if it isn't retried
+        self.retry_after: Optional[float] = None  # Seconds the server asked to wait before retrying (Retry-After)
+        self.retry_attempt = 0  # Consecutive failed transfers that received nothing
+        self.retry_count = 0  # Transfers started automatically after a failure
+        self.next_retry_at: Optional[float] = None  # When the next automatic retry is due (epoch seconds)
+        self._attempt_start_bytes = 0
+        self._count_bytes = BYTES_RECEIVED.inc
+
+    @property
+    def header(self):
+        return self._odm_object.header
 
     def __getattr__(self, name):
         """Custom attribute access for delegated properties"""
@@ -123,7 +527,7 @@ class Download:
             >>> get_download_speed(unit=None, formatted=True)  # Auto unit selection
             "1.0 MB/s"
         """
-        speed = self._download_speed
+        speed = self._odm_object.download_speed
 
         # Unit conversion factors (to bytes)
         unit_conversions = {
@@ -214,91 +618,54 @@ class Download:
         :return:
         """
         print(f"Starting download: {self._odm_object.header.download_filename}, Size: {self._odm_object.header.file_size}Bytes")
-        from tqdm import tqdm
 
         error_msg = None
+        self._start_attempt()
         try:
-            start_offset = self._odm_object.get_resume_byte() - self._odm_object.header.header_size
-            if start_offset and resume:
-                headers = {
-                    "Range": f"bytes={start_offset}-"
-                }
-            else:
-                headers = {}
-
-            # print(f"Starting download from byte {self._odm_object.get_resume_byte()}")
-            with requests.get(self._odm_object.header.url, headers=headers, stream=True, timeout=30) as response:
-                response.raise_for_status()
-
-                import time
-
-                # Will contain tuples with two elements, the first being the time
-                # of download increment and the second being the magnitude
-                increments_in_last_second = []
-
-                for chunk in tqdm(
-                        response.iter_content(chunk_size=self.chunk_size),
-                        total=self._odm_object.header.file_size / self.chunk_size if self._odm_object.header.file_size else None,
-                        unit=f"x{self.chunk_size}B",
-                        desc=f"Downloading {self._odm_object.header.download_filename}"
-                ):
-                    if self._stop_flag:
-                        print(f"Stopping download of '{self._odm_object.header.download_filename}'")
-                        self._stop_flag = False
-                        self.is_downloading = False
-                        return
+            try:
+                completed = self._transfer(resume)
+            except RemoteFileChangedError as e:
+                # Never mix two versions of the file: start over, once
+                print(f"[WARN] {e}. Restarting '{self._odm_object.header.download_filename}' from the beginning")
+                self._restart_payload(e)
+                completed = self._transfer(resume=True)
 
-                    if chunk:
-                        self.is_downloading = True
-                        self._odm_object.append_to_payload(chunk)
+            if not completed:
+                # Download was stopped intentionally
+                return
 
-                        # Record the current time and chunk size
-                        current_time = time.time()
-                        increments_in_last_second.append((current_time, len(chunk)))
+            # Download completed successfully, once its checksums are right
+            self._odm_object.close_writer()
+            print(f"Write statistics: {self._odm_object.get_writer_stats()}")
+            print(f"Checksums: {self._odm_object.finish_checksum()}")
+            self._odm_object.header.completed = True
+            self._odm_object.write_header()
+            self._odm_object.extract_payload(remove_payload_from_odm=False)
+            if self.on_complete:
+                self.on_complete()
+            print("Download complete")
 
-                        # Remove increments older than 1 second
-                        cutoff_time = current_time - 1.0
-                        increments_in_last_second = [
-                            (t, size) for t, size in increments_in_last_second
-                            if t > cutoff_time
-                        ]
+        except ChecksumMismatchError as e:
+            error_msg = f"Downloaded file is corrupt. {e}"
 
-                        # Calculate download speed (bytes per second)
-                        total_bytes_in_last_second = sum(size for _, size in increments_in_last_second)
-                        download_speed_bps = total_bytes_in_last_second  # Already in bytes/second since window is 1 second
-                        # download_speed_mbps = download_speed_bps / (1024 * 1024)
-
-                        # print(f"Download speed: {download_speed_mbps:.2f} MB/s ({download_speed_bps / 1024:.2f} KB/s)")
-                        self._download_speed = download_speed_bps
-
-                        if self.on_progress:
-                            self.on_progress(self._odm_object.get_resume_byte() + len(chunk))
-
-                # Download completed successfully
-                self._odm_object.extract_payload(remove_payload_from_odm=False)
-                if self.on_complete:
-                    self.on_complete()
-                print("Download complete")
+        except RemoteFileChangedError as e:
+            error_msg = f"The file keeps changing on the server. {e}"
 
         except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 403:
-                error_msg = f"Access forbidden (403). The URL may have expired or requires authentication."
-            elif e.response.status_code == 404:
-                error_msg = f"File not found (404). The URL may be invalid or the file has been moved."
-            elif e.response.status_code == 416:
-                error_msg = f"Range not satisfiable (416). The file may have changed or resume position is invalid."
-            elif e.response.status_code == 429:
-                error_msg = f"Too many requests (429). Server is rate limiting, try again later."
-            elif e.response.status_code >= 500:
-                error_msg = f"Server error ({e.response.status_code}). The server is experiencing issues."
-            else:
-                error_msg = f"HTTP {e.response.status_code} - {e}"
+            error_msg = http_error_message(e.response.status_code, e)
+            self._record_http_error(e.response.status_code, e.response.headers)
 
         except requests.exceptions.ConnectionError as e:
             error_msg = "Connection failed. Check your internet connection or the server may be down."
+            self.retry_class = CONNECTION
 
         except requests.exceptions.Timeout as e:
             error_msg = "Request timed out. The server is taking too long to respond."
+            self.retry_class = TIMEOUT
+
+        except requests.exceptions.ChunkedEncodingError as e:
+            error_msg = "Connection lost while receiving the file."
+            self.retry_class = CONNECTION
 
         except requests.exceptions.RequestException as e:
             error_msg = f"Network error - {e}"
@@ -307,19 +674,377 @@ class Download:
             error_msg = "Permission denied writing to file. Check file permissions."
 
         except OSError as e:
-            error_msg = f"File system error - {e}"
+            if e.errno == errno.ENOSPC:
+                error_msg = "Not enough disk space to continue the download."
+            else:
+                error_msg = f"File system error - {e}"
 
         except Exception as e:
             error_msg = f"Unexpected error - {e}"
 
         finally:
             self.is_downloading = False
+            try:
+                self._odm_object.close_writer()
+            except OSError as e:
+                error_msg = error_msg or f"File system error - {e}"
             if error_msg:
+                self.error_message = error_msg
                 print(f"Error downloading '{self._odm_object.odm_filepath}': {error_msg}")
                 if self.on_error:
                     self.on_error(error_msg)
+            if self.on_finish:
+                self.on_finish(self)
+
+    def _start_attempt(self):
+        """Clears the error of the previous transfer, which is counted as retried if there was one"""
+        if self.error_message is not None:
+            RETRIES.labels(self.error_status or "none").inc()
+        self.error_message = None
+        self.error_status = None
+        self.retry_class = None
+        self.retry_after = None
+        self.next_retry_at = None
+        self._attempt_start_bytes = self._odm_object.header.downloaded_bytes
+
+    def _record_http_error(self, status: int, headers=None):
+        self.error_status = status
+        self.retry_class = classify_http_status(status)
+        self.retry_after = parse_retry_after(headers.get("Retry-After")) if headers else None
+        HTTP_ERRORS.labels(status).inc()
+
+    @property
+    def made_progress(self) -> bool:
+        """Whether the current (or last) transfer received any payload"""
+        return self._odm_object.header.downloaded_bytes > self._attempt_start_bytes
+
+    def _transfer(self, resume=True) -> bool:
+        if self._use_segments():
+            return self._download_segments()
+        return self._download_stream(resume)
+
+    def _get_range_headers(self, start: int, end: int = None, mirror: bool = False) -> dict:
+        """
+        Headers requesting the payload bytes [start, end), from a mirror if `mirror` is set.
+        If-Range makes a server whose file changed send the whole new version (200) instead of a range of it.
+        """
+        headers = {"Range": f"bytes={start}-{end - 1 if end is not None else ''}"}
+        validator = self._odm_object.header.get_if_range(mirror)
+        if validator:
+            headers["If-Range"] = validator
+        return headers
+
+    def _record_validators(self, headers):
+        """Keeps the validators of a response that starts the payload, for later resumes"""
+        header = self._odm_object.header
+        header.etag = headers.get("ETag") or header.etag
+        header.last_modified = headers.get("Last-Modified") or header.last_modified
+
+    def _restart_payload(self, error: RemoteFileChangedError):
+        """Starts the payload over for the version of the file described by `error`"""
+        self._odm_object.restart_payload(error.file_size, error.etag, error.last_modified,
+                                         supports_resume=False if error.ranges_ignored else None)
+
+    def _accept_whole_file(self, headers, error: RemoteFileChangedError, start_offset: int) -> int:
+        """
+        Handles a whole file sent in answer to a resume request. Its first `start_offset`
+        bytes are skipped if it is provably the same content, otherwise the payload starts over.
+        :return: Number of bytes of the body to skip
+        """
+        header = self._odm_object.header
+        if header.is_same_content(headers):
+            print(f"[INFO] Server ignored the range request, skipping the {start_offset} bytes already downloaded")
+            header.supports_resume = False
+            return start_offset
+        print(f"[WARN] {error}. Restarting '{header.download_filename}' from the beginning")
+        self._restart_payload(error)
+        return 0
+
+    def _use_segments(self) -> bool:
+        """Whether this download should be fetched over several parallel connections."""
+        header = self._odm_object.header
+        if header.segments is not None:
+            # A segmented download must be resumed segment by segment
+            return True
+        return bool(header.supports_resume and header.file_size
+                    and self.segment_count > 1
+                    and header.file_size - header.downloaded_bytes >= 2 * MIN_SEGMENT_SIZE)
+
+    def _download_stream(self, resume=True) -> bool:
+        """
+        Downloads the payload over a single connection.
+        :return: True if the stream was fully received, False if the download was stopped
+        """
+        from tqdm import tqdm
+
+        header = self._odm_object.header
+        start_offset = header.downloaded_bytes
+        if start_offset and not resume:
+            # Asked to start over
+            self._odm_object.restart_payload(header.file_size, header.etag, header.last_modified)
+            start_offset = 0
+        headers = self._get_range_headers(start_offset) if start_offset else {}
+
+        # print(f"Starting download from byte {self._odm_object.get_resume_byte()}")
+        with self.session_pool.get(header.url, headers=headers, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            skip = 0
+            if start_offset:
+                try:
+                    check_range_response(header, response.status_code, response.headers, start_offset)
+                except RemoteFileChangedError as e:
+                    if response.status_code != 200:
+                        raise
+                    # The body is the whole file, use it rather than asking again
+                    skip = self._accept_whole_file(response.headers, e, start_offset)
+                    start_offset = skip
+            else:
+                self._record_validators(response.headers)
+            self._odm_object.add_expected_checksums(
+                parse_digest_headers(response.headers, full_response=response.status_code == 200))
+
+            buffer = ReceiveBuffer()
+            if skip:
+                for _ in self._read_chunks(response, buffer, limit=skip):
+                    if self._stop_flag:
+                        break
+
+            progress_bar = tqdm(
+                total=header.file_size,
+                initial=start_offset,
+                unit="B",
+                unit_scale=True,
+                desc=f"Downloading {header.download_filename}"
+            )
+            try:
+                for chunk in self._read_chunks(response, buffer):
+                    if self._stop_flag:
+                        print(f"Stopping download of '{self._odm_object.header.download_filename}'")
+                        self._stop_flag = False
+                        self.is_downloading = False
+                        self._odm_object.close_writer()
+                        return False
+
+                    self.is_downloading = True
+                    self._odm_object.append_to_payload(chunk)
+                    self._record_progress(len(chunk))
+                    progress_bar.update(len(chunk))
+                    self._throttle(len(chunk))
+            finally:
+                progress_bar.close()
+
+        return True
+
+    def _read_chunks(self, response: requests.Response, buffer: ReceiveBuffer, limit: Optional[int] = None):
+        """
+        Yields the body of a streamed response, at most `limit` bytes of it if given.
+        Every chunk is a memoryview of `buffer`, which is reused for the next read,
+        so it must be consumed (copied) before asking for the next one. The read
+        size adapts to the throughput of this response, see ReadSizer.
+        """
+        sizer = ReadSizer(initial=self.chunk_size)
+        raw = response.raw
+        raw.decode_content = True  # Like iter_content, undo any Content-Encoding
+        self._read_sizers.append(sizer)
+        try:
+            while limit is None or limit > 0:
+                size = sizer.size if limit is None else min(sizer.size, limit)
+                started = time.monotonic()
+                view = buffer.reserve(size)
+                num_bytes = raw.readinto(view[:size])
+                if not num_bytes:
+                    return
+                sizer.record(num_bytes, time.monotonic() - started)
+                if limit is not None:
+                    limit -= num_bytes
+                yield view[:num_bytes]
+        # Raise the same errors as iter_content
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            self._read_sizers.remove(sizer)
+
+    @property
+    def read_size(self) -> Optional[int]:
+        """Current read size of the fastest open response, None while nothing is being received"""
+        return max((sizer.size for sizer in self._read_sizers), default=None)
+
+    def _download_segments(self) -> bool:
+        """
+        Downloads the payload as several byte ranges over parallel connections.
+        Progress of every segment is kept in the ODM header, so a resumed download
+        continues each segment where it left off.
+        :return: True if every segment is complete, False if the download was stopped
+        """
+        from tqdm import tqdm
+
+        header = self._odm_object.header
+        segments, mirrors = self._plan_segments()
+        writer = self._odm_object.open_writer()
+
+        abort = Event()
+        errors = []
+        progress_bar = tqdm(
+            total=header.file_size,
+            initial=header.downloaded_bytes,
+            unit="B",
+            unit_scale=True,
+            desc=f"Downloading {header.download_filename} ({len(header.segments)} segments)"
+        )
+        self.is_downloading = True
+        workers = [
+            Thread(target=self._segment_worker, args=(segment, mirror, writer, abort, errors, progress_bar))
+            for segment, mirror in zip(segments, mirrors)
+        ]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            progress_bar.close()
+            self._mirror_set.save()
+
+        if errors:
+            raise errors[0]
+
+        if self._stop_flag:
+            print(f"Stopping download of '{header.download_filename}'")
+            self._stop_flag = False
+            self.is_downloading = False
+            self._odm_object.close_writer()
+            return False
+
+        return all(segment.is_complete for segment in header.segments)
+
+    def _plan_segments(self) -> tuple[list[Segment], list[Mirror]]:
+        """
+        Splits the payload into segments if it isn't yet, sized in proportion to the throughput
+        of the mirror each one goes to. Returns the incomplete segments and their mirrors.
+        """
+        header = self._odm_object.header
+        self._mirror_set = MirrorSet(header.urls, self.mirror_stats)
+        if header.segments is None:
+            mirrors = self._mirror_set.plan(self.segment_count)
+            header.split_into_segments(len(mirrors), weights=[self._mirror_set.get_throughput(mirror)
+                                                              for mirror in mirrors])
+            return list(header.segments), mirrors[:len(header.segments)]
+        segments = [segment for segment in header.segments if not segment.is_complete]
+        return segments, self._mirror_set.assign(segments)
+
+    def _replace_mirror(self, mirror: Mirror, segment: Segment, error: Exception) -> Optional[Mirror]:
+        """Mirror to fetch the rest of `segment` from after `mirror` failed with `error`, None if there's none left"""
+        replacement = self._mirror_set.replace(mirror, error)
+        if replacement is not None:
+            print(f"[WARN] Mirror '{mirror.url}' failed ({error}), moving segment {segment.start}-{segment.end - 1} "
+                  f"to '{replacement.url}'")
+        return replacement
+
+    def _steal_segment(self, writer: PayloadWriter) -> Optional[Segment]:
+        """
+        Called when a connection has finished its range. Splits the range of the active
+        connection that would finish last (remaining bytes over its throughput, so the slowest
+        one among similar ranges, the largest among similar speeds) and returns its second
+        half as a new segment, or None if no range is worth another connection. The new
+        boundaries are checkpointed at once, so a resumed download keeps the layout.
+        """
+        now = time.monotonic()
+
+        def time_left(item) -> float:
+            segment, (started, start_offset) = item
+            throughput = (segment.start + segment.downloaded - start_offset) / max(now - started, 0.001)
+            return segment.remaining / max(throughput, 1.0)
+
+        for victim, _ in sorted(list(self._active_fetches.items()), key=time_left, reverse=True):
+            new_segment = writer.split_segment(victim, MIN_SEGMENT_SIZE)
+            if new_segment is not None:
+                print(f"[INFO] Taking over bytes {new_segment.start}-{new_segment.end - 1} of "
+                      f"'{self._odm_object.header.download_filename}' from a slower connection")
+                return new_segment
+        return None
+
+    def _segment_worker(self, segment: Segment, mirror: Mirror, writer: PayloadWriter, abort: Event, errors: list,
+                        progress_bar):
+        """
+        Fetches the remainder of one segment from `mirror`, moving to another mirror if it fails.
+        Once the segment is complete, the worker takes over part of a slower one (see
+        _steal_segment). Errors no mirror is left for are collected in `errors` and stop the other workers.
+        """
+        buffer = ReceiveBuffer()
+        try:
+            while segment is not None:
+                try:
+                    self._fetch_segment(segment, mirror, writer, abort, progress_bar, buffer)
+                except (requests.exceptions.RequestException, RemoteFileChangedError) as e:
+                    if self._stop_flag or abort.is_set():
+                        return
+                    mirror = self._replace_mirror(mirror, segment, e)
+                    if mirror is None:
+                        raise
+                    continue
+                if self._stop_flag or abort.is_set():
+                    return
+                segment = self._steal_segment(writer)
+
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+
+    def _fetch_segment(self, segment: Segment, mirror: Mirror, writer: PayloadWriter, abort: Event, progress_bar,
+                       buffer: ReceiveBuffer):
+        start = self._odm_object.get_resume_byte(segment) - self._odm_object.header.header_size
+        is_mirror = mirror.url != self._odm_object.header.url
+        headers = self._get_range_headers(start, segment.end, is_mirror)
+        received = 0
+        started = time.monotonic()
+        self._mirror_set.begin(mirror)
+        self._active_fetches[segment] = (started, start)
+        try:
+            with self.session_pool.get(mirror.url, headers=headers, stream=True,
+                                       timeout=(30, self._mirror_set.read_timeout)) as response:
+                response.raise_for_status()
+                check_range_response(self._odm_object.header, response.status_code, response.headers, start,
+                                     is_mirror)
+                self._odm_object.add_expected_checksums(parse_digest_headers(response.headers, full_response=False))
+
+                # Never read past the end of the segment
+                for chunk in self._read_chunks(response, buffer, limit=segment.remaining):
+                    if self._stop_flag or abort.is_set():
+                        return
+                    written = writer.write_segment(segment, chunk)
+                    received += written
+                    self._record_progress(written)
+                    progress_bar.update(written)
+                    self._throttle(len(chunk))
+                    if segment.is_complete:
+                        # The end may have moved back, when another connection took over part of the segment
+                        break
+        finally:
+            del self._active_fetches[segment]
+            self._mirror_set.end(mirror, received, time.monotonic() - started)
+
+        if not segment.is_complete:
+            raise requests.exceptions.ConnectionError(
+                f"Connection closed with {segment.remaining} bytes left in segment {segment.start}-{segment.end - 1}")
+
+    def _throttle(self, num_bytes: int):
+        """Waits as long as the speed limits require after receiving `num_bytes`."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.throttle(self, num_bytes)
+
+    def _record_progress(self, num_bytes: int):
+        """Updates the speed meter and notifies progress listeners after `num_bytes` were received."""
+        self._odm_object.speed_meter.update(num_bytes)
+        self._count_bytes(num_bytes)
+        if self.on_progress:
+            self.on_progress(self._odm_object.get_resume_byte() + num_bytes)
 
     def get_status(self) -> dict:
+        writer_stats = self._odm_object.get_writer_stats()
         return {
             "downloaded_bytes": self._odm_object.header.downloaded_bytes,
             "total_bytes": self._odm_object.header.file_size,
@@ -328,7 +1053,62 @@ class Download:
             "download_percentage": (self._odm_object.header.downloaded_bytes / self._odm_object.header.file_size) if (
                     self._odm_object.header.file_size and self._odm_object.header.file_size > 0) else "Unknown",
             "download_speed": self.get_download_speed(unit=None, formatted=True),
+            "download_speed_bps": self._odm_object.speed_meter.get_speed(),
+            "smoothed_speed_bps": self._odm_object.speed_meter.get_smoothed_speed(),
+            "eta_seconds": self._odm_object.speed_meter.get_eta(
+                self._odm_object.header.file_size - self._odm_object.header.downloaded_bytes
+                if self._odm_object.header.file_size else None),
             "supports resume": self._odm_object.header.supports_resume if self._odm_object.header.supports_resume is not None else "Unknown",
+            "speed_limit": self.rate_limiter.get_rate(self) if self.rate_limiter is not None else None,
+            "writes_per_mb": writer_stats.get("writes_per_mb", 0.0),
+            "disk_queue_bytes": writer_stats.get("queued_bytes", 0),
+            "segments": [segment.to_dict() for segment in self._odm_object.header.segments]
+            if self._odm_object.header.segments is not None else None,
+            "checksums": self._odm_object.header.checksum.results,
+            "checksum_verified": self._odm_object.header.checksum.verified,
+            "read_size": self.read_size,
+            "mirrors": self._get_mirrors_status(),
+            "retries": self.retry_count,
+            "next_retry_at": time.strftime(DATETIME_FORMAT, time.localtime(self.next_retry_at))
+            if self.next_retry_at is not None else None,
+        }
+
+    def _get_mirrors_status(self) -> Optional[list[dict]]:
+        """URLs of a download with mirrors and how each one is doing, None without mirrors"""
+        header = self._odm_object.header
+        if not header.mirrors:
+            return None
+        mirror_set = self._mirror_set
+        if mirror_set is None:
+            mirror_set = self._mirror_set = MirrorSet(header.urls, self.mirror_stats)
+        return mirror_set.get_status()
+
+    def get_raw_status(self) -> dict:
+        """Status with unformatted values only, for clients that do their own formatting"""
+        header = self._odm_object.header
+        speed_meter = self._odm_object.speed_meter
+        eta = speed_meter.get_eta(header.file_size - header.downloaded_bytes if header.file_size else None)
+        return {
+            "download_filename": header.download_filename,
+            "url": header.url,
+            "downloaded_bytes": header.downloaded_bytes,
+            "total_bytes": header.file_size,
+            "is_downloading": self.is_downloading,
+            "completed": header.completed,
+            "error": self.error_message,
+            "download_speed_bps": round(speed_meter.get_speed()),
+            "smoothed_speed_bps": round(speed_meter.get_smoothed_speed()),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "supports_resume": header.supports_resume,
+            "speed_limit": self.rate_limiter.get_rate(self) if self.rate_limiter is not None else None,
+            "segments": [segment.to_dict() for segment in header.segments] if header.segments is not None else None,
+            "checksums": header.checksum.results,
+            "checksum_verified": header.checksum.verified,
+            "read_size": self.read_size,
+            "disk_queue_bytes": self._odm_object.get_writer_stats().get("queued_bytes", 0),
+            "mirrors": self._get_mirrors_status(),
+            "retries": self.retry_count,
+            "next_retry_at": self.next_retry_at,
         }
 
 
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+from fastapi import WebSocketDisconnect
+
+from config import EVENT_PUBLISH_INTERVAL, WS_SEND_TIMEOUT
+from metrics import WS_FANOUT_LAG_SECONDS, WS_SUBSCRIBERS
+
+
+class Subscriber:
+    """A connected event stream client and the updates it hasn't received yet."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        # Coalesced changes per download id. A client that falls behind only ever
+        # holds the latest value of each field, never a backlog of messages.
+        self.pending: dict[str, dict] = {}
+        self.pending_since = None  # When the oldest pending change was published
+        self.wakeup = asyncio.Event()
+        self.send_lock = asyncio.Lock()  # WebSockets don't allow concurrent sends
+
+    async def send(self, send_coroutine, timeout: float):
+        async with self.send_lock:
+            await asyncio.wait_for(send_coroutine, timeout=timeout)
+
+    def queue(self, changes: dict[str, dict]):
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        for download_id, fields in changes.items():
+            if fields is None:
+                # Removed, which replaces any change still pending
+                self.pending[download_id] = None
+            elif self.pending.get(download_id) is None:
+                self.pending[download_id] = dict(fields)
+            else:
+                self.pending[download_id].update(fields)
+        if self.pending:
+            self.wakeup.set()
+
+    def take_pending(self) -> tuple[dict[str, dict], float]:
+        """Returns the pending changes and when the oldest of them was published"""
+        pending, self.pending = self.pending, {}
+        self.wakeup.clear()
+        return pending, self.pending_since
+
+
+class EventHub:
+    """
+    Publishes download status changes to subscribers (the /ws WebSocket clients).
+
+    Every `interval` seconds the hub refreshes the shared StatusView and hands
+    the fields changed since the last publication to each subscriber. A
+    subscriber gets a full snapshot when it subscribes and then at most one
+    update per download per interval.
+    """
+
+    def __init__(self, status_view, interval: float = EVENT_PUBLISH_INTERVAL, send_timeout: float = WS_SEND_TIMEOUT):
+        self.status_view = status_view
+        self.interval = interval
+        self.send_timeout = send_timeout
+        self.version = 0  # Last status view version published
+        self.subscribers: list[Subscriber] = []
+        self._task = None
+        WS_SUBSCRIBERS.set_function(lambda: len(self.subscribers))
+
+    def start(self):
+        """Starts publishing. Must be called on the event loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        """Stops publishing."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.publish()
+            except Exception as e:
+                print(f"[WARN] Failed to publish download events: {e}")
+
+    def publish(self):
+        """Queues the changes made since the last call for every subscriber."""
+        self.status_view.refresh()
+        # Changes may also have been picked up by other readers of the view, so ask by version
+        version, changes = self.status_view.get_changes(self.version)
+        self.version = version
+        if changes:
+            for subscriber in self.subscribers:
+                subscriber.queue(changes)
+
+    async def serve(self, websocket):
+        """Streams events to an accepted WebSocket until it disconnects."""
+        subscriber = Subscriber(websocket)
+        version, downloads = self.status_view.get_snapshot()
+        snapshot = {"type": "snapshot", "version": version, "downloads": downloads}
+        # Subscribe before sending, so changes published meanwhile are queued behind the snapshot
+        self.subscribers.append(subscriber)
+        print(f"WebSocket client subscribed. Total subscribers: {len(self.subscribers)}")
+
+        sender = asyncio.ensure_future(self._send_updates(subscriber, snapshot))
+        receiver = asyncio.ensure_future(self._receive(subscriber))
+        try:
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = task.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    print(f"WebSocket error: {error!r}")
+        finally:
+            sender.cancel()
+            receiver.cancel()
+            self.subscribers.remove(subscriber)
+            print(f"WebSocket client unsubscribed. Total subscribers: {len(self.subscribers)}")
+
+    async def _send_updates(self, subscriber: Subscriber, snapshot: dict):
+        await subscriber.send(subscriber.websocket.send_json(snapshot), self.send_timeout)
+        while True:
+            await subscriber.wakeup.wait()
+            changes, published_at = subscriber.take_pending()
+            # A client that can't take a message within the timeout is dropped
+            await subscriber.send(
+                subscriber.websocket.send_json({"type": "update", "version": self.version, "downloads": changes}),
+                self.send_timeout,
+            )
+            WS_FANOUT_LAG_SECONDS.observe(time.monotonic() - published_at)
+
+    @staticmethod
+    async def _receive(subscriber: Subscriber):
+        # Clients don't send anything meaningful yet, reading only detects disconnects
+        while True:
+            await subscriber.websocket.receive_text()
+
+    async def broadcast(self, message: str):
+        """Sends a text message to every subscriber right away."""
+        for subscriber in list(self.subscribers):
+            try:
+                await subscriber.send(subscriber.websocket.send_text(message), self.send_timeout)
+            except Exception as e:
+                print(f"Error broadcasting to client: {e}")
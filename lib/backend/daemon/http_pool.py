@@ -0,0 +1,136 @@
+import time
+from threading import Lock
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import HTTP_POOL_MAXSIZE, HTTP_POOL_IDLE_TIMEOUT
+
+
+class SessionPool:
+    """
+    Daemon-wide pool of HTTP sessions, one per origin (scheme, host, port).
+
+    Every request to the same origin goes through the same keep-alive
+    connection pool, so the HEAD probe and the transfers of many downloads
+    from one host share TCP/TLS connections instead of opening new ones.
+    Sessions that stay unused for `idle_timeout` seconds are closed.
+    """
+
+    def __init__(self, pool_maxsize: int = HTTP_POOL_MAXSIZE, idle_timeout: float = HTTP_POOL_IDLE_TIMEOUT):
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self._sessions: dict[tuple, requests.Session] = {}
+        self._last_used: dict[tuple, float] = {}
+        self._lock = Lock()
+        self._last_eviction = time.monotonic()
+
+        # Counters
+        self.session_hits = 0
+        self.session_misses = 0
+        self.evicted_sessions = 0
+        self._retired_requests = 0  # Requests and connections of sessions already closed
+        self._retired_connections = 0
+
+    @staticmethod
+    def _get_key(url: str) -> tuple:
+        parsed = urlparse(url)
+        return parsed.scheme, parsed.hostname, parsed.port
+
+    def get_session(self, url: str) -> requests.Session:
+        """Returns the session for the origin of `url`, creating it if needed."""
+        key = self._get_key(url)
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_eviction >= self.idle_timeout:
+                self._evict_idle(now)
+
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[key] = session
+                self.session_misses += 1
+            else:
+                self.session_hits += 1
+            self._last_used[key] = now
+            return session
+
+    def _evict_idle(self, now: float):
+        for key, last_used in list(self._last_used.items()):
+            if now - last_used >= self.idle_timeout:
+                session = self._sessions.pop(key)
+                del self._last_used[key]
+                requests_made, connections = self._get_connection_counts(session)
+                self._retired_requests += requests_made
+                self._retired_connections += connections
+                session.close()
+                self.evicted_sessions += 1
+        self._last_eviction = now
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        """Closes every session."""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._last_used.clear()
+
+    @staticmethod
+    def _get_connection_counts(session: requests.Session) -> tuple[int, int]:
+        """Returns (requests made, connections opened) over the urllib3 pools of `session`."""
+        requests_made = connections = 0
+        for adapter in set(session.adapters.values()):
+            for pool_key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(pool_key)
+                if pool is not None:
+                    requests_made += pool.num_requests
+                    connections += pool.num_connections
+        return requests_made, connections
+
+    def get_stats(self) -> dict:
+        """
+        Pool counters. A connection hit is a request sent over an already open
+        connection, a miss is a request that had to open a new one.
+        """
+        with self._lock:
+            requests_made, connections = self._retired_requests, self._retired_connections
+            for session in self._sessions.values():
+                session_requests, session_connections = self._get_connection_counts(session)
+                requests_made += session_requests
+                connections += session_connections
+            return {
+                "sessions": len(self._sessions),
+                "session_hits": self.session_hits,
+                "session_misses": self.session_misses,
+                "evicted_sessions": self.evicted_sessions,
+                "requests": requests_made,
+                "connection_hits": requests_made - connections,
+                "connection_misses": connections,
+            }
+
+
+_shared_pool: Optional[SessionPool] = None
+_shared_pool_lock = Lock()
+
+
+def get_shared_pool() -> SessionPool:
+    """Returns the pool shared by the whole daemon."""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = SessionPool()
+        return _shared_pool
@@ -0,0 +1,264 @@
+"""
+Daemon metrics, served at /metrics in the Prometheus text format.
+
+Counters and histograms are updated from the download hot paths, so updates
+take no lock: every thread adds to its own cells (see _Shards) and the cells
+are only summed when the metrics are collected. Hot paths bind the update
+methods once (e.g. `self._count_bytes = BYTES_RECEIVED.inc`). With
+METRICS_ENABLED off those methods do nothing and /metrics isn't served.
+"""
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Optional
+
+from config import METRICS_ENABLED
+
+# Histogram buckets in seconds, for disk writes and for network round trips
+WRITE_LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+NETWORK_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _noop(*args):
+    pass
+
+
+class _Shards:
+    """
+    Per-thread cells of `size` numbers. A cell is only ever written by its own
+    thread, so adding to it needs no lock; collect() sums the cells of all
+    threads, folding those of finished threads into a single total.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._cells: list[tuple[threading.Thread, list]] = []
+        self._retired = [0] * size
+        self._lock = threading.Lock()
+
+    def cell(self) -> list:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self.size
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+            return cell
+
+    def collect(self) -> list:
+        with self._lock:
+            totals = list(self._retired)
+            alive = []
+            for thread, cell in self._cells:
+                for i, value in enumerate(cell):
+                    totals[i] += value
+                if thread.is_alive():
+                    alive.append((thread, cell))
+                else:
+                    for i, value in enumerate(cell):
+                        self._retired[i] += value
+            self._cells = alive
+        return totals
+
+
+class _CounterChild:
+    def __init__(self):
+        self._shards = _Shards(1)
+        self.inc = self._inc if METRICS_ENABLED else _noop
+
+    def _inc(self, amount=1):
+        self._shards.cell()[0] += amount
+
+    def get(self):
+        return self._shards.collect()[0]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Samples the gauge by calling `function` when the metrics are collected"""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # One count per bucket, one for +Inf, then the sum of the observations
+        self._shards = _Shards(len(buckets) + 2)
+        self.observe = self._observe if METRICS_ENABLED else _noop
+
+    def _observe(self, value: float):
+        cell = self._shards.cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def get(self) -> tuple[list, float]:
+        """Returns the (non-cumulative) bucket counts and the sum"""
+        totals = self._shards.collect()
+        return totals[:-1], totals[-1]
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), registry: "Registry" = None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+        if not self.labelnames:
+            self._bind(self.labels())
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _bind(self, child):
+        """Exposes the update methods of the unlabelled child on the metric itself"""
+
+    def labels(self, *values):
+        """Returns the child for these label values, to be kept and updated directly by hot paths"""
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _format_labels(self, values: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.labelnames, values)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values: tuple, child) -> list[str]:
+        return [f"{self.name}{self._format_labels(values)} {_format_value(child.get())}"]
+
+
+class Counter(_Metric):
+    """Monotonic count, e.g. bytes received"""
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _bind(self, child):
+        self.inc = child.inc
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, set directly or sampled from a function"""
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _bind(self, child):
+        self.set = child.set
+        self.set_function = child.set_function
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies in seconds"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = WRITE_LATENCY_BUCKETS,
+                 registry: "Registry" = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _bind(self, child):
+        self.observe = child.observe
+
+    def _render_child(self, values: tuple, child) -> list[str]:
+        counts, total = child.get()
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else _format_value(bound)
+            lines.append(f"{self.name}_bucket{self._format_labels(values, {'le': le})} {cumulative}")
+        lines.append(f"{self.name}_sum{self._format_labels(values)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{self._format_labels(values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Set of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+BYTES_RECEIVED = Counter("odm_bytes_received_total", "Payload bytes received by all downloads")
+CHUNK_WRITE_SECONDS = Histogram("odm_chunk_write_seconds",
+                                "Time taken to hand a received chunk to the payload writer, including any wait "
+                                "for room in the disk queue and the checkpoints it triggers")
+DISK_WRITE_SECONDS = Histogram("odm_disk_write_seconds",
+                               "Latency of a (vectored) payload write by the disk writer pool")
+DISK_BACKPRESSURE_SECONDS = Histogram("odm_disk_backpressure_seconds",
+                                      "Time a reader waited for room in the disk queue of its download")
+DISK_QUEUE_BYTES = Gauge("odm_disk_queue_bytes", "Payload bytes waiting for the disk writer pool")
+DISK_QUEUES_BUSY = Gauge("odm_disk_queues_busy", "Downloads with payload bytes waiting for the disk writer pool")
+CHECKPOINT_SECONDS = Histogram("odm_header_checkpoint_seconds",
+                               "Time taken by a header checkpoint (payload flush and header write)")
+HEAD_PROBE_SECONDS = Histogram("odm_head_probe_seconds", "Latency of the HEAD request probing a new download",
+                               buckets=NETWORK_LATENCY_BUCKETS)
+DOWNLOADS = Gauge("odm_downloads", "Downloads by scheduling state", ("state",))
+ADMISSIONS_PENDING = Gauge("odm_admissions_pending", "Accepted downloads waiting to be probed and created")
+OPEN_CIRCUITS = Gauge("odm_open_circuits", "Hosts whose retries are held back by an open or half-open circuit")
+HTTP_ERRORS = Counter("odm_http_errors_total", "Transfers that failed with an HTTP error status", ("status",))
+RETRIES = Counter("odm_retries_total",
+                  "Transfers started again after a failed one, by the HTTP status of the failure "
+                  "(none if it wasn't an HTTP error)", ("status",))
+WS_SUBSCRIBERS = Gauge("odm_ws_subscribers", "Connected event stream (WebSocket) clients")
+WS_FANOUT_LAG_SECONDS = Histogram("odm_ws_fanout_lag_seconds",
+                                  "Time from publishing a status change until it was sent to a WebSocket client",
+                                  buckets=NETWORK_LATENCY_BUCKETS)
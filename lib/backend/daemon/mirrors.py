@@ -0,0 +1,228 @@
+import sqlite3
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from checksum import parse_digest_headers
+from config import MAX_MIRRORS, MIRROR_STALL_SECONDS, MIRROR_STATS_SMOOTHING, HEAD_TIMEOUT_SECONDS
+
+# Bytes a mirror must have sent in a transfer for its throughput to be measured
+MIN_SAMPLE_BYTES = 256 * 1024
+
+
+def get_origin(url: str) -> str:
+    """Mirrors are told apart by origin, so what is learnt about one applies to all its files"""
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}".lower()
+
+
+def check_mirrors(mirrors: list[str], file_size: Optional[int], is_same_version: Callable, session_pool=None,
+                  timeout: float = HEAD_TIMEOUT_SECONDS, expected_digests: dict = None) -> list[str]:
+    """
+    Probes the `mirrors` of a download concurrently and returns the ones serving the same
+    file: `file_size` bytes, byte ranges not refused, and the same digest as one of
+    `expected_digests` if the mirror sends any, validators accepted by `is_same_version(headers)`
+    otherwise. The others are left out with a warning.
+    """
+    if not mirrors:
+        return []
+    if not file_size:
+        print(f"[WARN] Ignoring {len(mirrors)} mirror(s): the file size is unknown, so it can't be split")
+        return []
+    if session_pool is None:
+        from http_pool import get_shared_pool
+        session_pool = get_shared_pool()
+
+    def probe(url: str) -> Optional[str]:
+        """Returns why the mirror doesn't match, None if it does"""
+        try:
+            response = session_pool.head(url, timeout=timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            return f"HEAD request failed - {e}"
+        content_length = response.headers.get("Content-Length")
+        try:
+            size = int(content_length) if content_length is not None else None
+        except ValueError:
+            return f"malformed Content-Length '{content_length}'"
+        if size != file_size:
+            return f"size {content_length} instead of {file_size}"
+        digests = parse_digest_headers(response.headers)
+        compared = [name for name in digests if name in (expected_digests or {})]
+        for name in compared:
+            if digests[name] != expected_digests[name]:
+                return f"it serves another file ({name} digest differs)"
+        if not compared and not is_same_version(response.headers):
+            return "it serves another version of the file (Last-Modified differs)"
+        if response.headers.get("Accept-Ranges") == "none":
+            return "it doesn't support range requests"
+        return None
+
+    with ThreadPoolExecutor(max_workers=min(len(mirrors), MAX_MIRRORS)) as executor:
+        reasons = list(executor.map(probe, mirrors))
+    accepted = []
+    for url, reason in zip(mirrors, reasons):
+        if reason:
+            print(f"[WARN] Ignoring mirror '{url}': {reason}")
+        else:
+            accepted.append(url)
+    return accepted
+
+
+class MirrorStats:
+    """
+    Throughput per connection measured for each mirror origin, shared by all downloads.
+    With an index the stats are loaded from and saved to it, so that later downloads
+    from the same mirrors start with a good split.
+    """
+
+    def __init__(self, index=None, smoothing: float = MIRROR_STATS_SMOOTHING):
+        self.index = index
+        self.smoothing = smoothing
+        self._stats: dict[str, list] = {}  # Origin -> [throughput in B/s or None, failed transfers]
+        self._lock = Lock()
+
+    def _get_entry(self, origin: str) -> list:
+        with self._lock:
+            entry = self._stats.get(origin)
+        if entry is not None:
+            return entry
+        row = None
+        if self.index is not None:
+            try:
+                row = self.index.get_mirror_stats(origin)
+            except sqlite3.Error as e:
+                print(f"[WARN] Could not read the stats of mirror '{origin}': {e}")
+        with self._lock:
+            return self._stats.setdefault(origin, [row["throughput"], row["failures"]] if row else [None, 0])
+
+    def get_throughput(self, url: str) -> Optional[float]:
+        """Smoothed throughput per connection of the mirror of `url`, None if it was never measured"""
+        return self._get_entry(get_origin(url))[0]
+
+    def record(self, measurements: list[tuple[str, Optional[float], bool]]):
+        """
+        Adds the (url, throughput or None, failed) measurements of a transfer. A mirror that
+        failed without being measured has its throughput halved, so it's given less next time.
+        """
+        rows = []
+        for url, throughput, failed in measurements:
+            origin = get_origin(url)
+            entry = self._get_entry(origin)
+            with self._lock:
+                if throughput:
+                    entry[0] = throughput if entry[0] is None else entry[0] + self.smoothing * (throughput - entry[0])
+                elif failed and entry[0]:
+                    entry[0] /= 2
+                if failed:
+                    entry[1] += 1
+                rows.append((origin, entry[0], entry[1]))
+        if self.index is not None and rows:
+            try:
+                self.index.record_mirror_stats(rows)
+            except sqlite3.Error as e:
+                print(f"[WARN] Could not save mirror stats: {e}")
+
+
+class Mirror:
+    """One URL of a transfer, and what it has done during that transfer"""
+
+    def __init__(self, url: str, estimate: Optional[float]):
+        self.url = url
+        self.estimate = estimate  # Throughput per connection known from earlier transfers
+        self.bytes = 0
+        self.seconds = 0.0  # Summed over the connections to this mirror
+        self.connections = 0  # Currently open
+        self.failed = False
+        self.error: Optional[str] = None
+
+    @property
+    def measured_throughput(self) -> Optional[float]:
+        if self.bytes < MIN_SAMPLE_BYTES or self.seconds <= 0:
+            return None
+        return self.bytes / self.seconds
+
+    def to_dict(self) -> dict:
+        throughput = self.measured_throughput or self.estimate
+        return {
+            "url": self.url,
+            "throughput_bps": round(throughput) if throughput else None,
+            "connections": self.connections,
+            "downloaded_bytes": self.bytes,
+            "failed": self.failed,
+            "error": self.error,
+        }
+
+
+class MirrorSet:
+    """
+    The URLs a segmented transfer fetches from. New segments are sized in proportion to
+    the throughput of the mirror each one is given, and the segments of a mirror that
+    fails move to the fastest mirror still working. A download without mirrors is a set
+    of one, whose failure ends the transfer as before.
+    """
+
+    def __init__(self, urls: list[str], stats: MirrorStats, read_timeout: float = 30.0):
+        self.stats = stats
+        self.mirrors = [Mirror(url, stats.get_throughput(url)) for url in urls]
+        # Shorter read timeout with mirrors, so a stalled one is given up before long
+        self.read_timeout = min(read_timeout, MIRROR_STALL_SECONDS) if len(self.mirrors) > 1 else read_timeout
+        known = [mirror.estimate for mirror in self.mirrors if mirror.estimate]
+        self._default_estimate = statistics.median(known) if known else 1.0
+        self._lock = Lock()
+
+    def get_throughput(self, mirror: Mirror) -> float:
+        """Best guess of the throughput per connection of `mirror`"""
+        return mirror.measured_throughput or mirror.estimate or self._default_estimate
+
+    def _ranked(self) -> list[Mirror]:
+        """Working mirrors, fastest first"""
+        working = [mirror for mirror in self.mirrors if not mirror.failed] or self.mirrors
+        return sorted(working, key=self.get_throughput, reverse=True)
+
+    def plan(self, count: int) -> list[Mirror]:
+        """Mirrors of `count` new segments, spread evenly over the fastest ones"""
+        ranked = self._ranked()
+        return [ranked[i % len(ranked)] for i in range(count)]
+
+    def assign(self, segments: list) -> list[Mirror]:
+        """Mirror of each of `segments` (already split), the fastest ones getting the largest remainders"""
+        ranked = self._ranked()
+        assignment = [None] * len(segments)
+        by_size = sorted(range(len(segments)), key=lambda i: segments[i].remaining, reverse=True)
+        for n, i in enumerate(by_size):
+            assignment[i] = ranked[n % len(ranked)]
+        return assignment
+
+    def begin(self, mirror: Mirror):
+        """Records that a connection to `mirror` is opened"""
+        with self._lock:
+            mirror.connections += 1
+
+    def end(self, mirror: Mirror, num_bytes: int, seconds: float):
+        """Records that a connection to `mirror` received `num_bytes` in `seconds` and is closed"""
+        with self._lock:
+            mirror.connections -= 1
+            mirror.bytes += num_bytes
+            mirror.seconds += seconds
+
+    def replace(self, mirror: Mirror, error: Exception) -> Optional[Mirror]:
+        """Marks `mirror` as failed and returns the fastest working one to continue with, if any"""
+        with self._lock:
+            if not mirror.failed:
+                mirror.failed = True
+                mirror.error = str(error)
+        working = [other for other in self.mirrors if not other.failed]
+        return max(working, key=self.get_throughput) if working else None
+
+    def save(self):
+        """Adds what this transfer measured to the shared stats"""
+        if len(self.mirrors) > 1:
+            self.stats.record([(mirror.url, mirror.measured_throughput, mirror.failed) for mirror in self.mirrors])
+
+    def get_status(self) -> list[dict]:
+        return [mirror.to_dict() for mirror in self.mirrors]
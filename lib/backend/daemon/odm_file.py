@@ -1,9 +1,21 @@
+import errno
 import json
+import math
+import os
+import shutil
+import struct
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
-from config import DEFAULT_DOWNLOAD_DIR, DATETIME_FORMAT
+from config import (DEFAULT_DOWNLOAD_DIR, DATETIME_FORMAT, WRITE_BUFFER_SIZE, CHECKPOINT_INTERVAL_BYTES,
+                    CHECKPOINT_INTERVAL_SECONDS, HEADER_VERSION, HEADER_SIZE_V2, PREALLOCATE_DOWNLOADS,
+                    HEAD_TIMEOUT_SECONDS, MAX_MIRRORS, DISK_QUEUE_MAX_BYTES)
+from checksum import Checksum
+from disk_writer import DiskWriterPool, get_shared_writer_pool
+from metrics import CHECKPOINT_SECONDS, CHUNK_WRITE_SECONDS, HEAD_PROBE_SECONDS
+from speed_meter import SpeedMeter
 
 
 # from lib.scripts.daemon.config import DATETIME_FORMAT
@@ -29,6 +41,13 @@ class ODMFile:
             download_dir: str = None,
             datetime_format: str = DATETIME_FORMAT,
             supports_resume: bool = None,
+            segments: Optional[list] = None,
+            header_version: int = HEADER_VERSION,
+            header_size: Optional[int] = None,
+            checksum: Optional[dict] = None,
+            etag: Optional[str] = None,
+            last_modified: Optional[str] = None,
+            mirrors: Optional[list[str]] = None,
     ):
         """Initializes an ODMFile instance."""
 
@@ -45,6 +64,15 @@ class ODMFile:
             completed=completed,
             datetime_format=datetime_format,
             supports_resume=supports_resume,
+            segments=[Segment.from_dict(seg) if isinstance(seg, dict) else seg for seg in segments]
+            if segments is not None else None,
+            version=header_version,
+            header_size=header_size if header_size else Header.DEFAULT_SIZES[header_version],
+            # Files written before checksums existed get one that starts by hashing their payload
+            checksum=Checksum.from_dict(checksum) if isinstance(checksum, dict) else checksum or Checksum(),
+            etag=etag,
+            last_modified=last_modified,
+            mirrors=mirrors,
         )
         # self.url = url
         # self.website = website
@@ -57,28 +85,25 @@ class ODMFile:
         # self.preallocated = preallocated
         # self.completed = completed
         # self.odm_filepath = odm_filepath
-        self._last_bytes_appended = 0
-        self._last_download_speed = 0.0
+        self.speed_meter = SpeedMeter()
         self.odm_filepath = odm_filepath
+        self.on_checkpoint = None  # Called with this file after each header write
+        self._writer: Optional["PayloadWriter"] = None
 
 
-    def get_resume_byte(self) -> int:
-        """Get the index of byte to start writing the payload from"""
+    def get_resume_byte(self, segment: "Segment" = None) -> int:
+        """
+        Get the index of byte to start writing the payload from.
+        If `segment` is given, returns the resume byte of that segment instead.
+        """
+        if segment is not None:
+            return self.header.header_size + segment.start + segment.downloaded
         return self.header.header_size + self.header.downloaded_bytes
 
     @property
     def download_speed(self) -> float:
-        """Returns the last download speed if recent, otherwise 0."""
-        threshold_seconds = 2  # You can adjust this threshold as needed
-        now = datetime.now()
-        try:
-            last_attempt_time = datetime.strptime(self.header.last_attempt, self.header.datetime_format)
-        except Exception:
-            return 0.0
-        time_delta = (now - last_attempt_time).total_seconds()
-        if time_delta <= threshold_seconds:
-            return self._last_download_speed
-        return 0.0
+        """Returns the current download speed in bytes per second, which drops to 0 when no data arrives."""
+        return self.speed_meter.get_speed()
 
     def to_dict(self) -> dict:
         """Converts ODMFile to serializable dict."""
@@ -87,37 +112,95 @@ class ODMFile:
     def get_metadata(self) -> dict:
         return self.to_dict()
 
-    def append_to_payload(self, data: bytes) -> None:
-        """Appends bytes to the ODM payload and updates metadata."""
-        odm_filepath = self.odm_filepath
+    def open_writer(self, **kwargs) -> "PayloadWriter":
+        """
+        Returns the persistent payload writer for this file, opening it if needed.
+        Keyword arguments are passed to PayloadWriter when a new writer is opened.
+        """
+        if self._writer is None or self._writer.closed:
+            if not self.odm_filepath or not Path(self.odm_filepath).exists():
+                raise FileNotFoundError("ODM file does not exist")
+            self._writer = PayloadWriter(self, **kwargs)
+        return self._writer
+
+    def close_writer(self) -> None:
+        """Flushes buffered payload, checkpoints the header and releases the file handle."""
+        if self._writer is not None:
+            self._writer.close()
+
+    def restart_payload(self, file_size: Optional[int] = None, etag: Optional[str] = None,
+                        last_modified: Optional[str] = None, supports_resume: Optional[bool] = None) -> None:
+        """
+        Throws the downloaded payload away so that the download starts over, for a remote
+        file that changed since it was started. The header takes the size and validators
+        of the new version; expected checksums are kept, the computed ones start over.
+        """
+        header = self.header
+        header.file_size = file_size
+        header.etag = etag
+        header.last_modified = last_modified
+        if supports_resume is not None:
+            header.supports_resume = supports_resume
+        self.open_writer().reset(preallocate=header.preallocated)
+
+    def get_writer_stats(self) -> dict:
+        """Returns the I/O statistics of the current (or last) payload writer."""
+        if self._writer is None:
+            return {}
+        return self._writer.get_stats()
+
+    def write_header(self) -> None:
+        """Writes the current header to the start of the ODM file."""
+        if self._writer is not None and not self._writer.closed:
+            self._writer.checkpoint()
+            return
+        padded_header = self.header.to_bytes()
+        if len(padded_header) > self.header.header_size:
+            raise ValueError("Metadata too large for header")
+        with open(self.odm_filepath, "r+b") as f:
+            f.write(padded_header)
+        if self.on_checkpoint:
+            self.on_checkpoint(self)
+
+    def add_expected_checksums(self, digests: dict) -> None:
+        """Expects the payload to match `digests` (algorithm -> hex digest), keeping digests already expected."""
+        if self._writer is not None and not self._writer.closed:
+            self._writer.add_expected_checksums(digests)
+            return
+        _add_expected_checksums(self.header.checksum, digests)
+
+    def finish_checksum(self) -> dict:
+        """
+        Finalizes the checksums of the complete payload and returns them.
+        Raises ChecksumMismatchError if they don't match an expected digest.
+        """
+        checksum = self.header.checksum
+        with open(self.odm_filepath, "rb") as f:
+            # Only reads what the writer couldn't hash in order, and nothing for CRC32
+            results = checksum.finish(f, self.header.header_size, self.header.get_contiguous_bytes())
+        checksum.verify()
+        return results
 
-        if not odm_filepath or not Path(odm_filepath).exists():
-            raise FileNotFoundError("ODM file does not exist")
+    def append_to_payload(self, data: bytes) -> None:
+        """
+        Appends bytes to the ODM payload and updates metadata.
 
-        with open(odm_filepath, "r+b") as f:
-            previous_append_time = datetime.strptime(self.header.last_attempt, self.header.datetime_format)
-
-            # Seek to end of payload
-            f.seek(self.header.header_size + self.header.downloaded_bytes)
-            f.write(data)
-
-            # Update metadata
-            self.header.downloaded_bytes += len(data)
-            self.header.last_attempt = self._get_now()
-
-            # Rewrite updated header
-            # meta_json = json.dumps(self.header.to_dict()).encode("utf-8")
-            # if len(meta_json) > self.header.header_size:
-            #     raise ValueError("Metadata too large for header")
-            # padded_header = meta_json + b'\x00' * (ODMFile.HEADER_LENGTH - len(meta_json))
-            padded_header = self.header.to_bytes()
-            if len(padded_header) > self.header.header_size:
-                raise ValueError("Metadata too large for header")
-            f.seek(0)
-            f.write(padded_header)
+        Writes go through the persistent PayloadWriter, so the data may sit in memory
+        until the next flush and the header is only rewritten at checkpoints. Call
+        close_writer() (or checkpoint on the writer) to make everything durable.
+        """
+        self.open_writer().write(data)
 
     def extract_payload(self, remove_payload_from_odm=True, chunk_size=1048576):
-        """Saves the payload as a file, processing in chunks to minimize memory usage"""
+        """
+        Saves the payload as a file.
+        The payload follows the header, so it can't just be renamed: it is copied by the
+        kernel (copy_file_range, then sendfile) when the platform and filesystem allow it,
+        which also lets copy-on-write filesystems share the blocks instead of duplicating
+        them. Otherwise it falls back to copying in chunks of `chunk_size` bytes. The copy
+        is written under a temporary name and renamed once complete, so the file never
+        shows up partially written.
+        """
         if not self.odm_filepath or not Path(self.odm_filepath).exists():
             raise FileNotFoundError("ODM file does not exist")
 
@@ -133,31 +216,23 @@ class ODMFile:
                 output_path = Path(self.header.download_dir) / f"{stem}_{counter}{suffix}"
                 counter += 1
 
-        # Read payload from ODM file in chunks and write to output file
-        bytes_remaining = self.header.downloaded_bytes
-        with open(self.odm_filepath, "rb") as odm_file:
-            # Skip header to get to payload
-            odm_file.seek(ODMFile.HEADER_SIZE)
-
-            with open(output_path, "wb") as output_file:
-                while bytes_remaining > 0:
-                    # Read chunk (or remaining bytes if less than chunk_size)
-                    bytes_to_read = min(chunk_size, bytes_remaining)
-                    chunk = odm_file.read(bytes_to_read)
-
-                    if not chunk:
-                        break
-
-                    # Write chunk to output file
-                    output_file.write(chunk)
-                    bytes_remaining -= len(chunk)
+        # Copy the payload out of the ODM file, inside the kernel where possible
+        partial_path = output_path.with_name(output_path.name + ".part")
+        try:
+            with open(self.odm_filepath, "rb") as odm_file, open(partial_path, "wb") as output_file:
+                method = _copy_range(odm_file, output_file, self.header.header_size, self.header.downloaded_bytes,
+                                     chunk_size=chunk_size)
+            os.replace(partial_path, output_path)
+        except Exception:
+            partial_path.unlink(missing_ok=True)
+            raise
 
-        print(f"[INFO] Extracted payload to: {output_path}")
+        print(f"[INFO] Extracted payload to: {output_path} (using {method})")
 
         # Optionally remove payload from ODM file, keeping only metadata
         if remove_payload_from_odm:
             with open(self.odm_filepath, "r+b") as f:
-                f.truncate(ODMFile.HEADER_SIZE)
+                f.truncate(self.header.header_size)
             print(f"[INFO] Removed payload from ODM file: {self.odm_filepath}")
 
         return str(output_path)
@@ -165,10 +240,10 @@ class ODMFile:
     @classmethod
     def from_dict(cls, data: dict, filepath: Path):
         """Creates ODMFile from metadata dictionary."""
-        actual_data = {}
+        actual_data = {"header_version": 1}  # Version 1 headers don't record their version
         for key, val in data.items():
-            if key in {"header_size"}:
-                continue
+            if key == "version":
+                key = "header_version"
             actual_data[key] = val
         return cls(**actual_data, odm_filepath=filepath)
 
@@ -187,18 +262,33 @@ class ODMFile:
             website: str = None,
             download_dir: str = None,
             file_size: int = None,
-            preallocated: bool = False,
+            preallocated: bool = None,
             odm_filepath: str = None,
             supports_resume: bool = None,
             auto_request_file_size = True,
             auto_request_file_name = True,
             auto_check_resume_support = True,
+            expected_checksums: dict = None,
+            mirrors: list[str] = None,
 
     ) -> "ODMFile":
-        """Creates a new .odm file and writes initial metadata with proper header padding."""
+        """
+        Creates a new .odm file and writes initial metadata with proper header padding.
+
+        If `preallocated` is set (defaults to PREALLOCATE_DOWNLOADS) and the file size is known,
+        disk space for the whole payload is reserved up front. Raises OSError with ENOSPC,
+        without leaving a file behind, if the reserved space doesn't fit on the disk.
+
+        `expected_checksums` (algorithm -> hex digest) are verified when the download
+        completes, together with the digests announced in the HEAD response headers.
+
+        `mirrors` are other URLs of the same file. Only those with the same size and
+        validators as `url` are kept, see mirrors.check_mirrors.
+        """
 
-        import requests
         import re
+        from checksum import parse_digest_headers
+        from http_pool import get_shared_pool
 
         download_dir = download_dir or str(Path(DEFAULT_DOWNLOAD_DIR).resolve())
         Path(download_dir).mkdir(parents=True, exist_ok=True)
@@ -206,16 +296,24 @@ class ODMFile:
         update_resume_support: bool = supports_resume is None and auto_check_resume_support
         update_file_size: bool = file_size is None and auto_request_file_size
         update_filename: bool = download_filename is None and auto_request_file_name
+        etag = last_modified = None  # Validators used to resume safely, see Header.get_if_range
 
         if update_resume_support or update_file_size or update_filename:
             # Send a HEAD request to check capabilities
             try:
-                head_response = requests.head(url)
+                started = time.perf_counter()
+                head_response = get_shared_pool().head(url, timeout=HEAD_TIMEOUT_SECONDS)
+                HEAD_PROBE_SECONDS.observe(time.perf_counter() - started)
                 head_response.raise_for_status()
             except Exception as e:
                 print(f"Error getting HEAD response: {e}")
                 head_response = None
 
+            if head_response is not None:
+                expected_checksums = {**parse_digest_headers(head_response.headers), **(expected_checksums or {})}
+                etag = head_response.headers.get("ETag")
+                last_modified = head_response.headers.get("Last-Modified")
+
             if update_resume_support and head_response is not None:
                 # Check resume support
                 if 'Accept-Ranges' in head_response.headers:
@@ -234,7 +332,6 @@ class ODMFile:
 
             if update_filename:
                 from urllib.parse import urlparse, unquote
-                import os
 
                 # download_filename =
                 filename = None
@@ -285,6 +382,10 @@ class ODMFile:
                 odm_filepath = Path(download_dir) / f"{download_filename}({num}).odm"
                 num += 1
 
+        if preallocated is None:
+            preallocated = PREALLOCATE_DOWNLOADS
+        preallocated = bool(preallocated and file_size)
+
         print(f"Creating file: '{odm_filepath}'...")
 
         odm_file = ODMFile(
@@ -308,25 +409,49 @@ class ODMFile:
             completed=False,
             odm_filepath=odm_filepath,
             supports_resume=supports_resume,
+            checksum=Checksum(expected=expected_checksums),
+            etag=etag,
+            last_modified=last_modified,
         )
+        if mirrors:
+            from mirrors import check_mirrors
+            mirrors = [mirror for mirror in dict.fromkeys(mirrors) if mirror != url]
+            if len(mirrors) > MAX_MIRRORS:
+                raise ValueError(f"At most {MAX_MIRRORS} mirrors can be given, got {len(mirrors)}")
+            if supports_resume is False:
+                print(f"[WARN] Ignoring the mirrors of '{url}': it doesn't support range requests")
+                mirrors = []
+            odm_file.header.mirrors = check_mirrors(
+                mirrors, file_size, lambda headers: odm_file.header.has_same_validators(headers, mirror=True),
+                expected_digests=odm_file.header.checksum.expected)
+
+        # Space asked to be reserved must be free now, even where it ends up sparse
+        if preallocated:
+            needed = odm_file.header.header_size + file_size
+            if shutil.disk_usage(download_dir).free < needed:
+                raise OSError(errno.ENOSPC, f"Not enough disk space in '{download_dir}' for {needed} bytes")
 
         # Create file with padded header
-        with open(odm_filepath, "wb") as f:
-            f.write(odm_file.header.to_bytes(pad=True))
-            # No payload written initially - file ends after header
+        try:
+            with open(odm_filepath, "w+b") as f:
+                if preallocated:
+                    # The payload region is reserved but not yet valid, progress is tracked by downloaded_bytes.
+                    # The header records whether the blocks were really allocated, or the file is only sparse
+                    odm_file.header.preallocated = _preallocate(f, odm_file.header.header_size + file_size)
+                    f.seek(0)
+                # Otherwise no payload is written initially - file ends after header
+                header_bytes = odm_file.header.to_bytes(pad=True)
+                f.write(header_bytes)
+                # Read back, without parsing it again: the Download opening the file does that
+                f.seek(0)
+                if f.read(len(header_bytes)) != header_bytes:
+                    raise OSError(errno.EIO, f"The header of '{odm_filepath}' didn't read back as written")
+        except OSError:
+            Path(odm_filepath).unlink(missing_ok=True)
+            raise
 
         print(f"[INFO] Created ODM file at: {odm_filepath}")
-
-        # Load and return the file we just created, and perform quick test that it was loaded correctly
-        loaded_odm = ODMFile.load(odm_filepath)
-        assert all([
-            loaded_odm.header.url == url,
-            loaded_odm.header.website == website,
-            loaded_odm.header.downloaded_bytes == 0,
-            loaded_odm.header.download_dir == download_dir,
-            loaded_odm.header.download_filename == download_filename,
-        ]), "ODM file not loaded correctly"
-        return loaded_odm
+        return odm_file
 
     @staticmethod
     def get_download_filename_from_url(url: str) -> str:
@@ -334,28 +459,400 @@ class ODMFile:
 
     @staticmethod
     def load(filepath: str) -> "ODMFile":
-        """Loads an existing .odm file from disk."""
+        """Loads an existing .odm file from disk. Both header versions are detected automatically."""
         path = Path(filepath)
         if not path.exists():
             raise FileNotFoundError(f"No such ODM file: {filepath}")
 
         with open(path, "rb") as f:
-            header = f.read(ODMFile.HEADER_SIZE)
-            if len(header) < ODMFile.HEADER_SIZE:
-                raise ValueError("Invalid ODM file: missing header")
-
-            # Remove null padding and parse JSON
-            meta_json = header.rstrip(b'\x00')
-            data: dict = json.loads(meta_json.decode("utf-8"))
-
+            data = Header.read_dict(f)
             # The rest of the file (if any) is the payload
-            # Current position is already at start of payload
 
         return ODMFile.from_dict(data, filepath=path)
 
+    @staticmethod
+    def migrate(filepath: str, version: int = HEADER_VERSION) -> "ODMFile":
+        """
+        Rewrites the header of an existing .odm file in the given format version.
+
+        The header keeps its current size, so the payload stays where it is and
+        only the start of the file is rewritten.
+        """
+        odm_file = ODMFile.load(filepath)
+        header = odm_file.header
+        if header.version == version:
+            return odm_file
+
+        header.version = version
+        if len(header.to_bytes(pad=False)) > header.header_size:
+            raise ValueError(f"Header does not fit in {header.header_size} bytes as version {version}")
+        with open(odm_file.odm_filepath, "r+b") as f:
+            f.write(header.to_bytes(pad=True))
+        print(f"[INFO] Migrated '{filepath}' to header version {version}")
+        return odm_file
+
+
+class PayloadWriter:
+    """
+    Write-behind writer for the payload of an ODM file.
+
+    Keeps one file handle open for the lifetime of a transfer, coalesces incoming
+    chunks into a memory buffer and only rewrites the header when a checkpoint is
+    due, either after `checkpoint_bytes` new bytes or `checkpoint_interval` seconds.
+    The header is always written after the payload it describes has been flushed,
+    so the recorded progress never runs ahead of the data on disk.
+
+    Full buffers are written by the threads of a DiskWriterPool, through a
+    bounded queue: writing only blocks once the queue is full. A checkpoint waits
+    for the queue to drain, so it is put off while the queue is busy, until it is
+    twice overdue.
+    """
+
+    def __init__(
+            self,
+            odm_file: ODMFile,
+            buffer_size: int = WRITE_BUFFER_SIZE,
+            checkpoint_bytes: int = CHECKPOINT_INTERVAL_BYTES,
+            checkpoint_interval: float = CHECKPOINT_INTERVAL_SECONDS,
+            pool: Optional[DiskWriterPool] = None,
+            queue_bytes: int = DISK_QUEUE_MAX_BYTES,
+    ):
+        self.odm_file = odm_file
+        self.buffer_size = buffer_size
+        self.checkpoint_bytes = checkpoint_bytes
+        self.checkpoint_interval = checkpoint_interval
+
+        self._file = open(odm_file.odm_filepath, "r+b", buffering=0)
+        self._pool = pool or get_shared_writer_pool()
+        self._queue = self._pool.open_queue(self._file, queue_bytes)
+        self._lock = threading.RLock()
+        # Pending payload bytes, one contiguous run per stream (None for the
+        # sequential cursor, otherwise the Segment being written).
+        # Each entry maps to [payload offset of the first buffered byte, buffer]
+        self._buffers: dict = {}
+        self._buffered_bytes = 0
+        self._bytes_since_checkpoint = 0
+        self._last_checkpoint = time.monotonic()
+        self._written_metadata = None  # Last metadata blob written (version 2 headers)
+        self._checkpoint_done = False  # A checkpoint was written that on_checkpoint wasn't called for yet
+
+        # I/O statistics, used to report write amplification. Payload writes are counted by the queue
+        self.header_writes = 0
+        self._observe_write = CHUNK_WRITE_SECONDS.observe
+        self._observe_checkpoint = CHECKPOINT_SECONDS.observe
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def write(self, data: bytes) -> None:
+        """Buffers `data` at the current end of the payload and updates the header counters."""
+        with self._lock:
+            self._buffer_write(None, self.odm_file.header.downloaded_bytes, data)
+        self._notify_checkpoint()
+
+    def write_segment(self, segment: "Segment", data: bytes) -> int:
+        """
+        Buffers `data` at the resume position of `segment` and advances its progress.
+        Bytes past the end of the segment, which moves back when it is split, are dropped.
+        :return: Number of bytes taken
+        """
+        with self._lock:
+            if len(data) > segment.remaining:
+                data = data[:max(segment.remaining, 0)]
+            if data:
+                self._buffer_write(segment, segment.start + segment.downloaded, data)
+                segment.downloaded += len(data)
+        self._notify_checkpoint()
+        return len(data)
+
+    def split_segment(self, segment: "Segment", min_size: int) -> Optional["Segment"]:
+        """
+        Splits the remaining range of `segment` in two (see Header.split_segment) and
+        checkpoints the new layout at once. Returns the new segment, or None.
+        """
+        with self._lock:
+            new_segment = self.odm_file.header.split_segment(segment, min_size)
+            if new_segment is not None:
+                self._checkpoint()
+        self._notify_checkpoint()
+        return new_segment
+
+    def _buffer_write(self, key, offset: int, data: bytes) -> None:
+        started = time.perf_counter()
+        entry = self._buffers.get(key)
+        if entry is not None and entry[0] + len(entry[1]) != offset:
+            self._flush_entry(key)
+            entry = None
+        if entry is None:
+            entry = self._buffers[key] = [offset, bytearray()]
+        entry[1] += data
+        self._buffered_bytes += len(data)
+        self.odm_file.header.downloaded_bytes += len(data)
+        self._bytes_since_checkpoint += len(data)
+
+        if len(entry[1]) >= self.buffer_size:
+            self._flush_entry(key)
+        if self._is_checkpoint_due(1) and (self._is_checkpoint_due(2) or not self._queue.queued_bytes):
+            self._checkpoint()
+        self._observe_write(time.perf_counter() - started)
+
+    def _is_checkpoint_due(self, factor: int) -> bool:
+        return (self._bytes_since_checkpoint >= self.checkpoint_bytes * factor
+                or time.monotonic() - self._last_checkpoint >= self.checkpoint_interval * factor)
+
+    def _flush_entry(self, key) -> None:
+        """Hashes the buffer of stream `key` and hands it to the disk writer pool"""
+        offset, buffer = self._buffers.pop(key)
+        if not buffer:
+            return
+        self.odm_file.header.checksum.update(offset, buffer)
+        self._buffered_bytes -= len(buffer)
+        self._queue.put(self.odm_file.header.header_size + offset, buffer)
+
+    def add_expected_checksums(self, digests: dict) -> None:
+        """Adds expected digests (see ODMFile.add_expected_checksums) between two writes."""
+        with self._lock:
+            _add_expected_checksums(self.odm_file.header.checksum, digests)
+
+    def reset(self, preallocate: bool = False) -> None:
+        """
+        Throws the payload away so that it starts over: drops the buffered and queued bytes,
+        truncates the file after the header and checkpoints a header without progress and
+        with a fresh checksum (expected digests are kept). With `preallocate` the payload
+        region is reserved again, header.preallocated records whether it really was.
+        """
+        with self._lock:
+            self._queue.discard()
+            self._buffers.clear()
+            self._buffered_bytes = 0
+            header = self.odm_file.header
+            header.downloaded_bytes = 0
+            header.segments = None
+            header.checksum = Checksum(header.checksum.algorithms, header.checksum.expected)
+            # Old bytes must not survive past the end of a shorter new version
+            self._file.truncate(header.header_size)
+            header.preallocated = bool(preallocate and header.file_size) and _preallocate(
+                self._file, header.header_size + header.file_size)
+            self._checkpoint()
+        self._notify_checkpoint()
+
+    def flush(self) -> None:
+        """Writes buffered payload bytes to disk without touching the header."""
+        with self._lock:
+            for key in list(self._buffers):
+                self._flush_entry(key)
+            self._queue.drain()
+
+    def checkpoint(self) -> None:
+        """Flushes the payload and persists the header."""
+        with self._lock:
+            self._checkpoint()
+        self._notify_checkpoint()
+
+    def _checkpoint(self) -> None:
+        with self._lock:
+            started = time.perf_counter()
+            self.flush()
+            header = self.odm_file.header
+            header.last_attempt = ODMFile._get_now(header.datetime_format)
+            if header.version >= 2:
+                # Only rewrite the metadata blob when it changed, the hot fields
+                # are then updated in place with a single small write
+                metadata = header.metadata_bytes()
+                if metadata != self._written_metadata:
+                    if Header.V2_METADATA_OFFSET + len(metadata) > header.header_size:
+                        raise ValueError("Metadata too large for header")
+                    _pwrite(self._file, metadata, Header.V2_METADATA_OFFSET)
+                    self._written_metadata = metadata
+                    self.header_writes += 1
+                _pwrite(self._file, header.hot_bytes(len(metadata)), 0)
+            else:
+                padded_header = header.to_bytes()
+                if len(padded_header) > header.header_size:
+                    raise ValueError("Metadata too large for header")
+                _pwrite(self._file, padded_header, 0)
+            self.header_writes += 1
+            self._bytes_since_checkpoint = 0
+            self._last_checkpoint = time.monotonic()
+            self._observe_checkpoint(time.perf_counter() - started)
+            self._checkpoint_done = True
+
+    def _notify_checkpoint(self) -> None:
+        """
+        Calls on_checkpoint for the checkpoints made since the last call. Called once the
+        lock is released, so that a slow callback (the index update) doesn't hold writes back.
+        """
+        if not self._checkpoint_done:
+            return
+        with self._lock:
+            done, self._checkpoint_done = self._checkpoint_done, False
+        if done and self.odm_file.on_checkpoint:
+            self.odm_file.on_checkpoint(self.odm_file)
+
+    def close(self) -> None:
+        """Checkpoints and closes the underlying file handle."""
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self._checkpoint()
+            except OSError:
+                if self._queue.failed:
+                    self._restore_progress()
+                raise
+            finally:
+                self._pool.close_queue(self._queue)
+                self._file.close()
+        self._notify_checkpoint()
+
+    def _restore_progress(self) -> None:
+        """
+        Takes the progress back to the header on disk after queued payload writes failed:
+        that header was written after the payload it describes, the counters in memory weren't.
+        """
+        saved = ODMFile.load(self.odm_file.odm_filepath).header
+        header = self.odm_file.header
+        header.downloaded_bytes = saved.downloaded_bytes
+        header.segments = saved.segments
+        header.checksum = saved.checksum
+        print(f"[WARN] Payload writes of '{header.download_filename}' failed, "
+              f"going back to the last checkpoint ({header.downloaded_bytes} bytes)")
+
+    def get_stats(self) -> dict:
+        """
+        Returns write counters, including the number of write calls per MiB of payload,
+        the bytes waiting in the disk queue and the time spent writing and waiting for it.
+        """
+        queue = self._queue
+        megabytes = queue.bytes_written / (1024 * 1024)
+        total_writes = queue.writes + self.header_writes
+        return {
+            "bytes_written": queue.bytes_written,
+            "payload_writes": queue.writes,
+            "header_writes": self.header_writes,
+            "writes_per_mb": total_writes / megabytes if megabytes else 0.0,
+            "queued_bytes": queue.queued_bytes,
+            "write_seconds": queue.write_seconds,
+            "backpressure_seconds": queue.backpressure_seconds,
+        }
+
+
+def _add_expected_checksums(checksum: Checksum, digests: dict) -> None:
+    for algorithm, digest in digests.items():
+        if algorithm not in checksum.expected:
+            checksum.add_expected(algorithm, digest)
+
+
+def _pwrite(f, data, offset: int) -> None:
+    """Writes `data` at `offset` of the open file `f`, using os.pwrite where available."""
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(f.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        f.seek(offset)
+        f.write(data)
+
+
+def _preallocate(f, size: int) -> bool:
+    """
+    Reserves disk blocks so the open file `f` is `size` bytes long.
+    Falls back to a sparse extension where the platform or filesystem can't allocate.
+    Returns True if the blocks were actually allocated.
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return True
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EFBIG):
+                raise
+    f.truncate(size)
+    return False
+
+
+# Errors meaning a kernel-side copy is not possible here, so the next method should be tried
+_COPY_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+def _copy_range(src, dst, offset: int, count: int, chunk_size: int = 1048576) -> str:
+    """
+    Copies `count` bytes starting at `offset` of the open file `src` to the start of `dst`.
+    Returns the name of the method that completed the copy.
+    """
+    copied = 0
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < count:
+                if method == "copy_file_range":
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), count - copied, offset + copied, copied)
+                else:
+                    dst.seek(copied)
+                    n = os.sendfile(dst.fileno(), src.fileno(), offset + copied, count - copied)
+                if n == 0:
+                    # Source is shorter than expected
+                    return method
+                copied += n
+            return method
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                raise
+
+    # Copy through userspace, continuing after whatever the kernel already copied
+    src.seek(offset + copied)
+    dst.seek(copied)
+    while copied < count:
+        chunk = src.read(min(chunk_size, count - copied))
+        if not chunk:
+            break
+        dst.write(chunk)
+        copied += len(chunk)
+    return "buffered copy"
 
 
 class Header:
+    """
+    Metadata stored at the start of an .odm file.
+
+    Version 1 is a JSON document padded with NULs to `header_size`.
+    Version 2 is binary: a fixed struct with the frequently updated counters,
+    a fixed-capacity segment table, a fixed-capacity table of the CRC32 runs
+    (see Checksum) and a length-prefixed JSON blob holding the remaining
+    fields, padded with NULs to `header_size`:
+
+        [fixed struct, 64 bytes][segment table][CRC32 run table][metadata blob][padding]
+    """
+
+    DEFAULT_SIZES = {1: 128 * 1024, 2: HEADER_SIZE_V2}
+
+    V2_MAGIC = b"\x89ODM"
+    # magic, version, flags, header_size, downloaded_bytes, file_size (-1 if unknown),
+    # created_at, last_attempt (unix timestamps), segment count, metadata length, CRC32 run count
+    V2_FIXED = struct.Struct("<4sHHIQqddIII")
+    V2_FIXED_SIZE = 64
+    V2_SEGMENT = struct.Struct("<QQQ")  # start, end, downloaded
+    V2_MAX_SEGMENTS = 64
+    V2_RUN = struct.Struct("<QQI")  # start, end, CRC32
+    # Every run starts at a segment, there are never more runs than segments
+    V2_MAX_RUNS = V2_MAX_SEGMENTS
+    V2_RUNS_OFFSET = V2_FIXED_SIZE + V2_MAX_SEGMENTS * V2_SEGMENT.size
+    V2_METADATA_OFFSET = V2_RUNS_OFFSET + V2_MAX_RUNS * V2_RUN.size
+
+    FLAG_PREALLOCATED = 1 << 0
+    FLAG_COMPLETED = 1 << 1
+    FLAG_RESUME_KNOWN = 1 << 2
+    FLAG_SUPPORTS_RESUME = 1 << 3
+    FLAG_SEGMENTED = 1 << 4
+
+    # Fields kept in the metadata blob of version 2 headers
+    V2_METADATA_FIELDS = ("url", "download_filename", "website", "download_dir", "datetime_format", "etag",
+                          "last_modified", "mirrors")
+
     def __init__(
             self,
             url: str,
@@ -371,6 +868,12 @@ class Header:
             completed: bool = False,
             datetime_format: str = DATETIME_FORMAT,
             supports_resume: bool = None,
+            segments: Optional[list["Segment"]] = None,
+            version: int = 1,
+            checksum: Optional["Checksum"] = None,
+            etag: Optional[str] = None,
+            last_modified: Optional[str] = None,
+            mirrors: Optional[list[str]] = None,
     ):
         self.url = url
         self.download_filename = download_filename
@@ -385,6 +888,96 @@ class Header:
         self.header_size = header_size
         self.datetime_format = datetime_format
         self.supports_resume = supports_resume
+        self.segments = segments  # None unless the download is segmented
+        self.version = version
+        self.checksum = checksum if checksum is not None else Checksum()
+        # Validators of the remote file the payload comes from, as sent by the server
+        self.etag = etag
+        self.last_modified = last_modified
+        self.mirrors = mirrors or []  # Other URLs serving the same file, checked when the download was created
+
+    @property
+    def urls(self) -> list[str]:
+        """Every URL the payload can be fetched from, the original one first"""
+        return [self.url, *self.mirrors]
+
+    def get_if_range(self, mirror: bool = False) -> Optional[str]:
+        """
+        Value of the If-Range header of a resume request: the ETag if it is a strong
+        one (weak ETags aren't allowed in If-Range), otherwise the Last-Modified date.
+        A `mirror` (another host than `url`) makes its own ETags, so it's only sent the date.
+        """
+        if self.etag and not self.etag.startswith("W/") and not mirror:
+            return self.etag
+        return self.last_modified
+
+    def has_same_validators(self, headers, mirror: bool = False) -> bool:
+        """
+        Whether the validators in response `headers` don't contradict the stored ones.
+        ETags are made by each host, so for a `mirror` a different one proves nothing
+        and Last-Modified decides.
+        """
+        etag = headers.get("ETag")
+        if self.etag and etag and (etag == self.etag or not mirror):
+            return etag == self.etag
+        last_modified = headers.get("Last-Modified")
+        if self.last_modified and last_modified:
+            return last_modified == self.last_modified
+        return True
+
+    def is_same_content(self, headers) -> bool:
+        """Whether response `headers` prove the content is byte for byte the stored one (same strong ETag)."""
+        return bool(self.etag and not self.etag.startswith("W/") and headers.get("ETag") == self.etag)
+
+    def get_contiguous_bytes(self) -> int:
+        """Number of payload bytes downloaded without a gap from the start of the file."""
+        if self.segments is None:
+            return self.downloaded_bytes
+        for segment in self.segments:
+            if not segment.is_complete:
+                return segment.start + segment.downloaded
+        return self.segments[-1].end if self.segments else 0
+
+    def split_into_segments(self, count: int, weights: Optional[list[float]] = None) -> list["Segment"]:
+        """
+        Splits the payload into `count` byte ranges for a segmented download, sized in
+        proportion to `weights` (one per segment) if given, otherwise equally.
+        Bytes already downloaded sequentially are kept in the first segment.
+        """
+        if not self.file_size:
+            raise ValueError("Cannot split a download of unknown size")
+        remaining = self.file_size - self.downloaded_bytes
+        count = max(1, min(count, remaining))
+        weights = list(weights[:count]) if weights else [1.0] * count
+        total_weight = sum(weights)
+        segments = []
+        start = 0
+        cumulative = 0.0
+        for i in range(count):
+            cumulative += weights[i]
+            end = self.file_size if i == count - 1 else self.downloaded_bytes + math.ceil(
+                remaining * cumulative / total_weight)
+            end = min(max(end, start + 1), self.file_size)
+            segments.append(Segment(start, end, self.downloaded_bytes if i == 0 else 0))
+            start = end
+        self.segments = segments
+        return segments
+
+    def split_segment(self, segment: "Segment", min_size: int = 1) -> Optional["Segment"]:
+        """
+        Ends `segment` halfway through its remaining bytes and inserts a new segment holding
+        the second half right after it. Returns the new segment, or None if either half would
+        be smaller than `min_size` or the segment table is full.
+        """
+        if self.segments is None or len(self.segments) >= self.V2_MAX_SEGMENTS:
+            return None
+        if segment.remaining < 2 * min_size:
+            return None
+        middle = segment.end - segment.remaining // 2
+        new_segment = Segment(middle, segment.end)
+        segment.end = middle
+        self.segments.insert(self.segments.index(segment) + 1, new_segment)
+        return new_segment
 
     def to_dict(self) -> dict:
         return {
@@ -399,10 +992,132 @@ class Header:
             "preallocated": self.preallocated,
             "completed": self.completed,
             "header_size": self.header_size,
+            "supports_resume": self.supports_resume,
+            "segments": [segment.to_dict() for segment in self.segments] if self.segments is not None else None,
+            "version": self.version,
+            "checksum": self.checksum.to_dict(),
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "mirrors": self.mirrors,
         }
 
+    def metadata_bytes(self) -> bytes:
+        """Returns the metadata blob of a version 2 header."""
+        metadata = {field: getattr(self, field) for field in self.V2_METADATA_FIELDS}
+        # The checksum progress lives in the run table, so the blob only changes when a checksum is added or finished
+        metadata["checksum"] = self.checksum.to_dict(include_progress=False)
+        return json.dumps(metadata).encode("utf-8")
+
+    def hot_bytes(self, metadata_length: int) -> bytes:
+        """Returns the fixed struct, segment table and CRC32 run table of a version 2 header."""
+        flags = 0
+        if self.preallocated:
+            flags |= self.FLAG_PREALLOCATED
+        if self.completed:
+            flags |= self.FLAG_COMPLETED
+        if self.supports_resume is not None:
+            flags |= self.FLAG_RESUME_KNOWN
+            if self.supports_resume:
+                flags |= self.FLAG_SUPPORTS_RESUME
+        segments = self.segments or []
+        if self.segments is not None:
+            flags |= self.FLAG_SEGMENTED
+        if len(segments) > self.V2_MAX_SEGMENTS:
+            raise ValueError(f"Header can hold at most {self.V2_MAX_SEGMENTS} segments")
+        runs = self.checksum.get_runs()
+        if len(runs) > self.V2_MAX_RUNS:
+            raise ValueError(f"Header can hold at most {self.V2_MAX_RUNS} checksum runs")
+
+        fixed = self.V2_FIXED.pack(
+            self.V2_MAGIC,
+            2,
+            flags,
+            self.header_size,
+            self.downloaded_bytes,
+            self.file_size if self.file_size is not None else -1,
+            self._to_timestamp(self.created_at),
+            self._to_timestamp(self.last_attempt),
+            len(segments),
+            metadata_length,
+            len(runs),
+        )
+        table = b"".join(self.V2_SEGMENT.pack(seg.start, seg.end, seg.downloaded) for seg in segments)
+        run_table = b"".join(self.V2_RUN.pack(*run) for run in runs)
+        return (fixed.ljust(self.V2_FIXED_SIZE, b"\x00") + table).ljust(self.V2_RUNS_OFFSET, b"\x00") + run_table
+
+    def _to_timestamp(self, value: Optional[str]) -> float:
+        if not value:
+            return 0.0
+        return datetime.strptime(value, self.datetime_format).timestamp()
+
+    @classmethod
+    def read_dict(cls, f) -> dict:
+        """
+        Reads a header of either version from the start of the open binary file `f`
+        and returns its fields as a dict, as produced by to_dict().
+        """
+        f.seek(0)
+        start = f.read(cls.V2_FIXED_SIZE)
+        if start[:len(cls.V2_MAGIC)] == cls.V2_MAGIC:
+            return cls._read_dict_v2(f, start)
+
+        # Version 1: read JSON until the NUL padding begins, without loading the whole header
+        data = bytearray(start)
+        while b"\x00" not in data:
+            block = f.read(4096)
+            if not block:
+                break
+            data += block
+        meta_json = bytes(data).split(b"\x00", 1)[0]
+        if not meta_json:
+            raise ValueError("Invalid ODM file: missing header")
+        return json.loads(meta_json.decode("utf-8"))
+
+    @classmethod
+    def _read_dict_v2(cls, f, start: bytes) -> dict:
+        if len(start) < cls.V2_FIXED.size:
+            raise ValueError("Invalid ODM file: truncated header")
+        (_, version, flags, header_size, downloaded_bytes, file_size, created_at, last_attempt,
+         segment_count, metadata_length, run_count) = cls.V2_FIXED.unpack_from(start)
+        if version != 2:
+            raise ValueError(f"Unsupported ODM header version: {version}")
+
+        table = f.read(segment_count * cls.V2_SEGMENT.size)
+        f.seek(cls.V2_RUNS_OFFSET)
+        run_table = f.read(run_count * cls.V2_RUN.size)
+        f.seek(cls.V2_METADATA_OFFSET)
+        data: dict = json.loads(f.read(metadata_length).decode("utf-8"))
+
+        datetime_format = data.get("datetime_format", DATETIME_FORMAT)
+
+        def to_string(timestamp: float) -> Optional[str]:
+            return datetime.fromtimestamp(timestamp).strftime(datetime_format) if timestamp else None
+
+        data.update({
+            "version": version,
+            "header_size": header_size,
+            "downloaded_bytes": downloaded_bytes,
+            "file_size": file_size if file_size >= 0 else None,
+            "created_at": to_string(created_at),
+            "last_attempt": to_string(last_attempt),
+            "preallocated": bool(flags & cls.FLAG_PREALLOCATED),
+            "completed": bool(flags & cls.FLAG_COMPLETED),
+            "supports_resume": bool(flags & cls.FLAG_SUPPORTS_RESUME) if flags & cls.FLAG_RESUME_KNOWN else None,
+            "segments": [
+                {"start": start, "end": end, "downloaded": downloaded}
+                for start, end, downloaded in cls.V2_SEGMENT.iter_unpack(table)
+            ] if flags & cls.FLAG_SEGMENTED else None,
+        })
+        if "checksum" in data:
+            data["checksum"]["runs"] = [list(run) for run in cls.V2_RUN.iter_unpack(run_table)]
+        return data
+
     def to_bytes(self, pad=True) -> bytes:
-        bytes_representation = json.dumps(self.to_dict()).encode("utf-8")
+        if self.version >= 2:
+            metadata = self.metadata_bytes()
+            bytes_representation = self.hot_bytes(len(metadata)).ljust(self.V2_METADATA_OFFSET, b"\x00") + metadata
+        else:
+            bytes_representation = json.dumps(self.to_dict()).encode("utf-8")
         if bytes_representation is None:
             raise RuntimeError("Failed to convert header to bytes")
         if not pad:
@@ -411,5 +1126,32 @@ class Header:
             raise ValueError("Header exceeded size limit")
         return bytes_representation + b'\x00' * (self.header_size - len(bytes_representation))
 
+class Segment:
+    """A byte range [start, end) of the payload, fetched over its own connection."""
+
+    def __init__(self, start: int, end: int, downloaded: int = 0):
+        self.start = start
+        self.end = end
+        self.downloaded = downloaded
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.start - self.downloaded
+
+    @property
+    def is_complete(self) -> bool:
+        return self.remaining <= 0
+
+    def to_dict(self) -> dict:
+        return {"start": self.start, "end": self.end, "downloaded": self.downloaded}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Segment":
+        return cls(data["start"], data["end"], data.get("downloaded", 0))
+
+    def __repr__(self):
+        return f"Segment({self.start}, {self.end}, downloaded={self.downloaded})"
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,96 @@
+import time
+from threading import Lock
+from typing import Optional, Hashable
+
+from config import RATE_LIMIT_BURST_SECONDS
+
+
+def _normalize_rate(rate: Optional[float]) -> Optional[float]:
+    """A rate of zero or less means no limit"""
+    return rate if rate and rate > 0 else None
+
+
+class TokenBucket:
+    """
+    Token bucket limiting a byte rate, implemented as a virtual-time scheduler (GCRA).
+
+    Instead of polling for tokens, callers reserve the bytes they are about to
+    consume and get back how long to wait before doing so. Reservations are
+    served in arrival order, so consumers asking for similar amounts share the
+    rate fairly, and up to `burst_seconds` worth of bytes may be taken at once.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst_seconds: float = RATE_LIMIT_BURST_SECONDS):
+        self._rate = _normalize_rate(rate)
+        self.burst_seconds = burst_seconds
+        self._tat = time.monotonic()  # Theoretical arrival time of the next byte
+        self._lock = Lock()
+
+    @property
+    def rate(self) -> Optional[float]:
+        """Bytes per second, or None if unlimited"""
+        return self._rate
+
+    @rate.setter
+    def rate(self, value: Optional[float]):
+        with self._lock:
+            self._rate = _normalize_rate(value)
+            # Don't make new consumers wait for reservations made at the old rate
+            self._tat = min(self._tat, time.monotonic())
+
+    def reserve(self, amount: int) -> float:
+        """Reserves `amount` bytes and returns the number of seconds to wait before using them."""
+        with self._lock:
+            if not self._rate:
+                return 0.0
+            now = time.monotonic()
+            self._tat = max(self._tat, now) + amount / self._rate
+            return max(0.0, self._tat - now - self.burst_seconds)
+
+
+class RateLimiter:
+    """
+    Hierarchical bandwidth limiter: one global bucket shared by all downloads
+    and an optional bucket per download. A chunk has to fit in both.
+    """
+
+    def __init__(self, global_rate: Optional[float] = None, per_download_rate: Optional[float] = None):
+        self.global_bucket = TokenBucket(global_rate)
+        self.default_per_download_rate = _normalize_rate(per_download_rate)
+        self._buckets: dict[Hashable, TokenBucket] = {}
+        self._lock = Lock()
+
+    def _get_bucket(self, key: Hashable) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.default_per_download_rate)
+            return bucket
+
+    def set_global_rate(self, rate: Optional[float]):
+        """Changes the global limit in bytes per second. None removes it."""
+        self.global_bucket.rate = rate
+
+    def set_rate(self, key: Hashable, rate: Optional[float]):
+        """Changes the limit of one download in bytes per second. None removes it."""
+        self._get_bucket(key).rate = rate
+
+    def get_rate(self, key: Hashable) -> Optional[float]:
+        """Limit of one download, without creating a bucket for it (status reads outlive removed downloads)"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+        return bucket.rate if bucket is not None else self.default_per_download_rate
+
+    def remove(self, key: Hashable):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def reserve(self, key: Hashable, amount: int) -> float:
+        """Reserves `amount` bytes for download `key` and returns how long to wait before using them."""
+        return max(self._get_bucket(key).reserve(amount), self.global_bucket.reserve(amount))
+
+    def throttle(self, key: Hashable, amount: int):
+        """Blocks the calling thread until download `key` may use `amount` more bytes."""
+        delay = self.reserve(key, amount)
+        if delay > 0:
+            time.sleep(delay)
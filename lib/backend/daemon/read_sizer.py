@@ -0,0 +1,71 @@
+import time
+from typing import Optional
+
+from config import (READ_SIZE_MIN, READ_SIZE_MAX, READ_SIZE_INITIAL, READ_TARGET_SECONDS, READ_ADJUST_INTERVAL,
+                    READ_STALL_SECONDS)
+
+
+class ReadSizer:
+    """
+    Chooses how many bytes a receive loop asks for per read.
+
+    Small reads on a fast link cost one Python iteration (and allocation) per
+    few KiB, large reads on a slow or throttled link make progress, pausing and
+    rate limiting jerky. The size follows the measured throughput so that one
+    read takes about `target_seconds`, rounded down to a power of two within
+    [minimum, maximum], and is halved as soon as a read stalls.
+    """
+
+    def __init__(self, initial: Optional[int] = None, minimum: int = READ_SIZE_MIN, maximum: int = READ_SIZE_MAX,
+                 target_seconds: float = READ_TARGET_SECONDS, adjust_interval: float = READ_ADJUST_INTERVAL,
+                 stall_seconds: float = READ_STALL_SECONDS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.adjust_interval = adjust_interval
+        self.stall_seconds = stall_seconds
+        self.size = self._clamp(initial or READ_SIZE_INITIAL)
+        self._window_bytes = 0
+        self._window_start = time.monotonic()
+
+    def _clamp(self, size: int) -> int:
+        return min(max(size, self.minimum), self.maximum)
+
+    def record(self, num_bytes: int, elapsed: float):
+        """Records that a read returned `num_bytes` after `elapsed` seconds and adjusts the size."""
+        now = time.monotonic()
+        if elapsed > self.stall_seconds:
+            self.size = self._clamp(self.size // 2)
+            self._window_bytes = 0
+            self._window_start = now
+            return
+
+        self._window_bytes += num_bytes
+        window = now - self._window_start
+        if window >= self.adjust_interval:
+            desired = int(self._window_bytes / window * self.target_seconds)
+            self.size = self._clamp(1 << max(desired.bit_length() - 1, 0))
+            self._window_bytes = 0
+            self._window_start = now
+
+
+class ReceiveBuffer:
+    """
+    The memory a receive loop reads into, reused by every response of one connection
+    (a stream, or a segment worker with its failovers and stolen ranges). It is only
+    as large as the reads asked of it so far, and doubles when they need more.
+    """
+
+    def __init__(self):
+        self._view = memoryview(bytearray())
+
+    def __len__(self) -> int:
+        return len(self._view)
+
+    def reserve(self, size: int, keep: int = 0) -> memoryview:
+        """Returns the buffer, grown to at least `size` bytes if needed with its first `keep` bytes preserved."""
+        if len(self._view) < size:
+            grown = memoryview(bytearray(max(size, 2 * len(self._view))))
+            grown[:keep] = self._view[:keep]
+            self._view = grown
+        return self._view
@@ -0,0 +1,217 @@
+import heapq
+import itertools
+import random
+import time
+from email.utils import parsedate_to_datetime
+from threading import Condition, Lock, Thread
+from typing import Callable, Hashable, NamedTuple, Optional
+
+from config import RETRY_RULES, RETRY_AFTER_MAX_SECONDS, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS
+
+# Classes of errors that are retried, see RETRY_RULES
+CONNECTION = "connection"
+TIMEOUT = "timeout"
+RATE_LIMITED = "rate_limited"
+SERVER_ERROR = "server_error"
+
+
+def classify_http_status(status: int) -> Optional[str]:
+    """Returns the retry class of an HTTP error status, None if the request shouldn't be repeated."""
+    if status == 429:
+        return RATE_LIMITED
+    if status == 408:
+        return TIMEOUT
+    if 500 <= status < 600 and status not in (501, 505):
+        return SERVER_ERROR
+    return None
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header (delay in seconds or HTTP date), None if unusable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RetryRule(NamedTuple):
+    attempts: int
+    base_delay: float
+    max_delay: float
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed transfer is started again.
+
+    The delay before the n-th consecutive retry is base_delay * 2^(n-1), capped at
+    max_delay, of which a random half is taken away ("equal jitter") so that
+    downloads that failed together don't all come back at the same moment.
+    """
+
+    def __init__(self, rules: dict = None, retry_after_max: float = RETRY_AFTER_MAX_SECONDS):
+        self.rules = {name: RetryRule(*rule) for name, rule in (rules or RETRY_RULES).items()}
+        self.retry_after_max = retry_after_max
+
+    def get_delay(self, error_class: Optional[str], attempt: int, retry_after: float = None) -> Optional[float]:
+        """
+        Seconds to wait before retry number `attempt` (from 1) after an error of `error_class`,
+        at least `retry_after` if the server sent one. None if the error isn't retried (any more).
+        """
+        rule = self.rules.get(error_class)
+        if rule is None or attempt > rule.attempts:
+            return None
+        backoff = min(rule.max_delay, rule.base_delay * 2 ** (attempt - 1))
+        delay = backoff / 2 + random.uniform(0, backoff / 2)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.retry_after_max))
+        return delay
+
+
+class _Circuit:
+    __slots__ = ("failures", "opened_at", "probe_at")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_at: Optional[float] = None  # When the attempt probing a half-open circuit started
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker for retries. A host whose transfers failed
+    `failure_threshold` times in a row is left alone for `reset_seconds`
+    (the circuit is open). Then one retry may probe it (half-open): if that
+    succeeds the circuit closes, if it fails it opens again. A probe that
+    never reports back frees its turn after another `reset_seconds`.
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._circuits: dict[str, _Circuit] = {}
+        self._lock = Lock()
+
+    def record_success(self, host: str):
+        with self._lock:
+            circuit = self._circuits.pop(host, None)
+        if circuit is not None and circuit.opened_at is not None:
+            print(f"[INFO] '{host}' is reachable again, resuming its retries")
+
+    def record_failure(self, host: str):
+        with self._lock:
+            circuit = self._circuits.setdefault(host, _Circuit())
+            circuit.failures += 1
+            if circuit.opened_at is None and circuit.failures < self.failure_threshold:
+                return
+            reopened = circuit.opened_at is not None
+            circuit.opened_at = time.monotonic()
+            circuit.probe_at = None
+        if not reopened:
+            print(f"[WARN] {circuit.failures} transfers from '{host}' failed in a row, "
+                  f"holding its retries for {self.reset_seconds:g}s")
+
+    def get_wait(self, host: str) -> float:
+        """Seconds until an attempt on `host` may start, without taking the probe turn."""
+        with self._lock:
+            return self._get_wait(self._circuits.get(host), time.monotonic())
+
+    def acquire(self, host: str) -> float:
+        """
+        Returns 0 if an attempt on `host` may start now, taking the probe turn of a
+        half-open circuit, or else the number of seconds to wait before asking again.
+        """
+        with self._lock:
+            circuit = self._circuits.get(host)
+            now = time.monotonic()
+            wait = self._get_wait(circuit, now)
+            if wait == 0 and circuit is not None and circuit.opened_at is not None:
+                circuit.probe_at = now
+            return wait
+
+    def _get_wait(self, circuit: Optional[_Circuit], now: float) -> float:
+        if circuit is None or circuit.opened_at is None:
+            return 0.0
+        ready_at = circuit.opened_at + self.reset_seconds
+        if circuit.probe_at is not None:
+            ready_at = max(ready_at, circuit.probe_at + self.reset_seconds)
+        return max(0.0, ready_at - now)
+
+    def get_state(self, host: str) -> str:
+        """closed, open or half_open"""
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.opened_at is None:
+                return "closed"
+            if circuit.probe_at is None and time.monotonic() < circuit.opened_at + self.reset_seconds:
+                return "open"
+            return "half_open"
+
+    @property
+    def open_count(self) -> int:
+        """Number of hosts whose circuit is open or half-open"""
+        with self._lock:
+            return sum(circuit.opened_at is not None for circuit in self._circuits.values())
+
+
+class RetryTimer:
+    """
+    Calls `callback(item)` on a background thread once the delay an item was
+    scheduled with has passed. Scheduling an item again replaces its delay.
+    """
+
+    def __init__(self, callback: Callable[[Hashable], None], name: str = "odm-retry-timer"):
+        self.callback = callback
+        self.name = name
+        self._heap: list[tuple[float, int, Hashable]] = []  # (due time, sequence, item), may hold stale entries
+        self._due: dict[Hashable, float] = {}
+        self._sequence = itertools.count()
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+
+    def schedule(self, item: Hashable, delay: float):
+        with self._condition:
+            due = time.monotonic() + delay
+            self._due[item] = due
+            heapq.heappush(self._heap, (due, next(self._sequence), item))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True, name=self.name)
+                self._thread.start()
+            self._condition.notify()
+
+    def cancel(self, item: Hashable) -> bool:
+        """Unschedules `item`, returning whether it was scheduled"""
+        with self._condition:
+            return self._due.pop(item, None) is not None
+
+    def __len__(self):
+        return len(self._due)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    # Drop entries of items that were cancelled or scheduled again
+                    while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait > 0:
+                        self._condition.wait(wait)
+                        continue
+                    item = heapq.heappop(self._heap)[2]
+                    del self._due[item]
+                    break
+            try:
+                self.callback(item)
+            except Exception as e:
+                print(f"[WARN] Scheduled call of {self.name} failed: {e!r}")
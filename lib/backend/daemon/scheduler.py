@@ -0,0 +1,154 @@
+import heapq
+import itertools
+from threading import RLock
+from typing import Optional
+from urllib.parse import urlparse
+
+from config import MAX_SIMULTANEOUS_DOWNLOADS, MAX_CONNECTIONS_PER_HOST
+
+# Priority levels. Higher priorities are started first, equal priorities in FIFO order
+PRIORITY_LOW = -1
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+
+class DownloadScheduler:
+    """
+    Decides when queued downloads may start.
+
+    At most `max_active` downloads run at once, and the connections opened to
+    one host are capped at `max_connections_per_host` (a host with no active
+    downloads always admits one, so segmented downloads can't starve). Whenever
+    a download finishes, pauses or fails, the next eligible queued one is started.
+    """
+
+    def __init__(self, max_active: int = MAX_SIMULTANEOUS_DOWNLOADS,
+                 max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST):
+        self.max_active = max_active
+        self.max_connections_per_host = max_connections_per_host
+        self._queue: list[tuple[int, int, "Download"]] = []  # Heap of (-priority, sequence, download)
+        self._sequence = itertools.count()
+        self._priorities: dict["Download", int] = {}
+        self._active: dict["Download", int] = {}  # Running downloads and the connections they were granted
+        self._host_connections: dict[str, int] = {}
+        self._lock = RLock()
+        self.version = 0  # Incremented whenever the queue or the set of active downloads changes
+
+    @staticmethod
+    def get_host(download: "Download") -> str:
+        return urlparse(download.header.url).hostname or ""
+
+    @staticmethod
+    def get_connection_count(download: "Download") -> int:
+        """Number of connections `download` opens while it runs."""
+        return download.segment_count if download._use_segments() else 1
+
+    def enqueue(self, download: "Download", priority: int = None):
+        """Queues `download` to be started as soon as the limits allow."""
+        with self._lock:
+            if download in self._active or self.is_queued(download):
+                if priority is not None:
+                    self.set_priority(download, priority)
+                return
+            if priority is not None:
+                self._priorities[download] = priority
+            priority = self._priorities.setdefault(download, PRIORITY_NORMAL)
+            heapq.heappush(self._queue, (-priority, next(self._sequence), download))
+            self.version += 1
+        self.promote()
+
+    def remove(self, download: "Download"):
+        """Takes `download` out of the queue, if it's waiting there."""
+        with self._lock:
+            self._queue = [entry for entry in self._queue if entry[2] is not download]
+            heapq.heapify(self._queue)
+            self.version += 1
+
+    def set_priority(self, download: "Download", priority: int):
+        """Changes the priority of `download`. A queued download keeps its FIFO position among equals."""
+        with self._lock:
+            self._priorities[download] = priority
+            self._queue = [(-priority, seq, d) if d is download else (p, seq, d) for p, seq, d in self._queue]
+            heapq.heapify(self._queue)
+            self.version += 1
+        self.promote()
+
+    def is_queued(self, download: "Download") -> bool:
+        with self._lock:
+            return any(entry[2] is download for entry in self._queue)
+
+    def is_active(self, download: "Download") -> bool:
+        with self._lock:
+            return download in self._active
+
+    @property
+    def active_count(self) -> int:
+        return len(self._active)
+
+    @property
+    def queued_count(self) -> int:
+        return len(self._queue)
+
+    def on_download_stopped(self, download: "Download"):
+        """Frees the slot of a download that finished, paused or failed, and starts the next ones."""
+        with self._lock:
+            if download in self._active:
+                connections = self._active.pop(download)
+                host = self.get_host(download)
+                self._host_connections[host] -= connections
+                if self._host_connections[host] <= 0:
+                    del self._host_connections[host]
+                self.version += 1
+        self.promote()
+
+    def promote(self):
+        """Starts queued downloads while there are free slots."""
+        to_start = []
+        with self._lock:
+            skipped = []
+            while self._queue and len(self._active) < self.max_active:
+                entry = heapq.heappop(self._queue)
+                download = entry[2]
+                host = self.get_host(download)
+                connections = self.get_connection_count(download)
+                in_use = self._host_connections.get(host, 0)
+                if in_use and in_use + connections > self.max_connections_per_host:
+                    # Host is busy, let later downloads from other hosts go ahead
+                    skipped.append(entry)
+                    continue
+                self._active[download] = connections
+                self._host_connections[host] = in_use + connections
+                to_start.append(download)
+            for entry in skipped:
+                heapq.heappush(self._queue, entry)
+            if to_start:
+                self.version += 1
+
+        for download in to_start:
+            download.resume()
+
+    def get_queue_positions(self) -> dict["Download", int]:
+        """Maps each queued download to its 0-based position in the start order."""
+        with self._lock:
+            return {entry[2]: position for position, entry in enumerate(sorted(self._queue))}
+
+    def get_entry_status(self, download: "Download", queue_positions: dict = None) -> dict:
+        """
+        Scheduling state of `download`, merged into the download status.
+        Pass the result of get_queue_positions() when querying many downloads.
+        """
+        if queue_positions is None:
+            queue_positions = self.get_queue_positions()
+        with self._lock:
+            position: Optional[int] = queue_positions.get(download)
+            if download in self._active:
+                state = "active"
+            elif position is not None:
+                state = "queued"
+            else:
+                state = "inactive"
+            return {
+                "queue_state": state,
+                "queue_position": position,
+                "priority": self._priorities.get(download, PRIORITY_NORMAL),
+            }
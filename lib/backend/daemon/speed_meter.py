@@ -0,0 +1,97 @@
+import math
+import time
+from threading import Lock
+from typing import Optional
+
+from config import SPEED_WINDOW_SECONDS, SPEED_WINDOW_BUCKETS, SPEED_SMOOTHING_SECONDS
+
+
+class SpeedMeter:
+    """
+    Measures a transfer rate in constant time per update.
+
+    Bytes are counted into a fixed ring of time buckets covering the last
+    `window` seconds, which gives the instantaneous speed. Every completed
+    bucket is also folded into an exponentially weighted moving average with a
+    time constant of `smoothing_time` seconds, which gives a steadier speed for
+    ETA estimates. Timestamps come from time.monotonic().
+    """
+
+    def __init__(self, window: float = SPEED_WINDOW_SECONDS, buckets: int = SPEED_WINDOW_BUCKETS,
+                 smoothing_time: float = SPEED_SMOOTHING_SECONDS):
+        self.window = window
+        self.bucket_width = window / buckets
+        self._buckets = [0] * buckets
+        self._current: Optional[int] = None  # Absolute index of the bucket being filled
+        self._window_total = 0
+        self._started: Optional[float] = None
+        self._decay = math.exp(-self.bucket_width / smoothing_time)  # EWMA weight kept per bucket
+        self._smoothed = 0.0
+        self._completed_buckets = 0  # Used to correct the average's bias towards its zero start
+        self._lock = Lock()
+
+    def _advance(self, now: float) -> int:
+        """Moves the ring forward to the bucket containing `now` and returns its absolute index."""
+        index = int(now / self.bucket_width)
+        if self._current is None:
+            self._current = index
+            return index
+
+        steps = index - self._current
+        if steps <= 0:
+            return self._current
+
+        size = len(self._buckets)
+        # Fold the bucket that just completed into the average, then decay for the empty ones skipped
+        completed_rate = self._buckets[self._current % size] / self.bucket_width
+        self._smoothed = self._smoothed * self._decay + completed_rate * (1 - self._decay)
+        if steps > 1:
+            self._smoothed *= self._decay ** (steps - 1)
+        self._completed_buckets += steps
+
+        # Clear the buckets that are reused for the new time slots
+        for i in range(self._current + 1, self._current + 1 + min(steps, size)):
+            self._window_total -= self._buckets[i % size]
+            self._buckets[i % size] = 0
+        self._current = index
+        return index
+
+    def update(self, num_bytes: int):
+        """Records that `num_bytes` were transferred just now."""
+        now = time.monotonic()
+        with self._lock:
+            if self._started is None:
+                self._started = now
+            index = self._advance(now)
+            self._buckets[index % len(self._buckets)] += num_bytes
+            self._window_total += num_bytes
+
+    def get_speed(self) -> float:
+        """Instantaneous speed over the last window, in bytes per second."""
+        now = time.monotonic()
+        with self._lock:
+            if self._started is None:
+                return 0.0
+            index = self._advance(now)
+            # The current bucket is only partly elapsed
+            span = (len(self._buckets) - 1) * self.bucket_width + (now - index * self.bucket_width)
+            span = min(span, now - self._started)
+            return self._window_total / span if span > 0 else 0.0
+
+    def get_smoothed_speed(self) -> float:
+        """Exponentially smoothed speed in bytes per second."""
+        with self._lock:
+            if self._started is None:
+                return 0.0
+            self._advance(time.monotonic())
+            weight = 1 - self._decay ** self._completed_buckets
+            return self._smoothed / weight if weight > 0 else 0.0
+
+    def get_eta(self, remaining_bytes: Optional[int]) -> Optional[float]:
+        """Seconds until `remaining_bytes` are transferred at the smoothed speed, or None if unknown."""
+        if remaining_bytes is None:
+            return None
+        if remaining_bytes <= 0:
+            return 0.0
+        speed = self.get_smoothed_speed()
+        return remaining_bytes / speed if speed > 0 else None
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+
+class StatusView:
+    """
+    Versioned, incrementally maintained view of the status of every download.
+
+    Download threads only mark downloads as changed (see mark_dirty). refresh()
+    recomputes the status of the changed downloads, and each field that really
+    changed is stamped with a new view version. Readers get cheap answers from
+    the cached entries: the full list, a filtered page of it, or only the fields
+    changed since a version they already have.
+
+    A download the manager no longer has is dropped from the entries and reported
+    as removed (None instead of its fields) to readers asking for changes. Only the
+    last `max_removed` removals are remembered; a reader further behind than that
+    should fetch the full list again.
+    """
+
+    def __init__(self, manager, max_removed: int = 1000):
+        self.manager = manager
+        self.max_removed = max_removed
+        self.version = 0
+        self._entries: dict[str, dict] = {}  # Latest status per download id
+        self._field_versions: dict[str, dict[str, int]] = {}  # Version at which each field last changed
+        self._recent: OrderedDict[str, int] = OrderedDict()  # Download ids, least recently changed first
+        self._removed_count = 0  # Ids in _recent without an entry
+        self._lock = Lock()
+        self._dirty: set = set()
+        self._dirty_lock = Lock()
+        self._scheduler_version = None
+        manager.add_listener(self.mark_dirty)
+
+    def mark_dirty(self, download):
+        """Records that `download` changed. Safe to call from any thread, cheap enough for every chunk."""
+        with self._dirty_lock:
+            self._dirty.add(download)
+
+    def refresh(self) -> int:
+        """Brings the view up to date with the downloads marked dirty and returns the current version."""
+        with self._lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, set()
+
+            # Queue changes shift the position of every queued download
+            scheduler_version = self.manager.scheduler.version
+            if scheduler_version != self._scheduler_version:
+                self._scheduler_version = scheduler_version
+                dirty.update(self.manager.active_downloads.values())
+
+            if not dirty:
+                return self.version
+
+            queue_positions = self.manager.scheduler.get_queue_positions()
+            version = self.version + 1
+            changed = False
+            for download in dirty:
+                download_id = self.manager.get_download_id(download)
+                if not self.manager.is_listed(download):
+                    changed = self._remove(download_id, version) or changed
+                    continue
+                if download_id not in self._entries and download_id in self._recent:
+                    self._removed_count -= 1  # Added again
+                status = self.manager.get_raw_download_status(download, queue_positions)
+                previous = self._entries.get(download_id, {})
+                field_versions = self._field_versions.setdefault(download_id, {})
+                for key, value in status.items():
+                    if key not in previous or previous[key] != value:
+                        field_versions[key] = version
+                        changed = True
+                        self._recent[download_id] = version
+                        self._recent.move_to_end(download_id)
+                self._entries[download_id] = status
+
+            if changed:
+                self.version = version
+            return self.version
+
+    def _remove(self, download_id: str, version: int) -> bool:
+        """Drops the entry of a removed download and remembers the removal. Returns False if it had no entry."""
+        if self._entries.pop(download_id, None) is None:
+            return False
+        self._field_versions.pop(download_id, None)
+        self._recent[download_id] = version
+        self._recent.move_to_end(download_id)
+        self._removed_count += 1
+        if self._removed_count > self.max_removed:
+            # Forget the oldest removal
+            for old_id in self._recent:
+                if old_id not in self._entries:
+                    del self._recent[old_id]
+                    self._removed_count -= 1
+                    break
+        return True
+
+    def get_changes(self, since: int) -> tuple[int, dict[str, Optional[dict]]]:
+        """
+        Returns the current version and the fields changed after version `since`, per download id.
+        Downloads removed after `since` map to None.
+        """
+        with self._lock:
+            return self.version, self._get_changes(since)
+
+    def _get_changes(self, since: int) -> dict[str, Optional[dict]]:
+        changes = {}
+        # Walk back from the most recently changed download until reaching older changes
+        for download_id, version in reversed(self._recent.items()):
+            if version <= since:
+                break
+            if download_id not in self._entries:
+                changes[download_id] = None
+                continue
+            entry = self._entries[download_id]
+            changes[download_id] = {
+                key: entry[key] for key, field_version in self._field_versions[download_id].items()
+                if field_version > since
+            }
+        return changes
+
+    def get_snapshot(self) -> tuple[int, dict[str, dict]]:
+        """Returns the current version and the full status of every download."""
+        with self._lock:
+            return self.version, {download_id: dict(entry) for download_id, entry in self._entries.items()}
+
+    def query(self, state: str = None, host: str = None, since: int = None, offset: int = 0,
+              limit: Optional[int] = None) -> dict:
+        """
+        Returns a page of the cached statuses.
+        :param state: Only downloads in this state (downloading, queued, retrying, paused, error or completed)
+        :param host: Only downloads from this host
+        :param since: Only downloads changed after this version, with only their changed fields.
+            Downloads removed since then are listed as {"id": ..., "removed": True}, whatever the filters.
+        :param offset: Number of matching downloads to skip
+        :param limit: Maximum number of downloads returned. None returns all of them.
+        """
+        with self._lock:
+            if since is None:
+                candidates = self._entries
+            else:
+                candidates = self._get_changes(since)
+
+            matches = []
+            for download_id, fields in candidates.items():
+                if fields is None:
+                    matches.append({"id": download_id, "removed": True})
+                    continue
+                entry = self._entries[download_id]
+                if state is not None and entry["state"] != state:
+                    continue
+                if host is not None and entry["host"] != host:
+                    continue
+                matches.append({"id": download_id, **fields})
+
+            end = offset + limit if limit is not None else None
+            return {
+                "version": self.version,
+                "total": len(matches),
+                "offset": offset,
+                "limit": limit,
+                "downloads": matches[offset:end],
+            }
@@ -0,0 +1,113 @@
+import sys
+from pathlib import Path
+from threading import Event
+
+import pytest
+from fastapi.testclient import TestClient
+
+# The daemon modules import each other by plain name
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import daemon_main
+from bench_server import BenchServer
+from disk_writer import DiskWriterPool
+from odm_file import ODMFile
+
+
+class FakeClock:
+    """Stands in for the time module of a module under test, time only moves when told to."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def make_odm_file(tmp_path):
+    """Creates an .odm file with an empty payload in tmp_path, without the HEAD request of ODMFile.create_new"""
+
+    def make(name: str = "file.bin", file_size: int = 1 << 20, header_version: int = 1, **fields) -> ODMFile:
+        odm_file = ODMFile(
+            url=f"http://example.com/{name}",
+            download_filename=name,
+            download_dir=str(tmp_path),
+            file_size=file_size,
+            odm_filepath=tmp_path / f"{name}.odm",
+            header_version=header_version,
+            **fields,
+        )
+        with open(odm_file.odm_filepath, "wb") as f:
+            f.write(odm_file.header.to_bytes())
+        return odm_file
+
+    return make
+
+
+@pytest.fixture
+def writer_pool():
+    """A disk writer pool of the test's own, so a failing test can't leave the shared one busy"""
+    return DiskWriterPool(threads=2)
+
+
+def read_payload(odm_file: ODMFile) -> bytes:
+    with open(odm_file.odm_filepath, "rb") as f:
+        f.seek(odm_file.header.header_size)
+        return f.read()
+
+
+def run_server():
+    server = BenchServer()
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def server():
+    """The benchmarks' stand-in download server, with its default (well behaved) settings"""
+    yield from run_server()
+
+
+@pytest.fixture
+def mirror_server():
+    """A second stand-in server, files added to both are mirrors of each other"""
+    yield from run_server()
+
+
+@pytest.fixture
+def serve(server):
+    """Serves a synthetic file of `size` bytes as `name`, returns its URL and its content"""
+
+    def add(name: str, size: int) -> tuple[str, bytes]:
+        file = server.add_file(name, size)
+        return server.url_for(name), b"".join(file.iter_range(0, size))
+
+    return add
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Client of the daemon's HTTP API, without its startup: tests set daemon_main.manager themselves"""
+    ready = Event()
+    ready.set()
+    monkeypatch.setattr(daemon_main, "_services_ready", ready)
+    return TestClient(daemon_main.app)
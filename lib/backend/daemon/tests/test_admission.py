@@ -0,0 +1,114 @@
+import errno
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+
+import daemon_main
+from admission import AdmissionPool, AdmissionQueueFullError
+
+
+def wait_finished(pool, admission, timeout=5.0):
+    pool.shutdown(wait=True)
+    assert admission.finished_at is not None
+
+
+def fake_download(url, **options):
+    header = SimpleNamespace(download_filename=options.get("download_filename") or "file.bin", file_size=1000,
+                             supports_resume=True)
+    return SimpleNamespace(odm_file_path=f"/downloads/{header.download_filename}.odm", header=header)
+
+
+def test_admission_is_accepted_before_the_download_exists():
+    release = Event()
+    changes = []
+
+    def create(url, **options):
+        release.wait(5)
+        return fake_download(url, **options)
+
+    pool = AdmissionPool(create, on_change=lambda admission: changes.append(admission.state))
+    admission = pool.submit("http://example.com/file.bin", download_filename="named.bin")
+    assert admission.state == "admitting"
+    assert pool.get(admission.id) is admission
+    assert admission.get_raw_status()["download_filename"] == "named.bin"
+
+    release.set()
+    wait_finished(pool, admission)
+    status = admission.get_raw_status()
+    assert (status["state"], status["download_id"], status["total_bytes"]) == (
+        "admitted", "/downloads/named.bin.odm", 1000)
+    assert changes == ["admitting", "admitted"]
+    assert pool.pending_count == 0
+
+
+def test_full_queue_refuses_requests():
+    release = Event()
+    pool = AdmissionPool(lambda url, **options: release.wait(5) and fake_download(url), max_workers=1,
+                         max_pending=2)
+    pool.submit("http://example.com/a")
+    pool.submit("http://example.com/b")
+    with pytest.raises(AdmissionQueueFullError):
+        pool.submit("http://example.com/c")
+    assert len(pool.admissions) == 2
+
+    release.set()
+    pool.shutdown(wait=True)
+    assert pool.pending_count == 0
+
+
+@pytest.mark.parametrize("error, message", [
+    (OSError(errno.ENOSPC, "No space left on device"), "Not enough disk space for the download."),
+    (ValueError("bad URL"), "Could not create the download - bad URL"),
+])
+def test_failed_admission_records_the_error(error, message):
+    def create(url, **options):
+        raise error
+
+    pool = AdmissionPool(create)
+    admission = pool.submit("http://example.com/file.bin")
+    wait_finished(pool, admission)
+    assert (admission.state, admission.error) == ("error", message)
+    assert admission.download_id is None
+
+
+def test_finished_admission_is_forgotten_after_the_retention():
+    changes = []
+    expired = Event()
+
+    def on_change(admission):
+        changes.append(admission.state)
+        if pool.get(admission.id) is None:
+            expired.set()
+
+    pool = AdmissionPool(lambda url, **options: fake_download(url), on_change=on_change, retention=0.05)
+    pool.submit("http://example.com/file.bin")
+    assert expired.wait(5)
+    assert changes == ["admitting", "admitted", "admitted"]
+    assert pool.admissions == {}
+
+
+def test_download_endpoint_answers_202_or_503(monkeypatch, api):
+    pool = AdmissionPool(lambda url, **options: fake_download(url), max_pending=1)
+    submitted = []
+
+    def admit_download(url, **options):
+        submitted.append(options)
+        return pool.submit(url, **options)
+
+    monkeypatch.setattr(daemon_main, "manager", SimpleNamespace(admit_download=admit_download, admissions=pool))
+    response = api.post("/download", params={"url": "http://example.com/file.bin", "checksum": "md5:00"})
+    assert response.status_code == 202
+    admission_id = response.json()["id"]
+    assert submitted[0]["checksum"] == "md5:00"
+    pool.shutdown(wait=True)
+    assert api.get(f"/download/{admission_id}").json()["state"] == "admitted"
+    assert api.get("/download/unknown").status_code == 404
+
+    def refuse(url, **options):
+        raise AdmissionQueueFullError("too many")
+
+    monkeypatch.setattr(daemon_main.manager, "admit_download", refuse)
+    response = api.post("/download", params={"url": "http://example.com/file.bin"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
@@ -0,0 +1,57 @@
+import pytest
+import requests
+
+from bench_server import PATTERN_SIZE, SyntheticFile
+from benchmark import compare_with_baseline, percentile
+
+
+def test_synthetic_content_depends_only_on_the_name():
+    file = SyntheticFile("a.bin", PATTERN_SIZE + 100)
+    content = b"".join(file.iter_range(0, file.size, 1000))
+    assert content == b"".join(SyntheticFile("a.bin", file.size).iter_range(0, file.size))
+    assert content != b"".join(SyntheticFile("b.bin", file.size).iter_range(0, file.size))
+    assert content[PATTERN_SIZE:] == content[:100]
+    assert bytes(file.read(PATTERN_SIZE - 10, 50)) == content[PATTERN_SIZE - 10:PATTERN_SIZE + 40]
+
+
+def test_ranges(server, serve):
+    url, content = serve("file.bin", 1000)
+    response = requests.get(url, headers={"Range": "bytes=100-199"})
+    assert (response.status_code, response.content) == (206, content[100:200])
+    assert response.headers["Content-Range"] == "bytes 100-199/1000"
+    assert requests.get(url, headers={"Range": "bytes=-10"}).content == content[-10:]
+    assert requests.get(url, headers={"Range": "bytes=1000-"}).status_code == 416
+
+    server.supports_range = False
+    response = requests.get(url, headers={"Range": "bytes=100-199"})
+    assert (response.status_code, response.content) == (200, content)
+
+
+def test_injected_errors_and_disconnects(server, serve):
+    url, _ = serve("file.bin", 100_000)
+    server.error_rate = 1.0
+    server.error_statuses = (503,)
+    response = requests.get(url)
+    assert (response.status_code, response.headers["Retry-After"]) == (503, "1")
+
+    server.error_rate = 0.0
+    server.disconnect_after = 1000
+    server.disconnect_rate = 1.0
+    with pytest.raises(requests.exceptions.RequestException):
+        requests.get(url)
+    assert server.get_stats()["injected_errors"] == 1
+    assert server.get_stats()["disconnects"] == 1
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([3.0, 1.0, 2.0], 0.5) == 2.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 0.5) == 2.5
+
+
+def test_compare_with_baseline_flags_regressions():
+    baseline = {"results": {"single-large": {"throughput_mb_s": 100.0, "peak_rss_mb": 50.0}}}
+    results = {"single-large": {"throughput_mb_s": 80.0, "peak_rss_mb": 52.0}, "many-small": {}}
+    regressions = compare_with_baseline(results, baseline, tolerance=0.1)
+    assert len(regressions) == 1 and regressions[0].startswith("single-large throughput_mb_s")
+    assert compare_with_baseline(results, baseline, tolerance=0.25) == []
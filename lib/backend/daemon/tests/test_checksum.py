@@ -0,0 +1,177 @@
+import base64
+import hashlib
+import os
+import zlib
+
+import pytest
+
+from checksum import Checksum, ChecksumMismatchError, crc32_combine, parse_checksum, parse_digest_headers
+
+DATA = os.urandom(300_000)
+
+
+def b64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode()
+
+
+@pytest.fixture
+def payload_file(tmp_path):
+    """The payload after a header of 100 bytes, open for reading"""
+    path = tmp_path / "payload"
+    path.write_bytes(b"h" * 100 + DATA)
+    with open(path, "rb") as f:
+        yield f
+
+
+@pytest.fixture
+def empty_file(tmp_path):
+    """Any read from it fails, so a checksum that finishes with it hasn't read anything"""
+    path = tmp_path / "empty"
+    path.write_bytes(b"")
+    with open(path, "rb") as f:
+        yield f
+
+
+@pytest.mark.parametrize("first, second", [(b"", b"x"), (b"hello", b" world"), (b"a", b""),
+                                           (DATA[:1000], DATA[1000:])])
+def test_crc32_combine(first, second):
+    assert crc32_combine(zlib.crc32(first), zlib.crc32(second), len(second)) == zlib.crc32(first + second)
+
+
+def test_sequential_crc32_needs_no_reads(empty_file):
+    checksum = Checksum(["crc32"])
+    for i in range(0, len(DATA), 65536):
+        checksum.update(i, DATA[i:i + 65536])
+    assert checksum.get_runs() == [(0, len(DATA), zlib.crc32(DATA))]
+    assert checksum.finish(empty_file, 100, len(DATA)) == {"crc32": f"{zlib.crc32(DATA):08x}"}
+
+
+def test_segments_merge_into_one_run(empty_file):
+    checksum = Checksum(["crc32"])
+    bounds = [0, 100_000, 200_000, len(DATA)]
+    # Each segment writes in order, the segments interleave
+    for i in range(0, 100_000, 25_000):
+        for start in reversed(bounds[:-1]):
+            checksum.update(start + i, DATA[start + i:start + i + 25_000])
+    assert checksum.get_runs() == [(0, len(DATA), zlib.crc32(DATA))]
+    assert checksum.finish(empty_file, 100, len(DATA))["crc32"] == f"{zlib.crc32(DATA):08x}"
+
+
+def test_rewritten_bytes_are_hashed_once():
+    checksum = Checksum(["crc32"])
+    checksum.update(0, DATA[:1000])
+    checksum.update(500, DATA[500:1500])
+    assert checksum.get_runs() == [(0, 1500, zlib.crc32(DATA[:1500]))]
+
+
+def test_runs_survive_a_restart():
+    checksum = Checksum(["crc32"])
+    checksum.update(0, DATA[:1000])
+    checksum.update(200_000, DATA[200_000:201_000])
+
+    restored = Checksum.from_dict(checksum.to_dict())
+    assert restored.get_runs() == checksum.get_runs()
+    restored.update(1000, DATA[1000:200_000])
+    restored.update(201_000, DATA[201_000:])
+    assert restored.get_runs() == [(0, len(DATA), zlib.crc32(DATA))]
+
+
+def test_gaps_are_read_from_the_file(payload_file):
+    checksum = Checksum(["crc32"])
+    checksum.update(100_000, DATA[100_000:150_000])
+    assert checksum.finish(payload_file, 100, len(DATA), chunk_size=7000)["crc32"] == f"{zlib.crc32(DATA):08x}"
+
+
+def test_hashlib_takes_the_prefix_and_reads_the_rest(payload_file):
+    checksum = Checksum(["crc32", "sha256"])
+    checksum.update(150_000, DATA[150_000:])
+    checksum.update(0, DATA[:150_000])
+    assert checksum.offset == 150_000
+
+    results = checksum.finish(payload_file, 100, len(DATA))
+    assert results == {"crc32": f"{zlib.crc32(DATA):08x}", "sha256": hashlib.sha256(DATA).hexdigest()}
+
+
+def test_hashlib_starts_over_after_a_restart(payload_file):
+    checksum = Checksum(["md5"])
+    checksum.update(0, DATA[:1000])
+    restored = Checksum.from_dict(checksum.to_dict())
+    restored.update(1000, DATA[1000:])
+    assert restored.offset == 0
+    assert restored.finish(payload_file, 100, len(DATA)) == {"md5": hashlib.md5(DATA).hexdigest()}
+
+
+def test_added_algorithm_keeps_the_progress_of_the_others(tmp_path):
+    checksum = Checksum(["sha256"])
+    checksum.update(0, DATA[:200_000])
+    checksum.add_expected("md5", hashlib.md5(DATA).hexdigest())
+    checksum.update(200_000, DATA[200_000:250_000])
+    assert checksum.offset == 0
+
+    # Only md5 reads the first 200 000 bytes back: sha256 would hash the wrong ones
+    path = tmp_path / "payload"
+    path.write_bytes(b"h" * 100 + bytes(200_000) + DATA[200_000:])
+    with open(path, "rb") as f:
+        results = checksum.finish(f, 100, len(DATA), chunk_size=7000)
+    assert results["sha256"] == hashlib.sha256(DATA).hexdigest()
+    assert results["md5"] == hashlib.md5(bytes(200_000) + DATA[200_000:]).hexdigest()
+
+
+def test_added_algorithm_starts_from_the_first_byte(payload_file):
+    checksum = Checksum(["crc32"])
+    checksum.update(0, DATA[:1000])
+    checksum.add_expected("sha1", hashlib.sha1(DATA).hexdigest().upper())
+    checksum.update(1000, DATA[1000:])
+    checksum.finish(payload_file, 100, len(DATA))
+    assert checksum.verified is True
+    checksum.verify()
+
+
+def test_verify_raises_on_mismatch(payload_file):
+    checksum = Checksum(expected={"sha256": "00" * 32})
+    checksum.update(0, DATA)
+    assert checksum.verified is None
+    checksum.finish(payload_file, 100, len(DATA))
+    assert checksum.verified is False
+    with pytest.raises(ChecksumMismatchError):
+        checksum.verify()
+
+
+def test_truncated_payload_raises(payload_file):
+    checksum = Checksum(["sha256"])
+    with pytest.raises(EOFError):
+        checksum.finish(payload_file, 100, len(DATA) + 1)
+
+
+def test_parse_checksum():
+    assert parse_checksum("SHA-256:ABCDEF") == ("sha256", "abcdef")
+    assert parse_checksum("md5=0123") == ("md5", "0123")
+    for spec in ("sha256", "crc32c:1234", "sha256:xyz"):
+        with pytest.raises(ValueError):
+            parse_checksum(spec)
+
+
+def test_parse_digest_headers():
+    sha256 = hashlib.sha256(DATA).digest()
+    md5 = hashlib.md5(DATA).digest()
+    headers = {"Digest": f"SHA-256={b64(sha256)}, unixsum=30637"}
+    assert parse_digest_headers(headers) == {"sha256": sha256.hex()}
+
+    headers = {"Repr-Digest": f"sha-512=:{b64(hashlib.sha512(DATA).digest())}:"}
+    assert parse_digest_headers(headers) == {"sha512": hashlib.sha512(DATA).hexdigest()}
+
+    # crc32c isn't supported, zlib can't compute it
+    headers = {"x-goog-hash": f"crc32c=n03x6A==, md5={b64(md5)}"}
+    assert parse_digest_headers(headers) == {"md5": md5.hex()}
+
+
+def test_content_md5_only_describes_a_full_response():
+    md5 = hashlib.md5(DATA).digest()
+    headers = {"Content-MD5": b64(md5)}
+    assert parse_digest_headers(headers) == {"md5": md5.hex()}
+    assert parse_digest_headers(headers, full_response=False) == {}
+
+
+def test_malformed_digests_are_skipped():
+    assert parse_digest_headers({"Digest": "sha-256=not base64!, md5"}) == {}
+    assert parse_digest_headers({}) == {}
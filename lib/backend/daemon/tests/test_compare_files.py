@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+from compare_files import compare_files, compare_odm_payload, compare_regions, iter_mismatches, main
+
+DATA = os.urandom(10_000)
+
+
+def changed(data: bytes, *ranges) -> bytes:
+    """`data` with the bytes of each [start, end) range inverted"""
+    data = bytearray(data)
+    for start, end in ranges:
+        data[start:end] = bytes(byte ^ 0xFF for byte in data[start:end])
+    return bytes(data)
+
+
+@pytest.fixture
+def write(tmp_path):
+    def write(name: str, data: bytes) -> str:
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path)
+
+    return write
+
+
+def test_runs_are_merged_across_blocks():
+    other = changed(DATA, (5, 9), (100, 120), (9_990, 10_000))
+    assert list(iter_mismatches(DATA, other, block_size=8)) == [(5, 9), (100, 120), (9_990, 10_000)]
+    assert list(iter_mismatches(DATA, DATA, block_size=8)) == []
+
+
+def test_regions_at_different_offsets():
+    assert compare_regions(b"xx" + DATA, DATA, offset_a=2).identical
+    result = compare_regions(b"xx" + DATA, changed(DATA, (50, 60)), offset_a=2)
+    assert (result.ranges, result.differing_bytes) == ([(50, 60)], 10)
+
+
+def test_ranges_are_capped_but_counted():
+    other = changed(DATA, *[(i, i + 1) for i in range(0, 1000, 10)])
+    result = compare_regions(DATA, other, max_ranges=3)
+    assert result.ranges == [(0, 1), (10, 11), (20, 21)]
+    assert (result.total_ranges, result.differing_bytes) == (100, 100)
+
+
+def test_compare_files(write):
+    same = compare_files(write("a", DATA), write("b", DATA), verbose=False)
+    assert same.identical
+
+    shorter = compare_files(write("a", DATA), write("c", changed(DATA, (0, 2))[:9_000]), verbose=False)
+    assert shorter.ranges == [(0, 2), (9_000, 10_000)]
+    assert shorter.to_dict()["differing_bytes"] == 1_002
+
+    assert compare_files(write("empty", b""), write("empty2", b""), verbose=False).identical
+
+
+def test_odm_payload_compares_only_downloaded_ranges(make_odm_file, write):
+    odm_file = make_odm_file(file_size=len(DATA))
+    first, second = odm_file.header.split_into_segments(2)
+    first.downloaded = 3_000
+    second.downloaded = 1_000
+    odm_file.write_header()
+    with open(odm_file.odm_filepath, "r+b") as f:
+        f.seek(odm_file.header.header_size)
+        # Garbage where nothing was downloaded yet
+        f.write(DATA[:3_000] + b"\xff" * 2_000 + changed(DATA[5_000:6_000], (5, 6)) + b"\xff" * 4_000)
+
+    result = compare_odm_payload(odm_file.odm_filepath, write("reference", DATA), verbose=False)
+    assert result.size_a == 4_000
+    assert result.ranges == [(5_005, 5_006)]
+
+
+def test_complete_odm_payload(make_odm_file, write):
+    odm_file = make_odm_file(file_size=len(DATA), downloaded_bytes=len(DATA))
+    with open(odm_file.odm_filepath, "r+b") as f:
+        f.seek(odm_file.header.header_size)
+        f.write(changed(DATA, (9_000, 9_100)))
+
+    result = compare_odm_payload(odm_file.odm_filepath, write("reference", DATA), verbose=False)
+    assert (result.size_a, result.size_b) == (10_000, 10_000)
+    assert result.ranges == [(9_000, 9_100)]
+
+
+@pytest.mark.parametrize("reference, ranges, differing_bytes", [
+    (DATA[:9_000], [(9_000, 10_000)], 1_000),
+    (DATA + b"more", [(10_000, 10_004)], 4),
+], ids=["shorter reference", "longer reference"])
+def test_complete_odm_payload_of_another_length(make_odm_file, write, reference, ranges, differing_bytes):
+    odm_file = make_odm_file(file_size=len(DATA), downloaded_bytes=len(DATA))
+    with open(odm_file.odm_filepath, "r+b") as f:
+        f.seek(odm_file.header.header_size)
+        f.write(DATA)
+
+    result = compare_odm_payload(odm_file.odm_filepath, write("reference", reference), verbose=False)
+    assert (result.ranges, result.total_ranges, result.differing_bytes) == (ranges, 1, differing_bytes)
+
+
+def test_partial_odm_payload_of_a_longer_reference(make_odm_file, write):
+    odm_file = make_odm_file(file_size=len(DATA), downloaded_bytes=4_000)
+    with open(odm_file.odm_filepath, "r+b") as f:
+        f.seek(odm_file.header.header_size)
+        f.write(DATA[:4_000])
+    assert compare_odm_payload(odm_file.odm_filepath, write("reference", DATA), verbose=False).identical
+
+
+def test_main_exit_code(write, capsys):
+    assert main([write("a", DATA), write("b", DATA)]) == 0
+    assert main([write("a", DATA), write("c", changed(DATA, (7, 8))), "--context", "2"]) == 1
+    assert "Range: 7-7" in capsys.readouterr().out
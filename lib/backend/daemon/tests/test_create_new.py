@@ -0,0 +1,128 @@
+import errno
+import os
+from collections import namedtuple
+
+import pytest
+
+import odm_file as odm_module
+from odm_file import ODMFile
+
+DiskUsage = namedtuple("DiskUsage", "total used free")
+
+
+def create(tmp_path, **options) -> ODMFile:
+    """Creates a download whose size, name and resume support are known, so nothing is probed"""
+    options = {"download_filename": "file.bin", "download_dir": str(tmp_path), "file_size": 1 << 20,
+               "supports_resume": True, **options}
+    return ODMFile.create_new("http://example.com/file.bin", **options)
+
+
+def test_new_downloads_keep_the_header_the_app_reads(tmp_path):
+    odm_file = create(tmp_path, preallocated=False)
+    assert ODMFile.load(odm_file.odm_filepath).header.version == 1
+    assert odm_file.header.header_size == 128 * 1024
+
+
+def test_preallocated_file_reserves_the_payload(tmp_path):
+    odm_file = create(tmp_path, preallocated=True)
+    assert os.path.getsize(odm_file.odm_filepath) == odm_file.header.header_size + (1 << 20)
+
+    loaded = ODMFile.load(odm_file.odm_filepath).header
+    assert loaded.preallocated
+    assert loaded.downloaded_bytes == 0
+
+
+def test_file_ends_after_the_header_without_preallocation(tmp_path):
+    odm_file = create(tmp_path, preallocated=False)
+    assert os.path.getsize(odm_file.odm_filepath) == odm_file.header.header_size
+    assert not odm_file.header.preallocated
+
+
+def test_unknown_size_is_not_preallocated(tmp_path):
+    odm_file = create(tmp_path, file_size=None, preallocated=True, auto_request_file_size=False)
+    assert not odm_file.header.preallocated
+
+
+def test_writes_into_preallocated_file(tmp_path):
+    odm_file = create(tmp_path, preallocated=True)
+    odm_file.append_to_payload(b"abc")
+    odm_file.close_writer()
+    assert os.path.getsize(odm_file.odm_filepath) == odm_file.header.header_size + (1 << 20)
+    assert ODMFile.load(odm_file.odm_filepath).header.downloaded_bytes == 3
+
+
+def test_not_enough_free_space(monkeypatch, tmp_path):
+    monkeypatch.setattr(odm_module.shutil, "disk_usage", lambda path: DiskUsage(1 << 30, 1 << 30, 1000))
+    with pytest.raises(OSError) as error:
+        create(tmp_path, preallocated=True)
+    assert error.value.errno == errno.ENOSPC
+    assert not (tmp_path / "file.bin.odm").exists()
+
+
+def test_sparse_file_is_not_held_to_the_free_space(monkeypatch, tmp_path):
+    monkeypatch.setattr(odm_module.shutil, "disk_usage", lambda path: DiskUsage(1 << 30, 1 << 30, 1000))
+    odm_file = create(tmp_path, preallocated=False)
+    assert not odm_file.header.preallocated
+
+
+def test_free_space_must_hold_the_header_too(monkeypatch, tmp_path):
+    header_size = create(tmp_path / "probe", preallocated=False).header.header_size
+    monkeypatch.setattr(odm_module.shutil, "disk_usage",
+                        lambda path: DiskUsage(1 << 30, 1 << 30, (1 << 20) + header_size - 1))
+    with pytest.raises(OSError):
+        create(tmp_path, preallocated=True)
+
+
+def test_free_space_is_checked_without_posix_fallocate(monkeypatch, tmp_path):
+    monkeypatch.delattr(os, "posix_fallocate", raising=False)
+    monkeypatch.setattr(odm_module.shutil, "disk_usage", lambda path: DiskUsage(1 << 30, 1 << 30, 1000))
+    with pytest.raises(OSError) as error:
+        create(tmp_path, preallocated=True)
+    assert error.value.errno == errno.ENOSPC
+
+
+def test_header_records_a_sparse_fallback(monkeypatch, tmp_path):
+    def posix_fallocate(fd, offset, length):
+        raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+    monkeypatch.setattr(os, "posix_fallocate", posix_fallocate, raising=False)
+    odm_file = create(tmp_path, preallocated=True)
+    assert os.path.getsize(odm_file.odm_filepath) == odm_file.header.header_size + (1 << 20)
+    assert not odm_file.header.preallocated
+    assert not ODMFile.load(odm_file.odm_filepath).header.preallocated
+
+
+def test_failed_allocation_leaves_no_file(monkeypatch, tmp_path):
+    def posix_fallocate(fd, offset, length):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(os, "posix_fallocate", posix_fallocate, raising=False)
+    with pytest.raises(OSError):
+        create(tmp_path, preallocated=True)
+    assert not (tmp_path / "file.bin.odm").exists()
+
+
+def test_header_that_does_not_read_back_leaves_no_file(monkeypatch, tmp_path):
+    class ShortReads:
+        """A file whose reads come back one byte short, like a write lost on the way"""
+
+        def __init__(self, f):
+            self._f = f
+
+        def __getattr__(self, name):
+            return getattr(self._f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self._f.close()
+
+        def read(self, size=-1):
+            return self._f.read(size)[:-1]
+
+    monkeypatch.setattr(odm_module, "open", lambda *args, **kwargs: ShortReads(open(*args, **kwargs)), raising=False)
+    with pytest.raises(OSError) as error:
+        create(tmp_path, preallocated=False)
+    assert error.value.errno == errno.EIO
+    assert not (tmp_path / "file.bin.odm").exists()
@@ -0,0 +1,83 @@
+import errno
+import os
+
+import pytest
+
+import disk_writer
+from disk_writer import DiskWriterPool, pwritev
+
+
+def fail_with_enospc(f, buffers, offset):
+    raise OSError(errno.ENOSPC, "No space left on device")
+
+
+@pytest.fixture
+def open_file(tmp_path):
+    with open(tmp_path / "payload", "w+b", buffering=0) as f:
+        yield f
+
+
+def read_all(f) -> bytes:
+    f.seek(0)
+    return f.read()
+
+
+def test_coalesce_groups_adjacent_buffers_in_offset_order():
+    batch = [(200, b"c" * 50), (0, b"a" * 100), (1000, b"x"), (100, b"b" * 100)]
+    assert DiskWriterPool._coalesce(batch) == [
+        (0, [b"a" * 100, b"b" * 100, b"c" * 50]),
+        (1000, [b"x"]),
+    ]
+
+
+def test_coalesce_keeps_gaps_and_overlaps_apart():
+    batch = [(0, b"a" * 10), (11, b"b"), (5, b"c" * 10)]
+    assert DiskWriterPool._coalesce(batch) == [(0, [b"a" * 10]), (5, [b"c" * 10]), (11, [b"b"])]
+
+
+def test_coalesce_caps_buffers_per_write(monkeypatch):
+    monkeypatch.setattr(disk_writer, "IOV_MAX", 2)
+    batch = [(i, b"x") for i in range(5)]
+    assert [len(buffers) for _, buffers in DiskWriterPool._coalesce(batch)] == [2, 2, 1]
+
+
+def test_pwritev_writes_buffers_in_sequence(open_file):
+    pwritev(open_file, [b"hello ", memoryview(b"vectored "), bytearray(b"world")], 3)
+    assert read_all(open_file) == b"\x00\x00\x00hello vectored world"
+
+
+def test_queue_writes_out_of_order_items(open_file):
+    pool = DiskWriterPool(threads=2, write_max_bytes=64 * 1024)
+    queue = pool.open_queue(open_file, max_bytes=256 * 1024)
+    data = os.urandom(1 << 20)
+    chunks = [(i, bytearray(data[i:i + 32 * 1024])) for i in range(0, len(data), 32 * 1024)]
+    for offset, chunk in reversed(chunks):
+        queue.put(offset, chunk)
+    queue.drain()
+
+    assert read_all(open_file) == data
+    assert queue.queued_bytes == 0
+    assert queue.bytes_written == len(data)
+    assert pool.queued_bytes == 0
+    pool.close_queue(queue)
+
+
+def test_failed_write_is_sticky_until_discard(monkeypatch, open_file):
+    pool = DiskWriterPool(threads=1)
+    queue = pool.open_queue(open_file)
+    monkeypatch.setattr(disk_writer, "pwritev", fail_with_enospc)
+    queue.put(0, bytearray(10))
+    with pytest.raises(OSError) as error:
+        queue.drain()
+    assert error.value.errno == errno.ENOSPC
+    assert queue.failed
+    with pytest.raises(OSError):
+        queue.put(0, bytearray(10))
+
+    monkeypatch.undo()
+    queue.discard()
+    assert not queue.failed
+    queue.put(0, bytearray(b"ok"))
+    queue.drain()
+    assert read_all(open_file) == b"ok"
+    pool.close_queue(queue)
@@ -0,0 +1,122 @@
+import os
+
+import pytest
+
+from download_index import DownloadIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = DownloadIndex(tmp_path / "index" / "downloads.db")
+    yield index
+    index.close()
+
+
+def touch_later(path):
+    """Moves the modification time of `path` forward, as a write by another process would"""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_new_database_needs_rebuild(tmp_path, index):
+    assert index.needs_rebuild
+    index.rebuild([tmp_path])
+    assert not index.needs_rebuild
+    index.close()
+    assert not DownloadIndex(index.db_path).needs_rebuild
+
+
+def test_outdated_schema_is_recreated(tmp_path, index, make_odm_file):
+    index.record(make_odm_file(), "paused")
+    index._connection.execute(f"PRAGMA user_version = {DownloadIndex.SCHEMA_VERSION - 1}")
+    index.close()
+
+    reopened = DownloadIndex(index.db_path)
+    assert reopened.needs_rebuild
+    assert reopened.list() == []
+    reopened.close()
+
+
+def test_record_and_list(index, make_odm_file):
+    first = make_odm_file("a.bin")
+    second = make_odm_file("b.bin")
+    index.record(first, "paused")
+    index.record(second, "error", "Connection failed")
+    index.record(first, "downloading")
+
+    assert [row["download_filename"] for row in index.list()] == ["a.bin", "b.bin"]
+    assert [row["path"] for row in index.list(state="error")] == [str(second.odm_filepath)]
+    assert index.list(host="example.com", state="downloading")[0]["download_filename"] == "a.bin"
+    assert index.get(second.odm_filepath)["error"] == "Connection failed"
+
+    index.remove(first.odm_filepath)
+    assert index.get(first.odm_filepath) is None
+
+
+def test_validate_drops_deleted_and_reloads_modified_files(index, make_odm_file):
+    kept = make_odm_file("kept.bin")
+    modified = make_odm_file("modified.bin")
+    deleted = make_odm_file("deleted.bin")
+    for odm_file in (kept, modified, deleted):
+        index.record(odm_file, "paused", "old error")
+
+    os.remove(deleted.odm_filepath)
+    modified.header.downloaded_bytes = 4096
+    modified.header.completed = True
+    modified.write_header()
+    touch_later(modified.odm_filepath)
+
+    assert index.validate() == 2
+    assert index.get(deleted.odm_filepath) is None
+    row = index.get(modified.odm_filepath)
+    assert (row["downloaded_bytes"], row["state"], row["error"]) == (4096, "completed", "old error")
+    assert index.get(kept.odm_filepath)["state"] == "paused"
+    assert index.validate() == 0
+
+
+def test_payload_writes_after_the_last_checkpoint_need_no_reload(index, make_odm_file):
+    odm_file = make_odm_file()
+    index.record(odm_file, "downloading")
+    # A transfer killed after its checkpoint: the payload changed, the header didn't
+    with open(odm_file.odm_filepath, "r+b") as f:
+        f.seek(odm_file.header.header_size)
+        f.write(b"payload")
+    touch_later(odm_file.odm_filepath)
+
+    assert index.validate() == 0
+    assert index.get(odm_file.odm_filepath)["odm_mtime_ns"] == os.stat(odm_file.odm_filepath).st_mtime_ns
+    assert index.get(odm_file.odm_filepath)["state"] == "downloading"
+
+
+def test_validate_drops_unreadable_files(index, make_odm_file):
+    odm_file = make_odm_file()
+    index.record(odm_file, "paused")
+    with open(odm_file.odm_filepath, "wb") as f:
+        f.write(b"not a header")
+    touch_later(odm_file.odm_filepath)
+
+    assert index.validate() == 1
+    assert index.list() == []
+
+
+def test_rebuild_replaces_rows_with_files_found(tmp_path, index, make_odm_file):
+    stale = make_odm_file("stale.bin")
+    index.record(stale, "paused")
+    os.remove(stale.odm_filepath)
+
+    make_odm_file("paused.bin")
+    completed = make_odm_file("done.bin", completed=True)
+    (tmp_path / "broken.bin.odm").write_bytes(b"\x00" * 16)
+
+    assert index.rebuild([tmp_path, tmp_path, tmp_path / "missing"]) == 2
+    states = {row["download_filename"]: row["state"] for row in index.list()}
+    assert states == {"paused.bin": "paused", "done.bin": "completed"}
+    assert index.get(completed.odm_filepath)["completed"] == 1
+
+
+def test_mirror_stats(index):
+    assert index.get_mirror_stats("http://a.example") is None
+    index.record_mirror_stats([("http://a.example", 1000.0, 0)])
+    index.record_mirror_stats([("http://a.example", 2000.0, 1)])
+    stats = index.get_mirror_stats("http://a.example")
+    assert (stats["throughput"], stats["failures"]) == (2000.0, 1)
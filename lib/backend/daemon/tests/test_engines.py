@@ -0,0 +1,388 @@
+import asyncio
+import hashlib
+import time
+import zlib
+from pathlib import Path
+from threading import Event
+
+import pytest
+
+import daemon_main
+import download_manager
+from async_engine import AsyncDownloadManager
+from download_index import DownloadIndex
+from download_manager import DownloadManager
+from metrics import BYTES_RECEIVED
+from odm_file import ODMFile
+from retry import SERVER_ERROR, RetryPolicy
+
+
+@pytest.fixture(params=["threads", "asyncio"])
+def manager(request, tmp_path):
+    index = DownloadIndex(tmp_path / "index" / "downloads.db")
+    if request.param == "threads":
+        manager = DownloadManager(max_simultaneous_downloads=1, index=index)
+    else:
+        manager = AsyncDownloadManager(max_simultaneous_downloads=1, index=index)
+    yield manager
+    if not manager._closed:
+        close(manager)
+    if request.param == "asyncio" and manager.loop is not None:
+        manager.loop.call_soon_threadsafe(manager.loop.stop)
+
+
+def close(manager):
+    """Closes `manager` like the daemon does when it shuts down"""
+    if isinstance(manager, AsyncDownloadManager):
+        if manager.loop is None:
+            manager.index.close()
+            return
+        asyncio.run_coroutine_threadsafe(manager.close(), manager.loop).result(10)
+    else:
+        manager.close()
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(download_manager, "MIN_SEGMENT_SIZE", 256 * 1024)
+
+
+def start(manager, tmp_path, url, expected_checksums=None, mirrors=None, **kwargs):
+    """Creates the .odm file for `url` and a download for it, returns the download and an event set when it ends"""
+    odm_file = ODMFile.create_new(url, download_dir=str(tmp_path), expected_checksums=expected_checksums,
+                                  mirrors=mirrors)
+    download = manager._create_download(odm_file.odm_filepath)
+    ended, errors = Event(), []
+    download.on_complete = ended.set
+    download.on_error = lambda message: (errors.append(message), ended.set())
+    for name, value in kwargs.items():
+        setattr(download, name, value)
+    return download, ended, errors
+
+
+def test_stream_download(manager, tmp_path, serve):
+    url, data = serve("stream.bin", 300 * 1024)
+    download, ended, errors = start(manager, tmp_path, url)
+    assert not download._use_segments()
+    received = BYTES_RECEIVED.labels().get()
+    download.resume()
+
+    assert ended.wait(10) and not errors
+    assert BYTES_RECEIVED.labels().get() - received == len(data)
+    assert (tmp_path / "stream.bin").read_bytes() == data
+    assert ODMFile.load(download.odm_file_path).header.completed
+    # Keys added to the status are snake_case, only the old "supports resume" isn't
+    assert [key for key in download.get_status() if " " in key] == ["supports resume"]
+
+
+def test_status_reads_the_writer_stats_once(manager, tmp_path, serve, monkeypatch):
+    url, _ = serve("stats.bin", 1000)
+    download, _, _ = start(manager, tmp_path, url)
+    calls = []
+    get_writer_stats = download._odm_object.get_writer_stats
+    monkeypatch.setattr(download._odm_object, "get_writer_stats", lambda: calls.append(1) or get_writer_stats())
+    status = download.get_status()
+    assert len(calls) == 1
+    assert (status["writes_per_mb"], status["disk_queue_bytes"]) == (0.0, 0)
+
+
+def test_segmented_download(manager, tmp_path, serve, small_segments):
+    url, data = serve("segmented.bin", 1 << 20)
+    download, ended, errors = start(manager, tmp_path, url, segment_count=4)
+    assert download._use_segments()
+    download.resume()
+
+    assert ended.wait(10) and not errors
+    assert (tmp_path / "segmented.bin").read_bytes() == data
+    segments = ODMFile.load(download.odm_file_path).header.segments
+    assert len(segments) == 4 and all(segment.is_complete for segment in segments)
+
+
+@pytest.mark.parametrize("segment_count", [1, 4])
+def test_paused_download_resumes_where_it_stopped(manager, tmp_path, server, serve, small_segments, segment_count):
+    url, data = serve("paused.bin", 1 << 20)
+    server.bandwidth = 512 * 1024
+    progressed = Event()
+    download, ended, errors = start(manager, tmp_path, url, segment_count=segment_count,
+                                    on_progress=lambda downloaded: progressed.set())
+    download.resume()
+    assert progressed.wait(10)
+    download.pause()
+
+    assert not ended.is_set()
+    assert 0 < ODMFile.load(download.odm_file_path).header.downloaded_bytes < len(data)
+
+    server.bandwidth = None
+    download.resume()
+    assert ended.wait(10) and not errors
+    assert (tmp_path / "paused.bin").read_bytes() == data
+
+
+@pytest.mark.parametrize("manager", ["asyncio"], indirect=True)
+def test_pause_on_the_download_loop_does_not_block_it(manager, tmp_path, server, serve):
+    url, data = serve("loop.bin", 1 << 20)
+    server.bandwidth = 256 * 1024
+    progressed, returned = Event(), Event()
+    download, ended, errors = start(manager, tmp_path, url, on_progress=lambda downloaded: progressed.set())
+    download.resume()
+    assert progressed.wait(10)
+
+    manager.call_soon(lambda: (download.pause(), returned.set()))
+    assert returned.wait(5)
+    assert download._stopped.wait(5)
+    assert 0 < ODMFile.load(download.odm_file_path).header.downloaded_bytes < len(data)
+
+    server.bandwidth = None
+    download.resume()
+    assert ended.wait(10) and not errors
+    assert (tmp_path / "loop.bin").read_bytes() == data
+
+
+def pause_partway(server, download, progressed):
+    download.resume()
+    assert progressed.wait(10)
+    download.pause()
+    server.bandwidth = None
+
+
+@pytest.mark.parametrize("segment_count", [1, 4])
+def test_file_replaced_while_paused_is_downloaded_again(manager, tmp_path, server, serve, small_segments,
+                                                         segment_count):
+    url, _ = serve("replaced.bin", 1 << 20)
+    server.bandwidth = 512 * 1024
+    progressed = Event()
+    download, ended, errors = start(manager, tmp_path, url, segment_count=segment_count,
+                                    on_progress=lambda downloaded: progressed.set())
+    pause_partway(server, download, progressed)
+
+    new_version = server.replace_file("replaced.bin")
+    download.resume()
+    assert ended.wait(10) and not errors
+    assert (tmp_path / "replaced.bin").read_bytes() == b"".join(new_version.iter_range(0, new_version.size))
+
+
+def test_server_that_stops_honouring_ranges(manager, tmp_path, server, serve):
+    url, data = serve("unranged.bin", 1 << 20)
+    server.bandwidth = 512 * 1024
+    progressed = Event()
+    download, ended, errors = start(manager, tmp_path, url, on_progress=lambda downloaded: progressed.set())
+    pause_partway(server, download, progressed)
+
+    server.supports_range = False
+    download.resume()
+    assert ended.wait(10) and not errors
+    assert (tmp_path / "unranged.bin").read_bytes() == data
+
+
+def test_speed_limit_holds_the_download_back(manager, tmp_path, serve):
+    url, data = serve("limited.bin", 256 * 1024)
+    manager.set_speed_limit(256 * 1024)
+    download, ended, errors = start(manager, tmp_path, url)
+    started = time.monotonic()
+    download.resume()
+
+    assert ended.wait(10) and not errors
+    assert time.monotonic() - started >= 0.8
+    assert (tmp_path / "limited.bin").read_bytes() == data
+
+
+@pytest.mark.parametrize("segment_count", [1, 4])
+def test_checksum_is_verified_on_completion(manager, tmp_path, serve, small_segments, segment_count):
+    url, data = serve("checked.bin", 1 << 20)
+    download, ended, errors = start(manager, tmp_path, url, segment_count=segment_count,
+                                    expected_checksums={"sha256": hashlib.sha256(data).hexdigest()})
+    download.resume()
+
+    assert ended.wait(10) and not errors
+    header = ODMFile.load(download.odm_file_path).header
+    assert header.checksum.verified
+    assert header.checksum.results["crc32"] == f"{zlib.crc32(data):08x}"
+
+
+def test_checksum_mismatch_fails_the_download(manager, tmp_path, serve):
+    url, _ = serve("corrupt.bin", 100 * 1024)
+    download, ended, errors = start(manager, tmp_path, url, expected_checksums={"md5": "00" * 16})
+    download.resume()
+
+    assert ended.wait(10)
+    assert len(errors) == 1 and "corrupt" in errors[0]
+    assert not (tmp_path / "corrupt.bin").exists()
+
+
+def test_missing_file_reports_an_error(manager, tmp_path, server):
+    odm_file = ODMFile.create_new(server.url_for("missing.bin"), download_dir=str(tmp_path),
+                                  download_filename="missing.bin", file_size=1000, supports_resume=True)
+    download = manager._create_download(odm_file.odm_filepath)
+    ended, errors = Event(), []
+    download.on_error = lambda message: (errors.append(message), ended.set())
+    download.resume()
+
+    assert ended.wait(10)
+    assert len(errors) == 1 and "(404)" in errors[0]
+    assert not (tmp_path / "missing.bin").exists()
+
+
+def test_failing_mirror_hands_its_segments_over(manager, tmp_path, server, mirror_server, serve, small_segments):
+    url, data = serve("mirrored.bin", 1 << 20)
+    mirror_server.add_file("mirrored.bin", len(data))
+    download, ended, errors = start(manager, tmp_path, url, mirrors=[mirror_server.url_for("mirrored.bin")],
+                                    segment_count=4)
+    assert download.header.mirrors == [mirror_server.url_for("mirrored.bin")]
+    mirror_server.error_rate = 1.0
+    download.resume()
+
+    assert ended.wait(10) and not errors
+    assert (tmp_path / "mirrored.bin").read_bytes() == data
+    primary, mirror = download.get_raw_status()["mirrors"]
+    assert mirror["failed"] and not primary["failed"]
+    assert primary["downloaded_bytes"] == len(data)
+
+
+def test_mirror_with_its_own_etags_serves_its_segments(manager, tmp_path, server, mirror_server, serve,
+                                                        small_segments):
+    url, data = serve("etags.bin", 1 << 20)
+    mirror_server.etag_prefix = "mirror-"
+    mirror_server.add_file("etags.bin", len(data))
+    download, ended, errors = start(manager, tmp_path, url, mirrors=[mirror_server.url_for("etags.bin")],
+                                    segment_count=4)
+    assert download.header.mirrors == [mirror_server.url_for("etags.bin")]
+    download.resume()
+
+    assert ended.wait(10) and not errors
+    assert (tmp_path / "etags.bin").read_bytes() == data
+    primary, mirror = download.get_raw_status()["mirrors"]
+    assert not mirror["failed"] and mirror["downloaded_bytes"] > 0
+
+
+def test_idle_connection_takes_over_part_of_a_slow_one(manager, tmp_path, server, mirror_server, serve,
+                                                      small_segments):
+    url, data = serve("stolen.bin", 2 << 20)
+    mirror_server.add_file("stolen.bin", len(data))
+    mirror_server.bandwidth = 128 * 1024
+    download, ended, errors = start(manager, tmp_path, url, mirrors=[mirror_server.url_for("stolen.bin")],
+                                    segment_count=2)
+    download.resume()
+
+    # Without help the slow mirror would need 8 seconds for its half
+    assert ended.wait(6) and not errors
+    assert (tmp_path / "stolen.bin").read_bytes() == data
+    segments = ODMFile.load(download.odm_file_path).header.segments
+    assert len(segments) > 2 and all(segment.is_complete for segment in segments)
+
+
+def test_failed_transfer_is_retried(manager, tmp_path, server, serve):
+    url, data = serve("retried.bin", 100 * 1024)
+    manager.retry_policy = RetryPolicy({SERVER_ERROR: (3, 0.05, 0.05)}, retry_after_max=0.1)
+    server.error_rate = 1.0
+    server.error_statuses = (503,)
+    download, failed, errors = start(manager, tmp_path, url)
+    completed = Event()
+    download.on_complete = completed.set
+    download.resume()
+
+    assert failed.wait(10) and "503" in errors[0]
+    server.error_rate = 0.0
+    assert completed.wait(10)
+    assert download.retry_count >= 1 and download.next_retry_at is None
+    assert (tmp_path / "retried.bin").read_bytes() == data
+
+
+def test_queued_download_starts_when_the_active_one_finishes(manager, tmp_path, server, serve):
+    server.bandwidth = 1 << 20
+    ended = {}
+    for name in ("first.bin", "second.bin"):
+        url, _ = serve(name, 200 * 1024)
+        odm_file = ODMFile.create_new(url, download_dir=str(tmp_path))
+        manager.add_download(odm_file.odm_filepath, start=False)
+        download = manager.active_downloads[Path(odm_file.odm_filepath).resolve()]
+        ended[name] = Event()
+        download.on_complete = ended[name].set
+        manager.resume_download(odm_file.odm_filepath)
+
+    states = [status["queue_state"] for status in manager.get_status().values()]
+    assert states == ["active", "queued"]
+    assert ended["first.bin"].wait(10) and ended["second.bin"].wait(10)
+
+
+def test_index_follows_the_download_state(manager, tmp_path, serve):
+    url, _ = serve("indexed.bin", 100 * 1024)
+    odm_file = ODMFile.create_new(url, download_dir=str(tmp_path))
+    manager.add_download(odm_file.odm_filepath, start=False)
+    assert [row["state"] for row in manager.list_downloads()] == ["paused"]
+
+    download = manager.active_downloads[Path(odm_file.odm_filepath).resolve()]
+    finished = Event()
+    download.on_finish = lambda download: (manager._on_download_finished(download), finished.set())
+    manager.resume_download(odm_file.odm_filepath)
+    assert finished.wait(10)
+    row = manager.list_downloads(state="completed")[0]
+    assert (row["download_filename"], row["downloaded_bytes"], row["completed"]) == ("indexed.bin", 100 * 1024, 1)
+
+
+def test_removed_download_is_forgotten(manager, tmp_path, serve):
+    url, _ = serve("removed.bin", 100 * 1024)
+    odm_file = ODMFile.create_new(url, download_dir=str(tmp_path))
+    download = manager.add_download(odm_file.odm_filepath, start=False)
+    manager.set_speed_limit(1000, odm_file_path=odm_file.odm_filepath)
+    assert manager.index.get(download.odm_file_path) is not None
+
+    manager.remove_download(odm_file.odm_filepath)
+    assert manager.get_download(odm_file.odm_filepath) is None
+    assert download not in manager.rate_limiter._buckets
+    assert manager.index.get(download.odm_file_path) is None
+    assert Path(download.odm_file_path).exists()
+    with pytest.raises(KeyError):
+        manager.remove_download(odm_file.odm_filepath)
+
+
+def test_finished_download_leaves_no_bucket_behind(manager, tmp_path, serve):
+    url, _ = serve("limited.bin", 100 * 1024)
+    odm_file = ODMFile.create_new(url, download_dir=str(tmp_path))
+    completed = Event()
+    # Like the status view, which reads the status of every download that changed
+    manager.add_listener(lambda download: (manager.get_raw_download_status(download)["state"] == "completed"
+                                           and not manager.scheduler.is_active(download) and completed.set()))
+    download = manager.add_download(odm_file.odm_filepath, start=False)
+    manager.set_speed_limit(10 << 20, odm_file_path=odm_file.odm_filepath)
+    assert download in manager.rate_limiter._buckets
+    manager.resume_download(odm_file.odm_filepath)
+
+    assert completed.wait(10)
+    assert download not in manager.rate_limiter._buckets
+
+
+def test_speed_limit_of_an_unknown_download(manager, monkeypatch, api):
+    monkeypatch.setattr(daemon_main, "manager", manager)
+    with pytest.raises(KeyError):
+        manager.set_speed_limit(1000, odm_file_path="/nowhere/file.bin.odm")
+    response = api.post("/speed_limit", params={"limit": 1000, "odm_filepath": "/nowhere/file.bin.odm"})
+    assert response.status_code == 404
+    assert api.post("/speed_limit", params={"limit": 1000}).json()["status"] == "ok"
+    assert manager.rate_limiter.global_bucket.rate == 1000
+
+
+def test_close_stops_the_transfers_and_keeps_their_state(manager, tmp_path, server, serve):
+    server.bandwidth = 256 * 1024
+    paths = []
+    for name in ("running.bin", "waiting.bin"):
+        url, _ = serve(name, 1 << 20)
+        paths.append(ODMFile.create_new(url, download_dir=str(tmp_path)).odm_filepath)
+        manager.add_download(paths[-1], start=False)
+    running, waiting = (manager.get_download(path) for path in paths)
+    progressed = Event()
+    manager.add_listener(lambda download: download is running and running.is_downloading and progressed.set())
+    for path in paths:
+        manager.resume_download(path)
+    assert progressed.wait(10)
+
+    close(manager)
+    assert not running.is_downloading and not waiting.is_downloading
+    assert 0 < ODMFile.load(paths[0]).header.downloaded_bytes < 1 << 20
+    assert ODMFile.load(paths[1]).header.downloaded_bytes == 0
+    # The next start resumes both, in the same order
+    index = DownloadIndex(tmp_path / "index" / "downloads.db")
+    try:
+        assert {Path(row["path"]).name: row["state"] for row in index.list()} == {
+            "running.bin.odm": "downloading", "waiting.bin.odm": "queued"}
+    finally:
+        index.close()
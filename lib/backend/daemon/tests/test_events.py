@@ -0,0 +1,165 @@
+import asyncio
+from types import SimpleNamespace
+
+from fastapi import WebSocketDisconnect
+
+from events import EventHub, Subscriber
+from status_view import StatusView
+
+
+class FakeManager:
+    """What the status view uses of a DownloadManager, with downloads identified by name"""
+
+    def __init__(self, **statuses):
+        self.statuses = statuses
+        self.scheduler = SimpleNamespace(version=0, get_queue_positions=dict)
+        self.listeners = []
+
+    @property
+    def active_downloads(self) -> dict:
+        return {name: name for name in self.statuses}
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def get_download_id(self, download) -> str:
+        return download
+
+    def is_listed(self, download) -> bool:
+        return download in self.statuses
+
+    def get_raw_download_status(self, download, queue_positions) -> dict:
+        return dict(self.statuses[download])
+
+
+class FakeWebSocket:
+    def __init__(self, send_delay: float = 0.0):
+        self.sent = []
+        self.send_delay = send_delay
+        self.disconnected = asyncio.Event()
+
+    async def send_json(self, message):
+        await asyncio.sleep(self.send_delay)
+        self.sent.append(message)
+
+    async def send_text(self, message):
+        self.sent.append(message)
+
+    async def receive_text(self):
+        await self.disconnected.wait()
+        raise WebSocketDisconnect()
+
+
+def test_publish_sends_only_changed_fields():
+    manager = FakeManager(a={"downloaded_bytes": 0, "status": "Paused"})
+    hub = EventHub(StatusView(manager))
+    subscriber = Subscriber(None)
+    hub.subscribers.append(subscriber)
+    hub.publish()
+    assert subscriber.take_pending()[0] == {"a": {"downloaded_bytes": 0, "status": "Paused"}}
+
+    manager.statuses["a"]["downloaded_bytes"] = 100
+    manager.listeners[0]("a")
+    hub.publish()
+    assert subscriber.take_pending()[0] == {"a": {"downloaded_bytes": 100}}
+
+    # Nothing changed
+    version = hub.version
+    manager.listeners[0]("a")
+    hub.publish()
+    assert hub.version == version
+    assert subscriber.take_pending()[0] == {}
+
+
+def test_scheduler_change_republishes_every_download():
+    manager = FakeManager(a={"queue_position": 0}, b={"queue_position": 1})
+    hub = EventHub(StatusView(manager))
+    hub.publish()
+    subscriber = Subscriber(None)
+    hub.subscribers.append(subscriber)
+
+    manager.statuses["b"]["queue_position"] = 0
+    manager.scheduler.version += 1
+    hub.publish()
+    assert subscriber.take_pending()[0] == {"b": {"queue_position": 0}}
+
+
+def test_pending_changes_keep_only_the_latest_values():
+    subscriber = Subscriber(None)
+    subscriber.queue({"a": {"downloaded_bytes": 100, "status": "In progress"}})
+    subscriber.queue({"a": {"downloaded_bytes": 200}, "b": {"status": "Paused"}})
+    assert subscriber.wakeup.is_set()
+    changes, _ = subscriber.take_pending()
+    assert changes == {"a": {"downloaded_bytes": 200, "status": "In progress"}, "b": {"status": "Paused"}}
+    assert not subscriber.wakeup.is_set()
+
+
+def test_removal_replaces_pending_changes():
+    subscriber = Subscriber(None)
+    subscriber.queue({"a": {"downloaded_bytes": 100}})
+    subscriber.queue({"a": None})
+    assert subscriber.take_pending()[0] == {"a": None}
+
+    # Added again after its removal was queued: the new fields stand alone
+    subscriber.queue({"a": None})
+    subscriber.queue({"a": {"status": "Paused"}})
+    assert subscriber.take_pending()[0] == {"a": {"status": "Paused"}}
+
+
+def test_removed_download_is_published_as_null():
+    manager = FakeManager(a={"downloaded_bytes": 0}, b={"downloaded_bytes": 0})
+    hub = EventHub(StatusView(manager))
+    hub.publish()
+    subscriber = Subscriber(None)
+    hub.subscribers.append(subscriber)
+
+    del manager.statuses["a"]
+    manager.listeners[0]("a")
+    hub.publish()
+    assert subscriber.take_pending()[0] == {"a": None}
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met in time")
+
+
+def test_client_gets_a_snapshot_then_updates():
+    async def run():
+        manager = FakeManager(a={"downloaded_bytes": 0})
+        hub = EventHub(StatusView(manager))
+        hub.publish()
+        websocket = FakeWebSocket()
+        served = asyncio.ensure_future(hub.serve(websocket))
+        await wait_for(lambda: len(websocket.sent) == 1)
+
+        manager.statuses["a"]["downloaded_bytes"] = 10
+        manager.listeners[0]("a")
+        hub.publish()
+        await wait_for(lambda: len(websocket.sent) == 2)
+
+        websocket.disconnected.set()
+        await asyncio.wait_for(served, 5)
+        return hub, websocket.sent
+
+    hub, sent = asyncio.run(run())
+    assert sent == [
+        {"type": "snapshot", "version": 1, "downloads": {"a": {"downloaded_bytes": 0}}},
+        {"type": "update", "version": 2, "downloads": {"a": {"downloaded_bytes": 10}}},
+    ]
+    assert hub.subscribers == []
+
+
+def test_slow_client_is_dropped():
+    async def run():
+        hub = EventHub(StatusView(FakeManager()), send_timeout=0.05)
+        websocket = FakeWebSocket(send_delay=10.0)
+        await asyncio.wait_for(hub.serve(websocket), 5)
+        return hub, websocket.sent
+
+    hub, sent = asyncio.run(run())
+    assert sent == []
+    assert hub.subscribers == []
@@ -0,0 +1,109 @@
+import errno
+import os
+
+import pytest
+
+from odm_file import ODMFile, _copy_range
+
+DATA = os.urandom(300_000)
+
+
+@pytest.fixture
+def source(tmp_path):
+    """A file holding DATA after 1000 bytes of header, open for reading"""
+    path = tmp_path / "source"
+    path.write_bytes(b"h" * 1000 + DATA)
+    with open(path, "rb") as f:
+        yield f
+
+
+@pytest.fixture
+def target(tmp_path):
+    with open(tmp_path / "target", "w+b") as f:
+        yield f
+
+
+def read_all(f) -> bytes:
+    f.flush()
+    f.seek(0)
+    return f.read()
+
+
+def without(monkeypatch, *names):
+    for name in names:
+        monkeypatch.delattr(os, name, raising=False)
+
+
+@pytest.mark.parametrize("method, missing", [
+    ("copy_file_range", ()),
+    ("sendfile", ("copy_file_range",)),
+    ("buffered copy", ("copy_file_range", "sendfile")),
+])
+def test_copy_range_methods(monkeypatch, source, target, method, missing):
+    if method != "buffered copy" and not hasattr(os, method):
+        pytest.skip(f"os.{method} is not available here")
+    without(monkeypatch, *missing)
+    assert _copy_range(source, target, 1000, len(DATA), chunk_size=7000) == method
+    assert read_all(target) == DATA
+
+
+def test_copy_range_stops_at_end_of_source(monkeypatch, source, target):
+    without(monkeypatch, "copy_file_range", "sendfile")
+    _copy_range(source, target, 1000 + len(DATA) - 10, 100)
+    assert read_all(target) == DATA[-10:]
+
+
+def test_unsupported_kernel_copy_falls_back_after_what_it_copied(monkeypatch, source, target):
+    without(monkeypatch, "sendfile")
+    calls = []
+
+    def copy_file_range(src, dst, count, offset_src, offset_dst):
+        calls.append(offset_dst)
+        if len(calls) > 1:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        # Copies a first block, as a real kernel copy may before failing
+        os.pwrite(dst, DATA[:1000], offset_dst)
+        return 1000
+
+    monkeypatch.setattr(os, "copy_file_range", copy_file_range, raising=False)
+    assert _copy_range(source, target, 1000, len(DATA)) == "buffered copy"
+    assert calls == [0, 1000]
+    assert read_all(target) == DATA
+
+
+def test_other_copy_errors_are_raised(monkeypatch, source, target):
+    def copy_file_range(*args):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(os, "copy_file_range", copy_file_range, raising=False)
+    with pytest.raises(OSError):
+        _copy_range(source, target, 1000, len(DATA))
+
+
+def test_extract_payload_picks_a_free_name(make_odm_file, tmp_path):
+    odm_file = make_odm_file("file.bin", file_size=len(DATA))
+    odm_file.append_to_payload(DATA)
+    odm_file.close_writer()
+    (tmp_path / "file.bin").write_bytes(b"already there")
+
+    output = odm_file.extract_payload(remove_payload_from_odm=True)
+    assert output == str(tmp_path / "file_1.bin")
+    assert (tmp_path / "file_1.bin").read_bytes() == DATA
+    assert os.path.getsize(odm_file.odm_filepath) == odm_file.header.header_size
+    assert ODMFile.load(odm_file.odm_filepath).header.downloaded_bytes == len(DATA)
+
+
+def test_failed_extraction_leaves_no_file(make_odm_file, monkeypatch, tmp_path):
+    odm_file = make_odm_file("file.bin", file_size=len(DATA))
+    odm_file.append_to_payload(DATA)
+    odm_file.close_writer()
+
+    def copy_range(src, dst, offset, count, chunk_size):
+        dst.write(DATA[:1000])
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr("odm_file._copy_range", copy_range)
+    with pytest.raises(OSError):
+        odm_file.extract_payload()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [os.path.basename(odm_file.odm_filepath)]
+    assert os.path.getsize(odm_file.odm_filepath) == odm_file.header.header_size + len(DATA)
@@ -0,0 +1,52 @@
+import pytest
+
+import http_pool
+from http_pool import SessionPool
+
+
+@pytest.fixture
+def pool():
+    pool = SessionPool(pool_maxsize=4, idle_timeout=60.0)
+    yield pool
+    pool.close()
+
+
+def test_one_session_per_origin(pool):
+    session = pool.get_session("http://a.example/file.bin")
+    assert pool.get_session("http://a.example/other.bin") is session
+    assert pool.get_session("http://a.example:8080/file.bin") is not session
+    assert pool.get_session("https://a.example/file.bin") is not session
+
+    stats = pool.get_stats()
+    assert (stats["sessions"], stats["session_hits"], stats["session_misses"]) == (3, 1, 3)
+
+
+def test_requests_to_one_host_reuse_the_connection(pool, serve):
+    url, data = serve("file.bin", 10 * 1024)
+    assert pool.head(url).headers["Content-Length"] == str(len(data))
+    for _ in range(3):
+        assert pool.get(url, headers={"Range": "bytes=0-99"}).content == data[:100]
+
+    stats = pool.get_stats()
+    assert stats["requests"] == 4
+    assert (stats["connection_hits"], stats["connection_misses"]) == (3, 1)
+
+
+def test_idle_sessions_are_closed(monkeypatch, clock, pool, serve):
+    monkeypatch.setattr(http_pool, "time", clock)
+    pool._last_eviction = clock.now
+    url, _ = serve("file.bin", 1024)
+    old_session = pool.get_session(url)
+    pool.get(url).close()
+
+    clock.advance(30.0)
+    pool.get_session("http://b.example/")
+    clock.advance(30.0)
+    # The origin of `url` has been idle for 60 seconds, b.example only for 30
+    assert pool.get_session(url) is not old_session
+
+    stats = pool.get_stats()
+    assert stats["evicted_sessions"] == 1
+    assert stats["sessions"] == 2
+    # Requests of the closed session are still counted
+    assert stats["requests"] == 1
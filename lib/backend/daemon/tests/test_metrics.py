@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_sums_every_thread(registry):
+    counter = Counter("odm_test_total", "Test counter", registry=registry)
+    threads = [threading.Thread(target=lambda: [counter.inc(2) for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc()
+
+    assert counter.labels().get() == 8001
+    # Finished threads are folded into the total once, not counted again
+    assert counter.labels().get() == 8001
+
+
+def test_labelled_counter_render(registry):
+    counter = Counter("odm_errors_total", "Errors", ("status",), registry=registry)
+    counter.labels(503).inc()
+    counter.labels(503).inc()
+    counter.labels('a"b').inc(5)
+    with pytest.raises(ValueError):
+        counter.labels()
+
+    assert registry.render().splitlines() == [
+        "# HELP odm_errors_total Errors",
+        "# TYPE odm_errors_total counter",
+        'odm_errors_total{status="503"} 2',
+        'odm_errors_total{status="a\\"b"} 5',
+    ]
+
+
+def test_histogram_render_is_cumulative(registry):
+    histogram = Histogram("odm_latency_seconds", "Latency", buckets=(0.1, 1.0), registry=registry)
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'odm_latency_seconds_bucket{le="0.1"} 2',
+        'odm_latency_seconds_bucket{le="1.0"} 3',
+        'odm_latency_seconds_bucket{le="+Inf"} 4',
+        "odm_latency_seconds_sum 3.65",
+        "odm_latency_seconds_count 4",
+    ]
+
+
+def test_gauge_samples_its_function(registry):
+    gauge = Gauge("odm_things", "Things", registry=registry)
+    gauge.set(3)
+    assert registry.render().endswith("odm_things 3\n")
+    things = [1, 2]
+    gauge.set_function(lambda: len(things))
+    things.append(3)
+    assert registry.render().endswith("odm_things 3\n")
+    things.clear()
+    assert registry.render().endswith("odm_things 0\n")
+
+
+def test_disabled_metrics_do_nothing(monkeypatch, registry):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    counter = Counter("odm_off_total", "Off", registry=registry)
+    histogram = Histogram("odm_off_seconds", "Off", registry=registry)
+    counter.inc(10)
+    histogram.observe(1.0)
+    assert counter.labels().get() == 0
+    assert histogram.labels().get()[1] == 0
@@ -0,0 +1,113 @@
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+from download_index import DownloadIndex
+from mirrors import MirrorSet, MirrorStats, check_mirrors, get_origin
+from odm_file import Header
+
+SIZE = 100_000
+
+
+def b64(hexdigest: str) -> str:
+    return base64.b64encode(bytes.fromhex(hexdigest)).decode()
+
+
+@pytest.fixture
+def header(server):
+    """Header of a file served by `server`, with the validators a probe would have stored"""
+    file = server.add_file("file.bin", SIZE)
+    return Header(server.url_for("file.bin"), "file.bin", file_size=SIZE, etag=file.etag,
+                  last_modified=file.last_modified)
+
+
+def test_get_origin():
+    assert get_origin("HTTPS://Mirror.example:8443/pub/file.iso?x=1") == "https://mirror.example:8443"
+
+
+def test_only_mirrors_of_the_same_file_are_kept(header, mirror_server):
+    mirror_server.add_file("file.bin", SIZE)
+    mirror_server.add_file("shorter.bin", SIZE - 1)
+    urls = [mirror_server.url_for(name) for name in ("file.bin", "shorter.bin", "missing.bin")]
+    assert check_mirrors(urls, SIZE, header.has_same_validators) == urls[:1]
+
+    mirror_server.replace_file("file.bin")
+    assert check_mirrors(urls[:1], SIZE, header.has_same_validators) == []
+
+
+def test_etag_of_another_host_is_inconclusive(header, mirror_server):
+    mirror_server.etag_prefix = "mirror-"
+    mirror_server.add_file("file.bin", SIZE)
+    url = mirror_server.url_for("file.bin")
+    assert check_mirrors([url], SIZE, lambda headers: header.has_same_validators(headers, mirror=True)) == [url]
+    # Last-Modified still tells another version apart
+    mirror_server.replace_file("file.bin")
+    assert check_mirrors([url], SIZE, lambda headers: header.has_same_validators(headers, mirror=True)) == []
+
+
+def test_digest_sent_by_a_mirror_decides():
+    digest = "00" * 16
+    headers = {"Content-Length": str(SIZE), "Digest": f"md5={b64(digest)}"}
+    session_pool = SimpleNamespace(head=lambda url, timeout: SimpleNamespace(headers=headers,
+                                                                             raise_for_status=lambda: None))
+    url = "http://a.example/f"
+    assert check_mirrors([url], SIZE, lambda headers: False, session_pool, expected_digests={"md5": digest}) == [url]
+    assert check_mirrors([url], SIZE, lambda headers: True, session_pool, expected_digests={"md5": "11" * 16}) == []
+    # Digests of other algorithms prove nothing either way
+    assert check_mirrors([url], SIZE, lambda headers: False, session_pool, expected_digests={"sha1": "22" * 20}) == []
+
+
+def test_mirrors_need_ranges_and_a_size(header, mirror_server):
+    mirror_server.add_file("file.bin", SIZE)
+    url = mirror_server.url_for("file.bin")
+    assert check_mirrors([url], None, header.has_same_validators) == []
+    mirror_server.supports_range = False
+    assert check_mirrors([url], SIZE, header.has_same_validators) == []
+
+
+def test_malformed_content_length_only_drops_that_mirror():
+    lengths = {"http://a.example/f": "100", "http://b.example/f": "one hundred"}
+    session_pool = SimpleNamespace(head=lambda url, timeout: SimpleNamespace(
+        headers={"Content-Length": lengths[url]}, raise_for_status=lambda: None))
+    assert check_mirrors(list(lengths), 100, lambda headers: True, session_pool) == ["http://a.example/f"]
+
+
+def test_stats_are_smoothed_and_saved(tmp_path):
+    index = DownloadIndex(tmp_path / "downloads.db")
+    stats = MirrorStats(index, smoothing=0.5)
+    assert stats.get_throughput("http://a.example/file") is None
+    stats.record([("http://a.example/file", 1000.0, False)])
+    stats.record([("http://a.example/other", 2000.0, False), ("http://b.example/file", None, True)])
+    assert stats.get_throughput("http://a.example/file") == 1500.0
+
+    # A failure without a measurement halves what is known
+    stats.record([("http://a.example/file", None, True)])
+    reloaded = MirrorStats(index)
+    assert reloaded.get_throughput("http://a.example/x") == 750.0
+    assert index.get_mirror_stats("http://b.example")["failures"] == 1
+    index.close()
+
+
+def make_set(estimates: dict) -> MirrorSet:
+    stats = MirrorStats()
+    stats.record([(url, throughput, False) for url, throughput in estimates.items()])
+    return MirrorSet(list(estimates), stats)
+
+
+def test_segments_go_to_the_fastest_mirrors():
+    mirror_set = make_set({"http://slow.example/f": 100.0, "http://fast.example/f": 300.0})
+    plan = mirror_set.plan(3)
+    assert [mirror.url for mirror in plan] == ["http://fast.example/f", "http://slow.example/f",
+                                               "http://fast.example/f"]
+    assert [mirror_set.get_throughput(mirror) for mirror in plan] == [300.0, 100.0, 300.0]
+
+
+def test_failed_mirror_is_replaced_by_the_fastest_left():
+    mirror_set = make_set({"http://a.example/f": 100.0, "http://b.example/f": 300.0, "http://c.example/f": 200.0})
+    a, b, c = mirror_set.mirrors
+    assert mirror_set.replace(b, OSError("reset")) is c
+    assert b.to_dict()["failed"] and b.error == "reset"
+    assert mirror_set.plan(2) == [c, a]
+    assert mirror_set.replace(c, OSError("reset")) is a
+    assert mirror_set.replace(a, OSError("reset")) is None
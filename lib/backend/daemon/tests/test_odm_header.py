@@ -0,0 +1,114 @@
+import io
+import json
+import os
+
+import pytest
+
+from conftest import read_payload
+from odm_file import Header, ODMFile, Segment
+
+FIELDS = dict(
+    url="http://example.com/file.bin",
+    download_filename="file.bin",
+    website="example.com",
+    download_dir="/tmp/downloads",
+    file_size=3000,
+    downloaded_bytes=1200,
+    created_at="2024-05-01 10:00:00",
+    last_attempt="2024-05-01 10:05:30",
+    preallocated=True,
+    supports_resume=True,
+)
+
+
+def make_header(version: int) -> Header:
+    header = Header(**FIELDS, version=version, header_size=Header.DEFAULT_SIZES[version])
+    header.segments = [Segment(0, 1000, 1000), Segment(1000, 2000, 200), Segment(2000, 3000, 0)]
+    return header
+
+
+def read_back(header: Header) -> dict:
+    return Header.read_dict(io.BytesIO(header.to_bytes()))
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_header_round_trip(version):
+    header = make_header(version)
+    data = read_back(header)
+    # Version 2 keeps the format of its timestamps, which are stored as numbers
+    assert data.pop("datetime_format", header.datetime_format) == header.datetime_format
+    assert data == header.to_dict()
+
+
+def test_v1_header_is_nul_padded_json():
+    raw = make_header(1).to_bytes()
+    assert len(raw) == 128 * 1024
+    assert json.loads(raw.rstrip(b"\x00"))["url"] == FIELDS["url"]
+
+
+def test_v2_header_is_compact_binary():
+    raw = make_header(2).to_bytes()
+    assert len(raw) == Header.DEFAULT_SIZES[2]
+    assert raw.startswith(Header.V2_MAGIC)
+
+
+def test_v2_header_keeps_unknown_values():
+    header = Header("http://example.com/file.bin", "file.bin", version=2, header_size=Header.DEFAULT_SIZES[2])
+    data = read_back(header)
+    assert data["file_size"] is None
+    assert data["supports_resume"] is None
+    assert data["segments"] is None
+    assert data["created_at"] is None
+
+
+def test_v2_header_limits_segment_table():
+    header = make_header(2)
+    header.segments = [Segment(i, i + 1) for i in range(Header.V2_MAX_SEGMENTS + 1)]
+    with pytest.raises(ValueError):
+        header.to_bytes()
+
+
+def test_v2_checkpoint_rewrites_metadata_only_when_it_changes(make_odm_file):
+    odm_file = make_odm_file(header_version=2)
+    writer = odm_file.open_writer()
+    writer.write(b"x" * 100)
+    writer.checkpoint()
+    assert writer.header_writes == 2  # Metadata blob, then the hot fields
+    writer.write(b"x" * 100)
+    writer.checkpoint()
+    assert writer.header_writes == 3
+    odm_file.header.website = "example.org"
+    writer.checkpoint()
+    assert writer.header_writes == 5
+    odm_file.close_writer()
+
+    loaded = ODMFile.load(odm_file.odm_filepath).header
+    assert (loaded.version, loaded.downloaded_bytes, loaded.website) == (2, 200, "example.org")
+
+
+@pytest.mark.parametrize("source, target", [(1, 2), (2, 1)])
+def test_migrate_keeps_fields_and_payload(make_odm_file, source, target):
+    odm_file = make_odm_file(header_version=source, file_size=1000, header_size=Header.DEFAULT_SIZES[2])
+    payload = os.urandom(1000)
+    with open(odm_file.odm_filepath, "r+b") as f:
+        f.seek(odm_file.header.header_size)
+        f.write(payload)
+    odm_file.header.downloaded_bytes = 1000
+    odm_file.header.segments = [Segment(0, 600, 600), Segment(600, 1000, 400)]
+    odm_file.write_header()
+
+    migrated = ODMFile.migrate(odm_file.odm_filepath, version=target)
+    loaded = ODMFile.load(odm_file.odm_filepath)
+
+    assert migrated.header.version == loaded.header.version == target
+    expected = {**odm_file.header.to_dict(), "version": target}
+    assert loaded.header.to_dict() == expected
+    assert read_payload(loaded) == payload
+
+
+def test_migrate_refuses_header_that_does_not_fit(make_odm_file):
+    # Fits as JSON, but not after the fixed part and segment table of version 2
+    odm_file = make_odm_file(header_version=1, header_size=Header.DEFAULT_SIZES[2], website="x" * 15000)
+    with pytest.raises(ValueError):
+        ODMFile.migrate(odm_file.odm_filepath, version=2)
+    assert ODMFile.load(odm_file.odm_filepath).header.version == 1
@@ -0,0 +1,157 @@
+import errno
+import os
+import threading
+import zlib
+
+import pytest
+
+import disk_writer
+from conftest import read_payload
+from odm_file import ODMFile
+
+
+def open_writer(odm_file, writer_pool, **kwargs):
+    options = {"buffer_size": 64 * 1024, "checkpoint_bytes": 1 << 30, "checkpoint_interval": 3600, **kwargs}
+    return odm_file.open_writer(pool=writer_pool, **options)
+
+
+def test_header_only_records_progress_at_checkpoints(make_odm_file, writer_pool):
+    odm_file = make_odm_file()
+    writer = open_writer(odm_file, writer_pool)
+    data = os.urandom(200 * 1024)
+    for i in range(0, len(data), 10 * 1024):
+        writer.write(data[i:i + 10 * 1024])
+
+    assert odm_file.header.downloaded_bytes == len(data)
+    assert ODMFile.load(odm_file.odm_filepath).header.downloaded_bytes == 0
+
+    writer.checkpoint()
+    assert ODMFile.load(odm_file.odm_filepath).header.downloaded_bytes == len(data)
+    assert read_payload(odm_file) == data
+    odm_file.close_writer()
+
+
+def test_checkpoint_is_due_after_checkpoint_bytes(make_odm_file, writer_pool):
+    odm_file = make_odm_file()
+    # Nothing reaches the disk queue before the checkpoint, which would put it off
+    writer = open_writer(odm_file, writer_pool, buffer_size=1 << 20, checkpoint_bytes=100 * 1024)
+    writer.write(os.urandom(60 * 1024))
+    assert writer.header_writes == 0
+    writer.write(os.urandom(60 * 1024))
+    assert writer.header_writes >= 1
+    assert ODMFile.load(odm_file.odm_filepath).header.downloaded_bytes == 120 * 1024
+    odm_file.close_writer()
+
+
+def test_close_persists_buffered_bytes(make_odm_file, writer_pool):
+    odm_file = make_odm_file()
+    writer = open_writer(odm_file, writer_pool)
+    writer.write(b"abc")
+    odm_file.close_writer()
+
+    assert writer.closed
+    assert ODMFile.load(odm_file.odm_filepath).header.downloaded_bytes == 3
+    assert read_payload(odm_file) == b"abc"
+
+
+def test_segments_are_written_at_their_offsets(make_odm_file, writer_pool):
+    data = os.urandom(300 * 1024)
+    odm_file = make_odm_file(file_size=len(data))
+    segments = odm_file.header.split_into_segments(3)
+    writer = open_writer(odm_file, writer_pool)
+    for segment in reversed(segments):
+        taken = writer.write_segment(segment, data[segment.start:segment.end] + b"past the end")
+        assert taken == segment.end - segment.start
+    odm_file.close_writer()
+
+    loaded = ODMFile.load(odm_file.odm_filepath).header
+    assert [segment.is_complete for segment in loaded.segments] == [True, True, True]
+    assert loaded.get_contiguous_bytes() == len(data)
+    assert read_payload(odm_file)[:len(data)] == data
+
+
+def test_split_segment_is_checkpointed_at_once(make_odm_file, writer_pool):
+    data = os.urandom(200 * 1024)
+    odm_file = make_odm_file(file_size=len(data), header_version=2)
+    segment, = odm_file.header.split_into_segments(1)
+    writer = open_writer(odm_file, writer_pool)
+    writer.write_segment(segment, data[:1000])
+    new_segment = writer.split_segment(segment, min_size=1024)
+
+    loaded = ODMFile.load(odm_file.odm_filepath).header
+    assert [(s.start, s.end) for s in loaded.segments] == [(0, new_segment.start), (new_segment.start, len(data))]
+    assert loaded.segments[0].downloaded == 1000
+    # The connection that was split stops at its new end
+    assert writer.write_segment(segment, data[1000:]) == new_segment.start - 1000
+    assert writer.split_segment(new_segment, min_size=len(data)) is None
+    odm_file.close_writer()
+
+
+def test_on_checkpoint_runs_without_the_writer_lock(make_odm_file, writer_pool):
+    odm_file = make_odm_file()
+    writer = open_writer(odm_file, writer_pool, checkpoint_bytes=1000)
+    lock_free = []
+
+    def probe():
+        # From another thread, as the lock is reentrant
+        acquired = writer._lock.acquire(blocking=False)
+        lock_free.append(acquired)
+        if acquired:
+            writer._lock.release()
+
+    def on_checkpoint(checkpointed):
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+
+    odm_file.on_checkpoint = on_checkpoint
+    writer.write(b"x" * 1500)  # Checkpoint due
+    odm_file.close_writer()
+    assert lock_free == [True, True]
+
+
+def test_reset_starts_the_payload_over(make_odm_file, writer_pool):
+    odm_file = make_odm_file(file_size=300 * 1024)
+    odm_file.header.checksum.add_expected("md5", "00" * 16)
+    writer = open_writer(odm_file, writer_pool)
+    writer.write(os.urandom(200 * 1024))
+    writer.checkpoint()
+    writer.write(b"still buffered")
+    odm_file.header.file_size = 1000
+
+    writer.reset(preallocate=True)
+    writer.write(b"new")
+    odm_file.close_writer()
+    header = ODMFile.load(odm_file.odm_filepath).header
+    assert (header.downloaded_bytes, header.segments) == (3, None)
+    assert header.checksum.expected == {"md5": "00" * 16}
+    assert header.checksum.get_runs() == [(0, 3, zlib.crc32(b"new"))]
+    payload = read_payload(odm_file)
+    assert payload[:3] == b"new" and len(payload) == (1000 if header.preallocated else 3)
+
+
+def test_failed_queue_write_goes_back_to_last_checkpoint(monkeypatch, make_odm_file, writer_pool):
+    first, second = os.urandom(100 * 1024), os.urandom(100 * 1024)
+    odm_file = make_odm_file(file_size=len(first) + len(second))
+    writer = open_writer(odm_file, writer_pool)
+    writer.write(first)
+    writer.checkpoint()
+
+    def fail(f, buffers, offset):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(disk_writer, "pwritev", fail)
+    writer.write(second)
+    with pytest.raises(OSError):
+        odm_file.close_writer()
+    assert writer.closed
+    assert odm_file.header.downloaded_bytes == len(first)
+    assert odm_file.header.checksum.get_runs() == [(0, len(first), zlib.crc32(first))]
+
+    # The download picks up from the restored progress
+    monkeypatch.undo()
+    writer = open_writer(odm_file, writer_pool)
+    writer.write(second)
+    odm_file.close_writer()
+    assert read_payload(odm_file) == first + second
+    assert odm_file.finish_checksum() == {"crc32": f"{zlib.crc32(first + second):08x}"}
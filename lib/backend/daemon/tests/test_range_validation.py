@@ -0,0 +1,71 @@
+import pytest
+
+from conftest import read_payload
+from download_manager import Download, RemoteFileChangedError, check_range_response
+from odm_file import ODMFile
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Tue, 14 Nov 2023 22:13:20 GMT"
+
+
+@pytest.fixture
+def partial(make_odm_file):
+    """An .odm file of a 1000 byte file with 400 bytes downloaded, and the Download for it"""
+    odm_file = make_odm_file(file_size=1000, header_version=2, etag=ETAG, last_modified=LAST_MODIFIED)
+    with open(odm_file.odm_filepath, "r+b") as f:
+        f.seek(odm_file.header.header_size)
+        f.write(b"a" * 400)
+    odm_file.header.downloaded_bytes = 400
+    odm_file.write_header()
+    return Download(str(odm_file.odm_filepath))
+
+
+def test_expected_range_is_accepted(partial):
+    header = partial._odm_object.header
+    check_range_response(header, 206, {"Content-Range": "bytes 400-999/1000", "ETag": ETAG}, 400)
+    # Nothing to compare against is no reason to restart
+    check_range_response(header, 206, {"Content-Range": "bytes 400-999/*"}, 400)
+    assert partial._get_range_headers(400) == {"Range": "bytes=400-", "If-Range": ETAG}
+
+
+@pytest.mark.parametrize("headers", [
+    {"Content-Range": "bytes 0-999/1000", "ETag": ETAG},
+    {"Content-Range": "bytes 400-1999/2000", "ETag": ETAG},
+    {"Content-Range": "bytes 400-999/1000", "ETag": '"v2"'},
+    {"Content-Range": "bytes 400-999/1000", "Last-Modified": "Wed, 15 Nov 2023 08:00:00 GMT"},
+    {},
+])
+def test_partial_response_of_another_version_is_refused(partial, headers):
+    with pytest.raises(RemoteFileChangedError) as raised:
+        check_range_response(partial._odm_object.header, 206, headers, 400)
+    assert not raised.value.ranges_ignored
+
+
+def test_whole_file_with_the_same_etag_skips_what_is_on_disk(partial):
+    headers = {"Content-Length": "1000", "ETag": ETAG}
+    with pytest.raises(RemoteFileChangedError) as raised:
+        check_range_response(partial._odm_object.header, 200, headers, 400)
+    assert raised.value.ranges_ignored
+
+    assert partial._accept_whole_file(headers, raised.value, 400) == 400
+    header = partial._odm_object.header
+    assert (header.downloaded_bytes, header.supports_resume) == (400, False)
+    assert read_payload(partial._odm_object).startswith(b"a" * 400)
+
+
+@pytest.mark.parametrize("etag", ['"v2"', 'W/"v1"'])
+def test_whole_file_of_a_new_version_restarts_the_payload(partial, etag):
+    header = partial._odm_object.header
+    if etag.startswith("W/"):
+        # A weak ETag doesn't prove the bytes are the same
+        header.etag = etag
+    headers = {"Content-Length": "600", "ETag": etag}
+    with pytest.raises(RemoteFileChangedError) as raised:
+        check_range_response(header, 200, headers, 400)
+
+    assert partial._accept_whole_file(headers, raised.value, 400) == 0
+    partial._odm_object.close_writer()
+    header = ODMFile.load(partial.odm_file_path).header
+    assert (header.downloaded_bytes, header.file_size, header.etag) == (0, 600, etag)
+    assert header.checksum.get_runs() == []
+    assert read_payload(partial._odm_object) == b""
@@ -0,0 +1,77 @@
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter, TokenBucket
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(rate_limiter, "time", clock)
+
+
+@pytest.mark.parametrize("rate", [None, 0, -100])
+def test_unlimited_bucket_never_waits(rate):
+    bucket = TokenBucket(rate)
+    assert bucket.rate is None
+    assert bucket.reserve(10 ** 9) == 0.0
+
+
+def test_burst_is_free_then_rate_applies():
+    bucket = TokenBucket(1000, burst_seconds=0.5)
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    assert bucket.reserve(1000) == pytest.approx(1.5)
+
+
+def test_bucket_refills_with_time(clock):
+    bucket = TokenBucket(1000, burst_seconds=0.0)
+    assert bucket.reserve(1000) == pytest.approx(1.0)
+    clock.advance(1.0)
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    # Idle time doesn't pile up beyond the burst
+    clock.advance(100.0)
+    assert bucket.reserve(1000) == pytest.approx(1.0)
+
+
+def test_rate_change_drops_backlog_of_old_rate():
+    bucket = TokenBucket(10, burst_seconds=0.0)
+    assert bucket.reserve(100) == pytest.approx(10.0)
+    bucket.rate = 1000
+    assert bucket.reserve(100) == pytest.approx(0.1)
+    bucket.rate = 0
+    assert bucket.rate is None
+    assert bucket.reserve(100) == 0.0
+
+
+def test_download_waits_for_the_stricter_bucket():
+    limiter = RateLimiter(global_rate=1000)
+    limiter.global_bucket.burst_seconds = 0.0
+    limiter.set_rate("a", 100)
+    limiter._get_bucket("a").burst_seconds = 0.0
+
+    assert limiter.reserve("a", 100) == pytest.approx(1.0)
+    # The global bucket is shared: "b" has no limit of its own but waits behind "a"
+    assert limiter.reserve("b", 900) == pytest.approx(1.0)
+
+
+def test_throttle_sleeps_for_the_delay(clock):
+    limiter = RateLimiter(per_download_rate=1000)
+    limiter._get_bucket("a").burst_seconds = 0.0
+    limiter.throttle("a", 250)
+    assert clock.slept == [pytest.approx(0.25)]
+
+
+def test_remove_forgets_the_download_bucket():
+    limiter = RateLimiter(per_download_rate=500)
+    limiter.set_rate("a", 100)
+    assert limiter.get_rate("a") == 100
+    limiter.remove("a")
+    assert "a" not in limiter._buckets
+    assert limiter.get_rate("a") == 500
+    limiter.remove("unknown")
+
+
+def test_reading_a_rate_creates_no_bucket():
+    limiter = RateLimiter(per_download_rate=-1)
+    assert limiter.get_rate("a") is None
+    assert limiter._buckets == {}
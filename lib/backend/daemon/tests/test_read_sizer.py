@@ -0,0 +1,79 @@
+import pytest
+
+import read_sizer
+from read_sizer import ReadSizer, ReceiveBuffer
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(read_sizer, "time", clock)
+
+
+def receive(sizer, clock, rate: float, seconds: float):
+    """Feeds reads of the current size arriving at `rate` bytes per second"""
+    for _ in range(int(seconds / 0.01)):
+        clock.advance(0.01)
+        sizer.record(int(rate * 0.01), 0.01)
+
+
+def make_sizer() -> ReadSizer:
+    return ReadSizer(initial=64 * 1024, minimum=16 * 1024, maximum=4 << 20, target_seconds=0.02,
+                     adjust_interval=0.25, stall_seconds=0.5)
+
+
+def test_initial_size_is_clamped():
+    assert ReadSizer(initial=1, minimum=16 * 1024).size == 16 * 1024
+    assert ReadSizer(initial=1 << 30, maximum=4 << 20).size == 4 << 20
+
+
+def test_size_follows_the_throughput(clock):
+    sizer = make_sizer()
+    receive(sizer, clock, 50 << 20, 0.3)
+    # 50 MiB/s over 20 ms is 1 MiB
+    assert sizer.size == 1 << 20
+
+    # The first measurement of the new rate still holds reads at the old one
+    receive(sizer, clock, 5 << 20, 0.6)
+    # 100 KiB, rounded down to a power of two
+    assert sizer.size == 64 * 1024
+
+
+def test_size_stays_within_bounds(clock):
+    sizer = make_sizer()
+    receive(sizer, clock, 10 << 30, 0.3)
+    assert sizer.size == 4 << 20
+    receive(sizer, clock, 1024, 0.6)
+    assert sizer.size == 16 * 1024
+
+
+def test_size_waits_for_the_adjust_interval(clock):
+    sizer = make_sizer()
+    receive(sizer, clock, 50 << 20, 0.2)
+    assert sizer.size == 64 * 1024
+
+
+def test_stalled_read_halves_the_size_right_away(clock):
+    sizer = make_sizer()
+    receive(sizer, clock, 50 << 20, 0.3)
+    clock.advance(1.0)
+    sizer.record(1 << 20, 1.0)
+    assert sizer.size == 512 * 1024
+    # The stall doesn't count towards the next measurement
+    receive(sizer, clock, 50 << 20, 0.3)
+    assert sizer.size == 1 << 20
+
+
+def test_receive_buffer_is_reused_while_large_enough():
+    buffer = ReceiveBuffer()
+    view = buffer.reserve(64 * 1024)
+    assert len(view) == 64 * 1024
+    assert buffer.reserve(16 * 1024) is view
+    assert buffer.reserve(64 * 1024) is view
+
+
+def test_receive_buffer_grows_keeping_its_first_bytes():
+    buffer = ReceiveBuffer()
+    buffer.reserve(4)[:4] = b"abcd"
+    view = buffer.reserve(5, keep=3)
+    assert len(view) == 8
+    assert bytes(view[:3]) == b"abc"
@@ -0,0 +1,142 @@
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import pytest
+
+import retry
+from retry import (CONNECTION, RATE_LIMITED, SERVER_ERROR, TIMEOUT, CircuitBreaker, RetryPolicy, RetryTimer,
+                   classify_http_status, parse_retry_after)
+
+
+@pytest.fixture
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(retry, "time", clock)
+    return clock
+
+
+@pytest.mark.parametrize("status, error_class", [
+    (429, RATE_LIMITED), (408, TIMEOUT), (500, SERVER_ERROR), (503, SERVER_ERROR),
+    (501, None), (505, None), (404, None), (403, None),
+])
+def test_classify_http_status(status, error_class):
+    assert classify_http_status(status) == error_class
+
+
+def test_parse_retry_after(fake_time):
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    date = format_datetime(datetime.fromtimestamp(fake_time.now + 30, timezone.utc), usegmt=True)
+    assert parse_retry_after(date) == pytest.approx(30.0)
+    past = format_datetime(datetime.fromtimestamp(fake_time.now - 30, timezone.utc), usegmt=True)
+    assert parse_retry_after(past) == 0.0
+
+
+def test_backoff_doubles_with_equal_jitter():
+    policy = RetryPolicy({CONNECTION: (4, 2.0, 10.0)})
+    for attempt, backoff in [(1, 2.0), (2, 4.0), (3, 8.0), (4, 10.0)]:
+        delays = [policy.get_delay(CONNECTION, attempt) for _ in range(50)]
+        assert all(backoff / 2 <= delay <= backoff for delay in delays)
+    assert policy.get_delay(CONNECTION, 5) is None
+
+
+def test_unknown_errors_are_not_retried():
+    policy = RetryPolicy({CONNECTION: (4, 2.0, 10.0)})
+    assert policy.get_delay(None, 1) is None
+    assert policy.get_delay(SERVER_ERROR, 1) is None
+
+
+def test_retry_after_is_a_capped_minimum():
+    policy = RetryPolicy({RATE_LIMITED: (3, 1.0, 10.0)}, retry_after_max=60.0)
+    assert policy.get_delay(RATE_LIMITED, 1, retry_after=30.0) == 30.0
+    assert policy.get_delay(RATE_LIMITED, 1, retry_after=3600.0) == 60.0
+    assert policy.get_delay(RATE_LIMITED, 1, retry_after=0.0) <= 1.0
+
+
+def test_circuit_opens_after_threshold(fake_time):
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=60.0)
+    for _ in range(2):
+        breaker.record_failure("a.example")
+    assert breaker.get_state("a.example") == "closed"
+    assert breaker.acquire("a.example") == 0.0
+
+    breaker.record_failure("a.example")
+    assert breaker.get_state("a.example") == "open"
+    assert breaker.acquire("a.example") == pytest.approx(60.0)
+    assert breaker.get_state("b.example") == "closed"
+    assert breaker.open_count == 1
+
+
+def test_success_resets_the_failure_count(fake_time):
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60.0)
+    breaker.record_failure("a.example")
+    breaker.record_success("a.example")
+    breaker.record_failure("a.example")
+    assert breaker.get_state("a.example") == "closed"
+
+
+def test_half_open_circuit_lets_one_probe_through(fake_time):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60.0)
+    breaker.record_failure("a.example")
+    fake_time.advance(60.0)
+    assert breaker.get_state("a.example") == "half_open"
+    assert breaker.get_wait("a.example") == 0.0
+
+    assert breaker.acquire("a.example") == 0.0
+    assert breaker.acquire("a.example") == pytest.approx(60.0)
+
+    breaker.record_success("a.example")
+    assert breaker.get_state("a.example") == "closed"
+    assert breaker.acquire("a.example") == 0.0
+    assert breaker.open_count == 0
+
+
+def test_failed_probe_opens_the_circuit_again(fake_time):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60.0)
+    breaker.record_failure("a.example")
+    fake_time.advance(60.0)
+    assert breaker.acquire("a.example") == 0.0
+    fake_time.advance(5.0)
+    breaker.record_failure("a.example")
+    assert breaker.get_state("a.example") == "open"
+    assert breaker.acquire("a.example") == pytest.approx(60.0)
+
+
+def test_lost_probe_frees_its_turn(fake_time):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60.0)
+    breaker.record_failure("a.example")
+    fake_time.advance(60.0)
+    assert breaker.acquire("a.example") == 0.0
+    fake_time.advance(60.0)
+    assert breaker.acquire("a.example") == 0.0
+
+
+def test_retry_timer_calls_back_in_due_order():
+    called = []
+    done = threading.Event()
+
+    def callback(item):
+        called.append(item)
+        if len(called) == 2:
+            done.set()
+
+    timer = RetryTimer(callback, name="test-retry-timer")
+    timer.schedule("late", 0.2)
+    timer.schedule("cancelled", 0.01)
+    timer.schedule("early", 0.05)
+    assert timer.cancel("cancelled")
+    assert not timer.cancel("unknown")
+
+    assert done.wait(5)
+    assert called == ["early", "late"]
+    assert len(timer) == 0
+
+
+def test_retry_timer_thread_is_named():
+    done = threading.Event()
+    names = []
+    timer = RetryTimer(lambda item: (names.append(threading.current_thread().name), done.set()), name="odm-test")
+    timer.schedule("item", 0.0)
+    assert done.wait(5)
+    assert names == ["odm-test"]
@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+
+import pytest
+
+from scheduler import DownloadScheduler, PRIORITY_HIGH, PRIORITY_LOW
+
+
+class FakeDownload:
+    """What the scheduler uses of a Download: its URL, its connections and resume()"""
+
+    def __init__(self, name: str, host: str = "example.com", segment_count: int = 1, started: list = None):
+        self.name = name
+        self.header = SimpleNamespace(url=f"http://{host}/{name}")
+        self.segment_count = segment_count
+        self._started = started
+
+    def _use_segments(self) -> bool:
+        return self.segment_count > 1
+
+    def resume(self):
+        self._started.append(self.name)
+
+    def __repr__(self):
+        return f"FakeDownload({self.name})"
+
+
+@pytest.fixture
+def started():
+    return []
+
+
+def test_starts_up_to_max_active_in_fifo_order(started):
+    scheduler = DownloadScheduler(max_active=2, max_connections_per_host=10)
+    downloads = [FakeDownload(name, started=started) for name in "abc"]
+    for download in downloads:
+        scheduler.enqueue(download)
+
+    assert started == ["a", "b"]
+    assert scheduler.is_queued(downloads[2])
+    assert scheduler.get_entry_status(downloads[2]) == {"queue_state": "queued", "queue_position": 0,
+                                                        "priority": 0}
+
+    scheduler.on_download_stopped(downloads[0])
+    assert started == ["a", "b", "c"]
+    assert scheduler.get_entry_status(downloads[0])["queue_state"] == "inactive"
+
+
+def test_higher_priority_starts_first(started):
+    scheduler = DownloadScheduler(max_active=1, max_connections_per_host=10)
+    running = FakeDownload("running", started=started)
+    scheduler.enqueue(running)
+    low = FakeDownload("low", started=started)
+    normal = FakeDownload("normal", started=started)
+    high = FakeDownload("high", started=started)
+    scheduler.enqueue(low, PRIORITY_LOW)
+    scheduler.enqueue(normal)
+    scheduler.enqueue(high, PRIORITY_HIGH)
+
+    positions = scheduler.get_queue_positions()
+    assert [positions[d] for d in (high, normal, low)] == [0, 1, 2]
+
+    for download in (running, high, normal):
+        scheduler.on_download_stopped(download)
+    assert started == ["running", "high", "normal", "low"]
+
+
+def test_set_priority_reorders_the_queue(started):
+    scheduler = DownloadScheduler(max_active=1, max_connections_per_host=10)
+    scheduler.enqueue(FakeDownload("running", started=started))
+    first = FakeDownload("first", started=started)
+    second = FakeDownload("second", started=started)
+    scheduler.enqueue(first)
+    scheduler.enqueue(second)
+
+    scheduler.set_priority(second, PRIORITY_HIGH)
+    assert scheduler.get_queue_positions() == {second: 0, first: 1}
+
+
+def test_busy_host_lets_other_hosts_go_ahead(started):
+    scheduler = DownloadScheduler(max_active=10, max_connections_per_host=4)
+    scheduler.enqueue(FakeDownload("big", host="a.example", segment_count=4, started=started))
+    same_host = FakeDownload("same-host", host="a.example", started=started)
+    scheduler.enqueue(same_host)
+    scheduler.enqueue(FakeDownload("other-host", host="b.example", started=started))
+
+    assert started == ["big", "other-host"]
+    assert list(scheduler.get_queue_positions()) == [same_host]
+
+
+def test_idle_host_always_admits_one_download(started):
+    scheduler = DownloadScheduler(max_active=10, max_connections_per_host=2)
+    wide = FakeDownload("wide", segment_count=8, started=started)
+    scheduler.enqueue(wide)
+    scheduler.enqueue(FakeDownload("next", started=started))
+    assert started == ["wide"]
+
+    scheduler.on_download_stopped(wide)
+    assert started == ["wide", "next"]
+
+
+def test_removed_download_is_not_started(started):
+    scheduler = DownloadScheduler(max_active=1, max_connections_per_host=10)
+    running = FakeDownload("running", started=started)
+    waiting = FakeDownload("waiting", started=started)
+    scheduler.enqueue(running)
+    scheduler.enqueue(waiting)
+    version = scheduler.version
+
+    scheduler.remove(waiting)
+    scheduler.on_download_stopped(running)
+    assert started == ["running"]
+    assert scheduler.version > version
+    assert scheduler.get_entry_status(waiting)["queue_state"] == "inactive"
@@ -0,0 +1,97 @@
+import pytest
+
+from odm_file import Header, ODMFile, Segment
+
+
+def make_header(file_size=1000, downloaded_bytes=0) -> Header:
+    return Header("http://example.com/file.bin", "file.bin", file_size=file_size, downloaded_bytes=downloaded_bytes)
+
+
+def ranges(segments):
+    return [(segment.start, segment.end, segment.downloaded) for segment in segments]
+
+
+def test_split_into_equal_segments():
+    header = make_header()
+    assert ranges(header.split_into_segments(4)) == [(0, 250, 0), (250, 500, 0), (500, 750, 0), (750, 1000, 0)]
+    assert header.segments is not None
+
+
+def test_split_keeps_sequential_progress_in_first_segment():
+    header = make_header(downloaded_bytes=100)
+    segments = header.split_into_segments(4)
+    assert ranges(segments) == [(0, 325, 100), (325, 550, 0), (550, 775, 0), (775, 1000, 0)]
+    assert header.get_contiguous_bytes() == 100
+
+
+def test_split_by_weights():
+    header = make_header()
+    assert ranges(header.split_into_segments(2, weights=[3.0, 1.0])) == [(0, 750, 0), (750, 1000, 0)]
+
+
+def test_split_never_makes_empty_segments():
+    header = make_header(file_size=3)
+    assert ranges(header.split_into_segments(8)) == [(0, 1, 0), (1, 2, 0), (2, 3, 0)]
+
+
+def test_split_needs_file_size():
+    with pytest.raises(ValueError):
+        make_header(file_size=None).split_into_segments(4)
+
+
+def test_contiguous_bytes_stop_at_first_incomplete_segment():
+    header = make_header()
+    first, second, third, fourth = header.split_into_segments(4)
+    first.downloaded = 250
+    second.downloaded = 100
+    fourth.downloaded = 250
+    assert header.get_contiguous_bytes() == 350
+    second.downloaded = 250
+    third.downloaded = 250
+    assert header.get_contiguous_bytes() == 1000
+
+
+def test_split_segment_halves_remaining_bytes():
+    header = make_header()
+    first, second = header.split_into_segments(2)
+    first.downloaded = 100
+    new_segment = header.split_segment(first, min_size=10)
+
+    assert ranges([first, new_segment]) == [(0, 300, 100), (300, 500, 0)]
+    assert header.segments == [first, new_segment, second]
+    assert sum(segment.end - segment.start for segment in header.segments) == 1000
+
+
+def test_split_segment_respects_min_size():
+    header = make_header()
+    first, _ = header.split_into_segments(2)
+    first.downloaded = 450
+    assert header.split_segment(first, min_size=26) is None
+    assert header.split_segment(first, min_size=25) is not None
+
+
+def test_split_segment_stops_when_table_is_full():
+    header = make_header(file_size=Header.V2_MAX_SEGMENTS * 100)
+    header.split_into_segments(Header.V2_MAX_SEGMENTS)
+    assert header.split_segment(header.segments[0]) is None
+
+
+def test_segment_progress():
+    segment = Segment(100, 200, downloaded=40)
+    assert segment.remaining == 60
+    assert not segment.is_complete
+    assert Segment.from_dict(segment.to_dict()).to_dict() == {"start": 100, "end": 200, "downloaded": 40}
+    segment.downloaded = 100
+    assert segment.is_complete
+
+
+def test_segments_are_stored_in_the_header(make_odm_file):
+    odm_file = make_odm_file(file_size=1000)
+    first, second = odm_file.header.split_into_segments(2)
+    first.downloaded = 300
+    odm_file.write_header()
+
+    loaded = ODMFile.load(odm_file.odm_filepath)
+    assert ranges(loaded.header.segments) == [(0, 500, 300), (500, 1000, 0)]
+    assert loaded.get_resume_byte(loaded.header.segments[0]) == loaded.header.header_size + 300
+    assert make_odm_file("plain.bin").header.segments is None
@@ -0,0 +1,59 @@
+import pytest
+
+import speed_meter
+from speed_meter import SpeedMeter
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    # Half a bucket in, so that bucket boundaries don't depend on rounding
+    clock.now = 1000.05
+    monkeypatch.setattr(speed_meter, "time", clock)
+
+
+def feed(meter, clock, amount, seconds, step=0.1):
+    for _ in range(round(seconds / step)):
+        meter.update(amount)
+        clock.advance(step)
+
+
+def test_no_data():
+    meter = SpeedMeter()
+    assert meter.get_speed() == 0.0
+    assert meter.get_smoothed_speed() == 0.0
+    assert meter.get_eta(1000) is None
+    assert meter.get_eta(None) is None
+    assert meter.get_eta(0) == 0.0
+
+
+def test_steady_rate(clock):
+    meter = SpeedMeter(window=1.0, buckets=10, smoothing_time=5.0)
+    feed(meter, clock, 1000, 3.0)
+
+    assert meter.get_speed() == pytest.approx(10_000, rel=0.1)
+    # The average starts from zero, which the bias correction makes up for
+    assert meter.get_smoothed_speed() == pytest.approx(10_000)
+    assert meter.get_eta(50_000) == pytest.approx(5.0)
+
+
+def test_window_forgets_old_bytes(clock):
+    meter = SpeedMeter(window=1.0, buckets=10, smoothing_time=5.0)
+    feed(meter, clock, 1000, 2.0)
+    clock.advance(5.0)
+    assert meter.get_speed() == 0.0
+    # The smoothed speed decays instead
+    assert 0 < meter.get_smoothed_speed() < 10_000
+
+
+def test_speed_follows_rate_change(clock):
+    meter = SpeedMeter(window=1.0, buckets=10, smoothing_time=5.0)
+    feed(meter, clock, 1000, 5.0)
+    feed(meter, clock, 4000, 2.0)
+    assert meter.get_speed() == pytest.approx(40_000, rel=0.1)
+    assert 10_000 < meter.get_smoothed_speed() < 40_000
+
+
+def test_short_transfer_is_not_diluted_by_window(clock):
+    meter = SpeedMeter(window=1.0, buckets=10, smoothing_time=5.0)
+    feed(meter, clock, 1000, 0.3)
+    assert meter.get_speed() == pytest.approx(10_000, rel=0.2)
@@ -0,0 +1,137 @@
+import asyncio
+import time
+from pathlib import Path
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import daemon_main
+from config import INDEX_DB_FILE
+
+
+class FakeServices:
+    """Stands in for create_services, which would load the real download manager"""
+
+    def __init__(self, monkeypatch, fail: bool = False, engine: str = "threads"):
+        self.monkeypatch = monkeypatch
+        self.fail = fail
+        self.engine = engine
+        self.release = Event()
+        self.restored = Event()
+        self.started_hub = False
+        self.stopped_hub = False
+        self.closed = False
+
+    def __call__(self):
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("no disk")
+        manager = SimpleNamespace(list_downloads=lambda state=None, host=None: [{"path": "a.odm", "state": state}],
+                                  restore_downloads=self.restored.set, close=self.close)
+        if self.engine == "asyncio":
+            manager.attach_loop = lambda loop: None
+            manager.close = self.close_async
+        self.monkeypatch.setattr(daemon_main, "manager", manager)
+        self.monkeypatch.setattr(daemon_main, "event_hub", SimpleNamespace(start=self.start_hub, stop=self.stop_hub))
+
+    def start_hub(self):
+        self.started_hub = True
+
+    def stop_hub(self):
+        self.stopped_hub = True
+
+    def close(self):
+        self.closed = True
+
+    async def close_async(self):
+        await asyncio.sleep(0)
+        self.closed = True
+
+
+@pytest.fixture
+def services(monkeypatch):
+    services = FakeServices(monkeypatch)
+    monkeypatch.setattr(daemon_main, "create_services", services)
+    monkeypatch.setattr(daemon_main, "_services_ready", Event())
+    monkeypatch.setattr(daemon_main, "startup_timings", {})
+    return services
+
+
+def wait_until_ready(client):
+    for _ in range(500):
+        if client.get("/health").json()["ready"]:
+            return
+        time.sleep(0.01)
+    raise AssertionError("the daemon didn't get ready")
+
+
+def test_health_answers_before_the_manager_exists(services):
+    with TestClient(daemon_main.app) as client:
+        health = client.get("/health").json()
+        assert (health["status"], health["ready"]) == ("ok", False)
+        assert "serving" in health["startup_timings"]
+
+        services.release.set()
+        wait_until_ready(client)
+        assert client.get("/downloads", params={"state": "paused"}).json() == [{"path": "a.odm", "state": "paused"}]
+        assert services.started_hub
+        assert services.restored.wait(5)
+        assert "ready" in client.get("/health").json()["startup_timings"]
+
+
+def test_endpoints_fail_when_the_manager_does_not_start(services):
+    services.fail = True
+    services.release.set()
+    with TestClient(daemon_main.app) as client:
+        wait_until_ready(client)
+        response = client.get("/downloads")
+        assert response.status_code == 503
+        assert not services.restored.is_set()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_shutdown_closes_the_manager(services, engine):
+    services.engine = engine
+    services.release.set()
+    with TestClient(daemon_main.app) as client:
+        wait_until_ready(client)
+        assert not services.closed
+    assert services.closed and services.stopped_hub
+
+
+def test_shutdown_before_the_manager_exists(services):
+    with TestClient(daemon_main.app) as client:
+        assert not client.get("/health").json()["ready"]
+    services.release.set()
+    assert not services.closed
+
+
+def test_startup_report_uses_a_throwaway_index(monkeypatch, capsys):
+    index_files = []
+
+    def create_services(index_db_file=None):
+        index_files.append(index_db_file)
+        assert Path(index_db_file).parent.is_dir()
+        daemon_main.manager = SimpleNamespace(index=SimpleNamespace(close=lambda: None))
+        daemon_main.startup_timings["create_services"] = 0.5
+
+    def run(args, **kwargs):
+        # Runs the report's code here rather than in a fresh interpreter
+        code = args[args.index("-c") + 1]
+        exec(code, {})
+        return SimpleNamespace(returncode=0, stdout=capsys.readouterr().out,
+                               stderr="import time: self [us] | cumulative | imported package\n"
+                                      "import time:       120 |       3400 | fastapi\n")
+
+    monkeypatch.setattr(daemon_main, "create_services", create_services)
+    monkeypatch.setattr(daemon_main, "manager", None)
+    monkeypatch.setattr(daemon_main, "startup_timings", {})
+    monkeypatch.setattr("subprocess.run", run)
+    daemon_main.print_startup_report()
+
+    assert len(index_files) == 1 and Path(index_files[0]) != INDEX_DB_FILE
+    assert not Path(index_files[0]).parent.exists()
+    report = capsys.readouterr().out
+    assert "create_services" in report and "fastapi" in report
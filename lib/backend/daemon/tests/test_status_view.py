@@ -0,0 +1,169 @@
+from types import SimpleNamespace
+
+import pytest
+
+import daemon_main
+
+from status_view import StatusView
+
+
+class FakeDownload:
+    def __init__(self, download_id: str, **status):
+        self.id = download_id
+        self.status = {"state": "downloading", "host": "example.com", "downloaded_bytes": 0, **status}
+
+
+class FakeManager:
+    """What StatusView uses of a DownloadManager"""
+
+    def __init__(self):
+        self.listeners = []
+        self.active_downloads = {}
+        self.scheduler = SimpleNamespace(version=0, get_queue_positions=dict)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add(self, download):
+        self.active_downloads[download.id] = download
+        self.changed(download)
+
+    def remove(self, download):
+        del self.active_downloads[download.id]
+        self.changed(download)
+
+    def changed(self, download):
+        for listener in self.listeners:
+            listener(download)
+
+    @staticmethod
+    def get_download_id(download):
+        return download.id
+
+    def is_listed(self, download):
+        return self.active_downloads.get(download.id) is download
+
+    @staticmethod
+    def get_raw_download_status(download, queue_positions):
+        return dict(download.status)
+
+
+@pytest.fixture
+def manager():
+    return FakeManager()
+
+
+@pytest.fixture
+def view(manager):
+    return StatusView(manager)
+
+
+def test_refresh_only_bumps_version_on_real_changes(manager, view):
+    a = FakeDownload("a")
+    manager.add(a)
+    version = view.refresh()
+    assert version == 1
+
+    manager.changed(a)
+    assert view.refresh() == version
+    a.status["downloaded_bytes"] = 10
+    manager.changed(a)
+    assert view.refresh() == version + 1
+
+
+def test_since_returns_only_changed_fields(manager, view):
+    a, b = FakeDownload("a"), FakeDownload("b")
+    manager.add(a)
+    manager.add(b)
+    since = view.refresh()
+
+    a.status["downloaded_bytes"] = 500
+    manager.changed(a)
+    version = view.refresh()
+
+    assert view.get_changes(since) == (version, {"a": {"downloaded_bytes": 500}})
+    assert view.query(since=since)["downloads"] == [{"id": "a", "downloaded_bytes": 500}]
+    assert view.query(since=version)["downloads"] == []
+    assert view.query()["total"] == 2
+
+
+def test_removed_download_is_reported_once_and_dropped(manager, view):
+    a, b = FakeDownload("a"), FakeDownload("b")
+    manager.add(a)
+    manager.add(b)
+    since = view.refresh()
+
+    manager.remove(a)
+    version = view.refresh()
+
+    assert version == since + 1
+    assert view.get_changes(since) == (version, {"a": None})
+    assert view.query(since=since, state="paused")["downloads"] == [{"id": "a", "removed": True}]
+    assert [entry["id"] for entry in view.query()["downloads"]] == ["b"]
+    assert "a" not in view.get_snapshot()[1]
+
+
+def test_download_added_again_is_listed_again(manager, view):
+    a = FakeDownload("a")
+    manager.add(a)
+    view.refresh()
+    manager.remove(a)
+    since = view.refresh()
+
+    manager.add(a)
+    view.refresh()
+    assert view.get_changes(since)[1]["a"]["state"] == "downloading"
+    assert view._removed_count == 0
+
+
+def test_only_the_last_removals_are_remembered(manager):
+    view = StatusView(manager, max_removed=2)
+    downloads = [FakeDownload(str(i)) for i in range(4)]
+    for download in downloads:
+        manager.add(download)
+    view.refresh()
+    for download in downloads:
+        manager.remove(download)
+        view.refresh()
+
+    assert view.get_changes(0)[1] == {"3": None, "2": None}
+
+
+def test_query_filters_and_pages(manager, view):
+    for i in range(5):
+        manager.add(FakeDownload(f"d{i}", state="paused" if i % 2 else "downloading",
+                                 host="a.example" if i < 3 else "b.example"))
+    view.refresh()
+
+    assert sorted(d["id"] for d in view.query(state="paused")["downloads"]) == ["d1", "d3"]
+    assert sorted(d["id"] for d in view.query(host="b.example")["downloads"]) == ["d3", "d4"]
+    page = view.query(offset=1, limit=2)
+    assert page["total"] == 5
+    assert page["downloads"] == view.query()["downloads"][1:3]
+
+
+def test_queue_changes_refresh_every_download(manager, view):
+    a = FakeDownload("a")
+    manager.add(a)
+    view.refresh()
+    a.status["queue_position"] = 3  # Not marked dirty, only the scheduler changed
+    manager.scheduler.version += 1
+    view.refresh()
+    assert view.get_snapshot()[1]["a"]["queue_position"] == 3
+
+
+def test_status_etag_is_per_query(monkeypatch, api, manager, view):
+    monkeypatch.setattr(daemon_main, "manager", manager)
+    monkeypatch.setattr(daemon_main, "status_view", view)
+    manager.add(FakeDownload("a"))
+    first = api.get("/status")
+    etag = first.headers["ETag"]
+    assert first.json()["total"] == 1
+
+    assert api.get("/status", headers={"If-None-Match": etag}).status_code == 304
+    # Another query may have another answer at the same version
+    filtered = api.get("/status", params={"state": "paused"}, headers={"If-None-Match": etag})
+    assert filtered.status_code == 200 and filtered.json()["total"] == 0
+
+    manager.remove(manager.active_downloads["a"])
+    assert api.get("/status", headers={"If-None-Match": etag}).status_code == 200